@@ -1,12 +1,176 @@
 # agent.py
+import array
+import codecs
+import collections
+import contextlib
 import fnmatch
-import glob
+import functools
+import hashlib
+import io
+import itertools
+import json
+import math
+import mmap
 import os
 import re
+import socketserver
 import sys
+import threading
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from prompt_forest import prompt_templates
+from prompt_forest import compile_template, prompt_templates
+
+# 選択できるプロンプト（番号: (テンプレート名, 説明)）
+PROMPT_CHOICES = {
+    "1": ("review_prompt", "コードレビュー"),
+    "2": ("revise_prompt", "コード修正・作成"),
+    "3": ("error_prompt", "エラー解析"),
+    "4": ("ask_prompt", "コードについての質問"),
+    "5": ("code_prompt", "コードのみの提示"),
+}
+# ディレクトリ走査などの I/O 処理で使うスレッド数の既定値
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# 1ファイル・全ファイル合計で読み込む最大バイト数の既定値（超えた分は抜粋にする）
+DEFAULT_MAX_FILE_BYTES = 1024 * 1024
+DEFAULT_MAX_TOTAL_BYTES = 16 * 1024 * 1024
+# バイナリ判定で調べる先頭バイト数と、代表的なバイナリ形式のシグネチャ
+BINARY_SNIFF_BYTES = 8192
+_BINARY_SIGNATURES = (
+    b"\x89PNG",
+    b"GIF8",
+    b"\xff\xd8\xff",
+    b"%PDF",
+    b"PK\x03\x04",
+    b"\x1f\x8b",
+    b"BZh",
+    b"\xfd7zXZ",
+    b"7z\xbc\xaf",
+    b"\x7fELF",
+    b"\xca\xfe\xba\xbe",
+    b"\xcf\xfa\xed\xfe",
+    b"SQLite format 3",
+)
+# ファイル内容のキャッシュ（FileCache）がメモリ上に保持する最大バイト数の既定値
+DEFAULT_FILE_CACHE_BYTES = 256 * 1024 * 1024
+# 常駐モードでディレクトリ構造の変更を確認する間隔（秒）
+DEFAULT_POLL_INTERVAL = 1.0
+# --refresh で使うプロンプトのマニフェストの形式のバージョン
+MANIFEST_VERSION = 1
+# トークン数の上限で抜粋にする場合に、最低限残すトークン数
+MIN_EXCERPT_TOKENS = 256
+# UTF-8 のデコードを分割して行う単位（バイト）
+DECODE_CHUNK_BYTES = 1024 * 1024
+# UTF-8 にエンコードできない文字（サロゲート）
+_SURROGATE_PATTERN = re.compile("[\ud800-\udfff]")
+# 走査結果などのキャッシュを保存するディレクトリ（agent_simple/.cache）
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+
+class Profiler:
+    """
+    プロンプト生成の段階ごとの処理時間・呼び出し回数と、読み込み量などのカウンタを記録するクラス。
+    段階の時間はスレッドをまたいで合計するため、並列処理では実時間より大きくなることがあり、
+    入れ子の段階（render の中の read など）はそれぞれに計上される。
+    use_cprofile=True の場合は、メインスレッドを cProfile でも計測する。
+    """
+
+    enabled = True
+
+    def __init__(self, use_cprofile=False):
+        self.stages = collections.defaultdict(lambda: [0.0, 0])  # 名前 -> [秒, 回数]
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._cprofile = None
+        if use_cprofile:
+            import cProfile
+
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """with 文の中の処理時間を name の段階として計上する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                entry = self.stages[name]
+                entry[0] += elapsed
+                entry[1] += 1
+
+    def count(self, name, amount=1):
+        """カウンタ name に amount を加える"""
+        with self._lock:
+            self.counters[name] += amount
+
+    def report(self, **extra):
+        """計測結果を辞書にする（extra はそのまま追加する）"""
+        report = {
+            "total_seconds": round(time.perf_counter() - self._start, 6),
+            "stages": {
+                name: {"seconds": round(seconds, 6), "calls": calls}
+                for name, (seconds, calls) in sorted(
+                    self.stages.items(), key=lambda item: -item[1][0]
+                )
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+        try:
+            import resource
+
+            # Linux の ru_maxrss は KB 単位
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            report["peak_rss_mb"] = round(peak / 1024, 1)
+        except ImportError:
+            pass
+        report.update(extra)
+        return report
+
+    def save(self, path, **extra):
+        """レポートを JSON で path に保存し、cProfile を使っている場合は .pstats も保存する"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(**extra), f, ensure_ascii=False, indent=2)
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(os.path.splitext(path)[0] + ".pstats")
+
+
+class _NullProfiler:
+    """計測しない場合の Profiler（何もしない）"""
+
+    enabled = False
+    _stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, amount=1):
+        pass
+
+
+_profiler = _NullProfiler()
+
+
+def set_profiler(profiler):
+    """計測に使う Profiler を設定し、それまでの Profiler を返す（None で計測を止める）"""
+    global _profiler
+    previous = _profiler
+    _profiler = profiler or _NullProfiler()
+    return previous
+
+
+def get_profiler():
+    """現在の Profiler を返す（計測していない場合は何もしない Profiler）"""
+    return _profiler
 
 
 def replace_top_folder(path, old_folder="src", new_folder="/var/www"):
@@ -21,6 +185,35 @@ def replace_top_folder(path, old_folder="src", new_folder="/var/www"):
     return adjusted_path
 
 
+def folder_mappings(folder_mapping):
+    """
+    フォルダの対応（("src", "/var/www")）または対応のリストを、(old, new) のリストにする関数。
+    先頭の対応を主なルートとして扱う（出力先や自動選択の索引に使う）。
+    """
+    if isinstance(folder_mapping[0], str):
+        return [tuple(folder_mapping)]
+    return [tuple(mapping) for mapping in folder_mapping]
+
+
+def map_folder(path, folder_mapping):
+    """
+    path の先頭のフォルダを、一致する対応（複数ある場合は最初に一致したもの）で置き換える関数。
+    (置き換えたパス, 対応する new_folder) を返す。一致しない場合はパスを含む new_folder、
+    どれにも含まれなければ主なルートを返す。
+    """
+    mappings = folder_mappings(folder_mapping)
+    top = path.strip(os.sep).split(os.sep)[0]
+    for old_folder, new_folder in mappings:
+        if top == old_folder:
+            return replace_top_folder(path, old_folder, new_folder), new_folder
+    abs_path = os.path.abspath(path)
+    for _, new_folder in mappings:
+        root = os.path.abspath(new_folder)
+        if abs_path == root or abs_path.startswith(root.rstrip(os.sep) + os.sep):
+            return path, new_folder
+    return path, mappings[0][1]
+
+
 def select_prompt(prompts):
     """プロンプトを選択する関数"""
     print("\n利用可能なプロンプト:")
@@ -36,9 +229,8 @@ def select_prompt(prompts):
 
 
 def get_required_variables(prompt_template):
-    """プロンプトから必要な変数を抽出する関数"""
-    pattern = r"\{(.*?)\}"
-    variables = re.findall(pattern, prompt_template)
+    """プロンプトから必要な変数を抽出する関数（テンプレートの分解結果はキャッシュされる）"""
+    variables = list(compile_template(prompt_template).variables)
     allowed_vars = {
         "code",
         "error",
@@ -57,33 +249,78 @@ def get_required_variables(prompt_template):
     return variables
 
 
-def _decode_with_warning(byte_data: bytes) -> str:
+def decode_utf8(data, chunk_size=DECODE_CHUNK_BYTES):
     """
-    bytes を UTF-8 でデコードする。strict デコードが失敗した場合は ignore で再デコードし、
-    ユーザーに characters が削除された旨を警告する。
+    bytes（または mmap などのバッファ）を UTF-8 として1回だけ走査してデコードする関数。
+    不正なバイトは取り除き、(テキスト, 取り除いたバイト範囲 [(開始, 終了), ...]) を返す。
+    チャンク単位で処理するため、一時的なコピーはチャンクの大きさに収まる。
     """
+    parts = []
+    dropped = []
+    chunk_size = max(chunk_size, 4)
+    view = memoryview(data)
     try:
-        return byte_data.decode("utf-8", errors="strict")
-    except UnicodeDecodeError:
-        warnings.warn("Some characters were removed due to decode errors.", UserWarning)
-        return byte_data.decode("utf-8", errors="ignore")
+        size = len(view)
+        pos = 0
+        while pos < size:
+            end = min(pos + chunk_size, size)
+            try:
+                # final=False の場合、チャンク末尾で途切れた文字は次のチャンクに回される
+                text, consumed = codecs.utf_8_decode(
+                    view[pos:end], "strict", end == size
+                )
+            except UnicodeDecodeError as e:
+                text, _ = codecs.utf_8_decode(view[pos : pos + e.start], "strict", True)
+                start = pos + e.start
+                if dropped and dropped[-1][1] == start:
+                    dropped[-1] = (dropped[-1][0], pos + e.end)
+                else:
+                    dropped.append((start, pos + e.end))
+                consumed = e.end
+            parts.append(text)
+            pos += consumed
+    finally:
+        view.release()
+    return "".join(parts), dropped
+
+
+def _format_offsets(dropped, limit=5):
+    """取り除いたバイト範囲を "6-7, 20-23 (+3 more)" のような文字列にする関数"""
+    text = ", ".join(f"{start}-{end}" for start, end in dropped[:limit])
+    if len(dropped) > limit:
+        text += f" (+{len(dropped) - limit} more)"
+    return text
+
+
+def _decode_with_warning(byte_data: bytes) -> str:
+    """
+    bytes を UTF-8 で1回だけ走査してデコードする。不正なバイトは取り除き、
+    ユーザーに characters が削除された旨とそのバイト位置を警告する。
+    """
+    text, dropped = decode_utf8(byte_data)
+    if dropped:
+        warnings.warn(
+            "Some characters were removed due to decode errors "
+            f"(byte offsets: {_format_offsets(dropped)}).",
+            UserWarning,
+        )
+    return text
 
 
 def sanitize_string(s):
     """
     文字列(またはバイト列)からデコードエラーを引き起こす部分を削除し、
     その際は警告を表示する関数。
+    文字列の場合、UTF-8 にできないのはサロゲート文字だけなので、エンコードせずに検索する。
     """
     if isinstance(s, bytes):
         return _decode_with_warning(s)
-    try:
-        s.encode("utf-8", errors="strict")
+    if s.isascii() or not _SURROGATE_PATTERN.search(s):
         return s
-    except UnicodeEncodeError:
-        warnings.warn(
-            "Some characters in string were removed due to encode errors.", UserWarning
-        )
-        return s.encode("utf-8", errors="ignore").decode("utf-8", errors="ignore")
+    warnings.warn(
+        "Some characters in string were removed due to encode errors.", UserWarning
+    )
+    return _SURROGATE_PATTERN.sub("", s)
 
 
 def sanitize_input(prompt=""):
@@ -92,7 +329,8 @@ def sanitize_input(prompt=""):
     デコードエラー部分を削除（警告付き）して返す関数。
     """
     print(prompt, end="", flush=True)
-    line = sys.stdin.buffer.readline()
+    with _profiler.stage("input"):
+        line = sys.stdin.buffer.readline()
     if not line:
         return ""
     return _decode_with_warning(line).rstrip("\n")
@@ -104,19 +342,30 @@ def read_lines():
     Ctrl+C(KeyboardInterrupt) で抜ける。
     """
     lines = []
-    try:
-        for line in sys.stdin.buffer:
-            if not line:
-                break
-            line_decoded = _decode_with_warning(line).rstrip("\n")
-            lines.append(line_decoded)
-    except KeyboardInterrupt:
-        pass
+    with _profiler.stage("input"):
+        try:
+            for line in sys.stdin.buffer:
+                if not line:
+                    break
+                line_decoded = _decode_with_warning(line).rstrip("\n")
+                lines.append(line_decoded)
+        except KeyboardInterrupt:
+            pass
     return lines
 
 
 def get_input_for_variable(
-    var_name, folder_mapping, include_ignore=False, prompt_name=None
+    var_name,
+    folder_mapping,
+    include_ignore=False,
+    prompt_name=None,
+    workers=DEFAULT_WORKERS,
+    use_cache=False,
+    max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+    max_total_bytes=DEFAULT_MAX_TOTAL_BYTES,
+    reader=None,
+    tree_max_depth=None,
+    tree_max_files=None,
 ):
     """各変数に対してユーザ入力を取得する関数"""
     if var_name == "code":
@@ -135,34 +384,23 @@ def get_input_for_variable(
                 break
             file_specs.extend(line.split())
         # コードを読み込む
-        file_path_option = "1"  # デフォルト
         if file_specs:
-            # @と!の検出
-            contains_at = any("@" in spec for spec in file_specs)
-            contains_bang = any("!" in spec for spec in file_specs)
-            if contains_at and contains_bang:
-                print("エラー：ファイル名に@と!の両方を含めることはできません。")
+            try:
+                file_specs, file_path_option = parse_file_specs(file_specs)
+            except ValueError as e:
+                print(e)
                 sys.exit(1)
-            elif contains_at:
-                file_path_option = "3"
-                # '@'を削除
-                file_specs = [
-                    spec.replace("@", "") for spec in file_specs if "@" != spec
-                ]
-            elif contains_bang:
-                file_path_option = "2"
-                # '!'を削除
-                file_specs = [
-                    spec.replace("!", "") for spec in file_specs if "!" != spec
-                ]
-            else:
-                file_path_option = "1"
-            # コードを読み込む
-            code_content = read_code_as_markdown(
-                file_list=file_specs,
+            # 対象ファイルを特定する（内容はプロンプトの書き込み時に読み込む）
+            code_section = CodeSection(
+                file_specs,
                 folder_mapping=folder_mapping,
+                workers=workers,
+                max_file_bytes=max_file_bytes,
+                max_total_bytes=max_total_bytes,
+                reader=reader,
+                matcher=build_ignore_matcher(include_ignore),
             )
-            return code_content, file_path_option
+            return code_section, file_path_option
         else:
             # ファイル指定がない場合
             file_path_option = "1"
@@ -178,45 +416,262 @@ def get_input_for_variable(
             )
             or "y"
         )
-        if include_dir.lower() == "y":
-            dir_path = folder_mapping[0]
-            return list_directory_structure(
-                dir_path, folder_mapping=folder_mapping, include_ignore=include_ignore
-            )
-        elif include_dir and include_dir.lower() != "n":
-            return list_directory_structure(
-                include_dir,
-                folder_mapping=folder_mapping,
-                include_ignore=include_ignore,
-            )
-        else:
+        work_directory = resolve_directory_choice(include_dir, folder_mapping)
+        if work_directory is None:
             return ""
+        return list_directory_section(
+            work_directory,
+            folder_mapping=folder_mapping,
+            include_ignore=include_ignore,
+            workers=workers,
+            use_cache=use_cache,
+            max_depth=tree_max_depth,
+            max_files=tree_max_files,
+        )
     else:
         return ""
 
 
+def parse_file_specs(file_specs):
+    """
+    ファイルスペックから @ / ! を取り除き、(スペックのリスト, file_path_option) を返す関数。
+    @ は "3"（与えられたコードのみ）、! は "2"（ファイルパスを必ず要求）、それ以外は "1"。
+    """
+    contains_at = any("@" in spec for spec in file_specs)
+    contains_bang = any("!" in spec for spec in file_specs)
+    if contains_at and contains_bang:
+        raise ValueError("エラー：ファイル名に@と!の両方を含めることはできません。")
+    elif contains_at:
+        # '@'を削除
+        return [spec.replace("@", "") for spec in file_specs if "@" != spec], "3"
+    elif contains_bang:
+        # '!'を削除
+        return [spec.replace("!", "") for spec in file_specs if "!" != spec], "2"
+    return list(file_specs), "1"
+
+
+def resolve_directory_choice(include_dir, folder_mapping):
+    """
+    ディレクトリ構造の選択（y / n / 特定のパス）から、走査するディレクトリを返す関数。
+    n の場合は None を返す。フォルダの対応が複数ある場合、y はすべての old_folder のタプルを返す。
+    """
+    include_dir = include_dir or "y"
+    if include_dir.lower() == "y":
+        mappings = folder_mappings(folder_mapping)
+        if len(mappings) > 1:
+            return tuple(old_folder for old_folder, _ in mappings)
+        return mappings[0][0]
+    elif include_dir.lower() != "n":
+        return include_dir
+    return None
+
+
+def set_file_path_prompts(input_values, file_path_option):
+    """file_path_option に応じてファイルパス要求の文言を input_values に設定する関数"""
+    if file_path_option == "1":
+        conditional_file_path_request_prompt_text = prompt_templates[
+            "conditional_file_path_request_prompt"
+        ]
+        file_path_request_prompt_text = ""
+    elif file_path_option == "2":
+        conditional_file_path_request_prompt_text = prompt_templates[
+            "conditional_file_path_request_prompt"
+        ]
+        file_path_request_prompt_text = prompt_templates["file_path_request_prompt"]
+    else:  # "3"
+        conditional_file_path_request_prompt_text = ""
+        file_path_request_prompt_text = ""
+    input_values["conditional_file_path_request_prompt"] = (
+        conditional_file_path_request_prompt_text
+    )
+    input_values["file_path_request_prompt"] = file_path_request_prompt_text
+
+
+class _ByteWriter:
+    """テキストを UTF-8（エンコードできない文字は除く）で raw に書き込み、バイト数を数えるクラス"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.size = 0
+
+    def write(self, text):
+        self.write_bytes(text.encode("utf-8", "ignore"))
+        return len(text)
+
+    def write_bytes(self, data):
+        self.raw.write(data)
+        self.size += len(data)
+
+
+class _HashWriter:
+    """書き込まれたテキストを保持せず、UTF-8 のバイト列で SHA-1 を更新していくクラス"""
+
+    def __init__(self):
+        self.digest = hashlib.sha1()
+
+    def write(self, text):
+        self.digest.update(text.encode("utf-8", "surrogateescape"))
+        return len(text)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+class _SectionSpan:
+    """セクションの write(out) を包み、出力ファイル内のバイト位置を spans に記録するクラス"""
+
+    def __init__(self, name, section, spans):
+        self.name = name
+        self.section = section
+        self.spans = spans
+
+    def write(self, out):
+        start = out.size
+        self.section.write(out)
+        self.spans.append([self.name, start, out.size])
+
+
+def write_prompt(out, prompt_template, input_values, spans=None):
+    """
+    プロンプトテンプレートにユーザ入力を埋め込みながら out に書き込む関数。
+    値が文字列以外（CodeSection など）の場合は、その write(out) で直接書き込ませる。
+    spans（リスト）を渡すと、各セクションの [変数名, 開始, 終了] のバイト位置を追加する
+    （out は _ByteWriter であること）。
+    """
+    if "code" in input_values and not input_values["code"]:
+        prompt_template = prompt_template.replace("\n# 該当コード\n{code}", "")
+    if spans is not None:
+        input_values = dict(input_values)
+        for var, section in rendered_sections(input_values).items():
+            input_values[var] = _SectionSpan(var, section, spans)
+    with _profiler.stage("render"):
+        compile_template(prompt_template).render_to(out, input_values)
+
+
 def generate_prompt(prompt_template, input_values):
     """プロンプトテンプレートにユーザ入力を埋め込む関数"""
-    formatted_prompt = prompt_template
-    if "code" in input_values and not input_values["code"]:
-        formatted_prompt = formatted_prompt.replace("\n# 該当コード\n{code}", "")
+    buffer = io.StringIO()
+    write_prompt(buffer, prompt_template, input_values)
+    return buffer.getvalue()
 
-    for key, value in input_values.items():
-        # 値が空文字列でも置換を行う
-        formatted_prompt = formatted_prompt.replace(f"{{{key}}}", value)
-    return formatted_prompt
 
+def rendered_sections(input_values):
+    """書き込み時に描画されるセクション（文字列以外の値）を {変数名: 値} で返す関数"""
+    return {
+        var: value
+        for var, value in input_values.items()
+        if not isinstance(value, str) and (var != "code" or value)
+    }
 
-def create_input_prompt(folder_mapping=("src", "/var/www"), include_ignore=False):
-    """プロンプトファイルから入力を生成する関数"""
-    prompts = {
-        "1": ("review_prompt", "コードレビュー"),
-        "2": ("revise_prompt", "コード修正・作成"),
-        "3": ("error_prompt", "エラー解析"),
-        "4": ("ask_prompt", "コードについての質問"),
-        "5": ("code_prompt", "コードのみの提示"),
+
+def describe_job(prompt_template, input_values):
+    """
+    入力値からバッチ処理と同じ形式のジョブ（辞書）を作る関数（--refresh のマニフェストに保存する）。
+    自動で選んだファイルも files に記録するため、作り直しても同じファイルが使われる。
+    """
+    job = {
+        "template": next(
+            name for name, text in prompt_templates.items() if text == prompt_template
+        ),
+        "auto_files": 0,
+        "traceback_lines": 0,
+    }
+    code = input_values.get("code")
+    if isinstance(code, TracebackSection):
+        job["traceback_lines"] = code.context_lines
+    elif isinstance(code, CodeSection):
+        job["files"] = list(code.specs)
+        if input_values.get("conditional_file_path_request_prompt") == "":
+            job["files"].insert(0, "@")
+        elif input_values.get("file_path_request_prompt"):
+            job["files"].insert(0, "!")
+    for var in ["input", "error"]:
+        if isinstance(input_values.get(var), str):
+            job[var] = input_values[var]
+    tree = input_values.get("directory_structure")
+    if tree is not None:
+        if isinstance(tree, MultiTreeSection):
+            job["directory_structure"] = "y"
+        elif isinstance(tree, TreeSection):
+            job["directory_structure"] = tree.new_folder
+        else:
+            job["directory_structure"] = "n"
+    return job
+
+
+def prompt_manifest_path(output_path):
+    """出力ファイルに対応するマニフェストのパス（.aa_prompt.md -> .aa_prompt.manifest.json）"""
+    return os.path.splitext(output_path)[0] + ".manifest.json"
+
+
+def _save_manifest(output_path, manifest):
+    """マニフェストに出力ファイルのサイズと mtime を記録して保存する"""
+    st = os.stat(output_path)
+    manifest["output_stamp"] = [st.st_size, st.st_mtime_ns]
+    with open(prompt_manifest_path(output_path), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+
+def save_prompt(output_path, prompt_template, input_values, job=None, options=None):
+    """
+    プロンプトを output_path に書き込む関数。
+    job（describe_job の結果）を渡すと、--refresh で使うマニフェスト
+    （ジョブ・BatchContext の設定・セクションごとのバイト位置と指紋）も保存する。
+    """
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if job is None:
+        with open(output_path, "w", encoding="utf-8", errors="ignore") as f:
+            write_prompt(f, prompt_template, input_values)
+        return output_path
+    # 書き込み中に変更されたファイルが次回作り直されるよう、指紋は書き込む前に取る
+    fingerprints = {
+        var: section.fingerprint()
+        for var, section in rendered_sections(input_values).items()
+    }
+    spans = []
+    with open(output_path, "wb") as f:
+        write_prompt(_ByteWriter(f), prompt_template, input_values, spans)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "job": job,
+        "options": options or {},
+        "sections": [[*span, fingerprints[span[0]]] for span in spans],
     }
-    prompt_name = select_prompt(prompts)
+    try:
+        _save_manifest(output_path, manifest)
+    except OSError as e:
+        warnings.warn(f"Failed to save prompt manifest: {e}", UserWarning)
+    return output_path
+
+
+def prepare_input_prompt(
+    folder_mapping=("src", "/var/www"),
+    include_ignore=False,
+    workers=DEFAULT_WORKERS,
+    use_cache=False,
+    max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+    max_total_bytes=DEFAULT_MAX_TOTAL_BYTES,
+    max_tokens=None,
+    reader=None,
+    auto_files=0,
+    traceback_lines=0,
+    tree_max_depth=None,
+    tree_max_files=None,
+):
+    """
+    対話形式でテンプレートと入力値を集める関数。
+    (テンプレート, 入力値の辞書) を返し、描画は write_prompt / generate_prompt で行う。
+    max_tokens を指定すると、プロンプト全体がその概算トークン数に収まるように詰める。
+    reader にはファイルの読み込み関数（FileCache.read など）を渡せる。
+    auto_files を指定すると、{code} のファイル指定を省略した場合に
+    {error} / {input} の内容から関連するファイルを最大 auto_files 件自動で選ぶ。
+    traceback_lines を指定すると、{code} のファイル指定を省略した場合に
+    {error} のトレースバックが指す行の前後 traceback_lines 行を添付する（auto_files より優先）。
+    tree_max_depth / tree_max_files はディレクトリ構造を描画する深さとファイル数の上限。
+    """
+    prompt_name = select_prompt(PROMPT_CHOICES)
     prompt_template = prompt_templates[prompt_name]
     # file_path_optionの初期化
     file_path_option = "1"
@@ -228,235 +683,3153 @@ def create_input_prompt(folder_mapping=("src", "/var/www"), include_ignore=False
             continue  # 後で設定
         if var == "code":
             input_values[var], file_path_option = get_input_for_variable(
-                var, folder_mapping, include_ignore, prompt_name
+                var,
+                folder_mapping,
+                include_ignore,
+                prompt_name,
+                workers,
+                use_cache,
+                max_file_bytes,
+                max_total_bytes,
+                reader,
             )
         else:
             input_values[var] = get_input_for_variable(
-                var, folder_mapping, include_ignore, prompt_name
+                var,
+                folder_mapping,
+                include_ignore,
+                prompt_name,
+                workers,
+                use_cache,
+                tree_max_depth=tree_max_depth,
+                tree_max_files=tree_max_files,
+            )
+        # ファイル内容やツリーは書き込み時に読み込むため、文字列の入力のみここで検査する
+        if isinstance(input_values[var], (str, bytes)):
+            input_values[var] = sanitize_string(input_values[var])
+    if traceback_lines and "code" in input_values and not input_values["code"]:
+        section = traceback_section(
+            input_values.get("error") or "",
+            folder_mapping,
+            traceback_lines,
+            workers,
+            max_file_bytes,
+            max_total_bytes,
+        )
+        if section:
+            print(
+                "トレースバックが指すファイルの該当箇所を添付します:\n"
+                + "\n".join(section.files)
+            )
+            input_values["code"] = section
+    if auto_files and "code" in input_values and not input_values["code"]:
+        query = "\n".join(str(input_values.get(v) or "") for v in ["error", "input"])
+        files = select_relevant_files(
+            query, folder_mapping, auto_files, include_ignore, workers, use_cache
+        )
+        if files:
+            print("関連するファイルを自動で選択しました:\n" + "\n".join(files))
+            input_values["code"] = CodeSection(
+                files,
+                folder_mapping=folder_mapping,
+                workers=workers,
+                max_file_bytes=max_file_bytes,
+                max_total_bytes=max_total_bytes,
+                reader=reader,
             )
-        input_values[var] = sanitize_string(input_values[var])
     # file_path_optionに応じてプロンプトを設定
-    if file_path_option == "1":
-        conditional_file_path_request_prompt_text = prompt_templates[
-            "conditional_file_path_request_prompt"
-        ]
-        file_path_request_prompt_text = ""
-    elif file_path_option == "2":
-        conditional_file_path_request_prompt_text = prompt_templates[
-            "conditional_file_path_request_prompt"
-        ]
-        file_path_request_prompt_text = prompt_templates["file_path_request_prompt"]
-    else:  # "3"
-        conditional_file_path_request_prompt_text = ""
-        file_path_request_prompt_text = ""
-    input_values["conditional_file_path_request_prompt"] = (
-        conditional_file_path_request_prompt_text
+    set_file_path_prompts(input_values, file_path_option)
+    if max_tokens:
+        apply_token_budget(prompt_template, input_values, max_tokens)
+    return prompt_template, input_values
+
+
+def create_input_prompt(
+    folder_mapping=("src", "/var/www"),
+    include_ignore=False,
+    workers=DEFAULT_WORKERS,
+    use_cache=False,
+    max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+    max_total_bytes=DEFAULT_MAX_TOTAL_BYTES,
+    max_tokens=None,
+):
+    """プロンプトファイルから入力を生成する関数"""
+    prompt_template, input_values = prepare_input_prompt(
+        folder_mapping,
+        include_ignore,
+        workers,
+        use_cache,
+        max_file_bytes,
+        max_total_bytes,
+        max_tokens,
     )
-    input_values["file_path_request_prompt"] = file_path_request_prompt_text
     formatted_prompt = generate_prompt(prompt_template, input_values)
     return formatted_prompt
 
 
-def is_ignored(path, ignore_patterns, new_folder):
+_GLOB_CHARS = frozenset("*?[\\")
+
+
+def _parse_ignore_line(line):
     """
-    パスが ignore_patterns のいずれかに一致するかをチェックする関数。
+    .gitignore の1行を (否定フラグ, ディレクトリ限定フラグ, パターン) に分解する関数。
+    空行・コメント行は None を返す。
     """
-    relative_path = os.path.relpath(path, new_folder)
-    for pattern in ignore_patterns:
-        if pattern.endswith("/"):
-            base_pattern = os.path.basename(os.path.normpath(pattern))
-            base_path = os.path.basename(os.path.normpath(relative_path))
-            if fnmatch.fnmatch(base_path, base_pattern):
-                return True
-        elif "*" in pattern or "?" in pattern:
-            if fnmatch.fnmatch(relative_path, pattern):
-                return True
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    elif line[:2] in ("\\!", "\\#"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    return negated, dir_only, line
+
+
+def _ignore_pattern_to_regex(pattern):
+    """
+    gitignore のパターンを正規表現文字列に変換する関数（*, ?, [], ** に対応）。
+    先頭の / は取り除き、照合対象の文字列全体に一致する前提で変換する。
+    """
+    pattern = pattern.lstrip("/")
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            at_boundary = i == 0 or pattern[i - 1] == "/"
+            if at_boundary and pattern.startswith("**/", i):
+                res.append("(?:.*/)?")
+                i += 3
+                continue
+            if at_boundary and pattern.startswith("**", i) and i + 2 == n:
+                res.append(".*")
+                i += 2
+                continue
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j == -1:
+                res.append("\\[")
+            else:
+                body = pattern[i + 1 : j].replace("\\", "\\\\")
+                if body[:1] in ("!", "^"):
+                    body = "^" + body[1:]
+                res.append("[" + body + "]")
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
         else:
-            if relative_path == pattern:
-                return True
-    return False
+            res.append(re.escape(c))
+        i += 1
+    return "".join(res)
 
 
-def get_directory_structure(new_folder, ignore_patterns):
-    """ディレクトリ構造を取得する関数"""
-    dir_structure = []
-    for dirpath, dirnames, filenames in os.walk(new_folder):
-        if is_ignored(dirpath, ignore_patterns, new_folder):
-            continue
-        dirnames[:] = [
-            d
-            for d in dirnames
-            if not is_ignored(os.path.join(dirpath, d), ignore_patterns, new_folder)
-        ]
-        filenames[:] = [
-            f
-            for f in filenames
-            if not is_ignored(os.path.join(dirpath, f), ignore_patterns, new_folder)
-        ]
-        depth = dirpath[len(new_folder) :].count(os.sep)
-        dir_info = {
-            "depth": depth,
-            "dirname": os.path.basename(dirpath),
-            "files": filenames,
-        }
-        dir_structure.append(dir_info)
-    return dir_structure
+def _combine_regex_rules(rules):
+    """
+    (番号, 正規表現) のリストを1つの正規表現にまとめる関数。
+    番号の大きい順に並べるため、fullmatch の lastgroup が最後に一致したルールを示す。
+    """
+    if not rules:
+        return None
+    alternatives = [f"(?P<r{index}>{regex})" for index, regex in reversed(rules)]
+    return re.compile("|".join(alternatives), re.DOTALL)
 
 
-def format_directory_structure(dir_structure, new_folder):
-    """ディレクトリ構造を文字列に整形する関数"""
-    output = ""
-    for i, dir_info in enumerate(dir_structure):
-        indent = " " * 4 * dir_info["depth"]
-        if i == 0:  # 最初のディレクトリの場合
-            output += "{}/\n".format(new_folder.rstrip(os.sep))  # フルパスを表示
-        else:
-            output += "{}{}/\n".format(indent, dir_info["dirname"])
-        for filename in dir_info["files"]:
-            sub_indent = " " * 4 * (dir_info["depth"] + 1)
-            output += "{}{}\n".format(sub_indent, filename)
-    return "# ディレクトリ構造\n" + output
+class _IgnoreRuleSet:
+    """1つの .gitignore（またはパターンリスト）をコンパイルしたルール集合"""
 
+    __slots__ = ("exact", "names", "name_regex", "path_regex", "negations")
 
-def list_directory_structure(
-    work_directory: str, folder_mapping=("src", "/var/www"), include_ignore=False
-) -> str:
-    """ディレクトリ構造をツリー形式で出力（.ignoreに準拠)"""
-    old_folder, new_folder = folder_mapping
-    new_folder = replace_top_folder(work_directory, old_folder, new_folder)
-    if not os.path.exists(new_folder):
-        raise FileNotFoundError(
-            f"'{new_folder}' does not exist. You should input full path."
+    def __init__(self, patterns):
+        # [0] はファイル・ディレクトリ共通、[1] はディレクトリ限定（末尾 /）のルール
+        self.exact = ({}, {})  # アンカー付きリテラル -> ルール番号
+        self.names = ({}, {})  # スラッシュなしリテラル（basename 一致） -> ルール番号
+        name_rules = ([], [])  # スラッシュなしワイルドカード（basename に適用）
+        path_rules = ([], [])  # スラッシュありワイルドカード（相対パス全体に適用）
+        self.negations = set()
+        for index, line in enumerate(patterns):
+            parsed = _parse_ignore_line(line)
+            if parsed is None:
+                continue
+            negated, dir_only, pattern = parsed
+            if negated:
+                self.negations.add(index)
+            anchored = "/" in pattern
+            if _GLOB_CHARS.isdisjoint(pattern):
+                table = self.exact if anchored else self.names
+                table[dir_only][pattern.strip("/")] = index
+            elif anchored:
+                path_rules[dir_only].append((index, _ignore_pattern_to_regex(pattern)))
+            else:
+                name_rules[dir_only].append((index, _ignore_pattern_to_regex(pattern)))
+        # ディレクトリの照合では共通ルールとディレクトリ限定ルールの両方を使う
+        self.name_regex = (
+            _combine_regex_rules(name_rules[0]),
+            _combine_regex_rules(sorted(name_rules[0] + name_rules[1])),
+        )
+        self.path_regex = (
+            _combine_regex_rules(path_rules[0]),
+            _combine_regex_rules(sorted(path_rules[0] + path_rules[1])),
         )
-    try:
-        ignore_patterns = []
-        if not include_ignore:
-            if os.path.exists(".gitignore"):
-                with open(".gitignore", "r") as f:
-                    ignore_patterns += [
-                        line.strip()
-                        for line in f.readlines()
-                        if line.strip() and not line.startswith("#")
-                    ]
-            if os.path.exists(".dirignore"):
-                with open(".dirignore", "r") as f:
-                    ignore_patterns += [
-                        line.strip()
-                        for line in f.readlines()
-                        if line.strip() and not line.startswith("#")
-                    ]
-        ignore_patterns = [".git/", "agent_simple/"] + ignore_patterns
-        dir_structure = get_directory_structure(new_folder, ignore_patterns)
-        output = format_directory_structure(dir_structure, new_folder)
-        return output
-    except Exception as e:
-        return f"An error occurred: {e}"
 
+    def verdict(self, rel_path, is_dir):
+        """
+        最後に一致したルールに従い True(除外)/False(否定で再包含) を返す。
+        どのルールにも一致しない場合は None を返す。
+        """
+        name = rel_path.rpartition("/")[2]
+        best = max(self.names[0].get(name, -1), self.exact[0].get(rel_path, -1))
+        if is_dir:
+            best = max(
+                best, self.names[1].get(name, -1), self.exact[1].get(rel_path, -1)
+            )
+        regex = self.name_regex[is_dir]
+        if regex is not None:
+            m = regex.fullmatch(name)
+            if m:
+                best = max(best, int(m.lastgroup[1:]))
+        regex = self.path_regex[is_dir]
+        if regex is not None:
+            m = regex.fullmatch(rel_path)
+            if m:
+                best = max(best, int(m.lastgroup[1:]))
+        if best < 0:
+            return None
+        return best not in self.negations
 
-def get_files_from_spec(file_spec):
-    """ファイルスペックからファイルリストを取得する関数"""
-    if os.path.isdir(file_spec):
-        files = [
-            os.path.join(file_spec, f)
-            for f in os.listdir(file_spec)
-            if os.path.isfile(os.path.join(file_spec, f))
-        ]
-    elif os.path.isfile(file_spec):
-        files = [file_spec]
-    else:
-        exact_match = glob.glob(file_spec)
-        if exact_match:
-            files = exact_match
-        else:
-            if '*' in file_spec or '?' in file_spec:
-                files = glob.glob(file_spec)
-            else:
-                files = []
-    return files
-
-
-def read_code_as_markdown(file_list: list, folder_mapping=("src", "/var/www")):
-    """コードをMarkdown形式で読み込む関数"""
-    old_folder, new_folder = folder_mapping
-    markdown_content = ""
-    not_found_files = []
-    if file_list:
-        for file_spec in file_list:
-            adjusted_file_spec = replace_top_folder(file_spec, old_folder, new_folder)
-            files = get_files_from_spec(adjusted_file_spec)
-            if not files:
-                print(f"警告: '{file_spec}'に該当するファイルが見つかりませんでした。")
-                not_found_files.append(adjusted_file_spec)
+
+class IgnoreMatcher:
+    """
+    gitignore 形式のパターンを一度だけコンパイルし、パスを高速に照合するクラス。
+    否定（!）、アンカー（/foo）、**、ディレクトリ限定（foo/）、
+    およびサブディレクトリの .gitignore（下位の定義が優先）に対応する。
+    パスは照合の基準ディレクトリからの相対パスで渡す。
+    """
+
+    def __init__(self, patterns=(), load_nested=False):
+        self.load_nested = load_nested
+        self._lock = threading.Lock()
+        self._patterns = {"": list(patterns)}
+        self._layers = {"": _IgnoreRuleSet(self._patterns[""])}
+        # ルートのパターンと設定から計算する識別子（走査キャッシュの無効化に使う）
+        self.signature = hashlib.sha1(
+            "\n".join([str(load_nested)] + self._patterns[""]).encode(
+                "utf-8", errors="ignore"
+            )
+        ).hexdigest()[:16]
+
+    def copy(self):
+        """ルートのパターンだけを引き継いだ IgnoreMatcher を返す（別のルートの走査に使う）"""
+        return IgnoreMatcher(self._patterns[""], self.load_nested)
+
+    def add_patterns(self, base, patterns):
+        """base ディレクトリ（相対パス, ルートは ""）に適用するパターンを追加する"""
+        base = base.strip("/")
+        with self._lock:
+            merged = self._patterns.get(base, []) + list(patterns)
+            layers = dict(self._layers)
+            layers[base] = _IgnoreRuleSet(merged)
+            self._patterns[base] = merged
+            # 照合中の他スレッドから参照されても壊れないよう、辞書ごと差し替える
+            self._layers = layers
+
+    def add_ignore_file(self, base, file_path):
+        """ignore ファイルを読み込み、base ディレクトリのパターンとして追加する"""
+        try:
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+                self.add_patterns(base, f.read().splitlines())
+        except OSError:
+            pass
+
+    def match(self, rel_path, is_dir=False):
+        """
+        エントリ自身がパターンに一致するかを判定する（親ディレクトリは見ない）。
+        親から順に枝刈りしながら走査する場合はこちらを使う。
+        """
+        if os.sep != "/":
+            rel_path = rel_path.replace(os.sep, "/")
+        layers = self._layers
+        if len(layers) == 1:
+            return bool(layers[""].verdict(rel_path, is_dir))
+        base = rel_path
+        while base:
+            base = base.rpartition("/")[0]
+            ruleset = layers.get(base)
+            if ruleset is None:
                 continue
-            for f in files:
-                code = read_file(f)
-                if code is None:
-                    not_found_files.append(f)
-                    continue
-                markdown_content = add_markdown_block(
-                    markdown_content,
-                    title=f"File {os.path.basename(f)}",
-                    code=code,
-                )
-        return markdown_content
-    else:
-        return ""
+            sub_path = rel_path[len(base) + 1 :] if base else rel_path
+            verdict = ruleset.verdict(sub_path, is_dir)
+            if verdict is not None:
+                return verdict
+        return False
+
+    def is_ignored(self, rel_path, is_dir=False):
+        """親ディレクトリが除外されている場合も含めて、パスが除外対象かを判定する"""
+        if os.sep != "/":
+            rel_path = rel_path.replace(os.sep, "/")
+        parts = [p for p in rel_path.split("/") if p and p != "."]
+        for i in range(1, len(parts)):
+            if self.match("/".join(parts[:i]), is_dir=True):
+                return True
+        return bool(parts) and self.match("/".join(parts), is_dir)
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_ignore_patterns(ignore_patterns):
+    """パターンのタプルから IgnoreMatcher を生成してキャッシュする関数"""
+    return IgnoreMatcher(ignore_patterns)
 
 
-def read_file(file_path):
-    """ファイルを読み込む関数"""
+def is_ignored(path, ignore_patterns, new_folder, is_dir=None):
+    """
+    パスが ignore_patterns のいずれかに一致するかをチェックする関数。
+    パターンは gitignore と同じ規則で解釈し、コンパイル結果はキャッシュされる。
+    is_dir は種別が分かっている呼び出し元が渡す。None の場合は stat せず、
+    従来どおりディレクトリ限定パターン（foo/）も名前で一致させる。
+    """
+    matcher = _compile_ignore_patterns(tuple(ignore_patterns))
+    relative_path = os.path.relpath(path, new_folder)
+    return matcher.is_ignored(relative_path, True if is_dir is None else is_dir)
+
+
+def _list_directory(abs_dir):
+    """
+    os.scandir でディレクトリを読み、(ファイル名リスト, サブディレクトリ名リスト) を
+    ソートして返す関数。種別判定には DirEntry のキャッシュを使い、追加の stat を避ける。
+    """
+    files = []
+    dirs = []
     try:
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
-            return file.read()
-    except FileNotFoundError as e:
-        print(f"ファイル'{file_path}'の読み込み中にエラーが発生しました: {e}")
-        return None
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    # os.walk と同様、シンボリックリンク先のディレクトリは辿らない
+                    if is_dir and entry.is_symlink():
+                        continue
+                except OSError:
+                    is_dir = False
+                (dirs if is_dir else files).append(entry.name)
+    except OSError:
+        return [], []
+    files.sort()
+    dirs.sort()
+    return files, dirs
 
 
-def add_markdown_block(markdown_content, title, code):
-    """Markdownブロックを追加する関数"""
-    markdown_content += f"\n## {title}\n"
-    markdown_content += "```\n"
-    markdown_content += code + "\n"
-    markdown_content += "```"
-    return markdown_content
+def _filter_entries(rel_dir, files, dirs, matcher):
+    """ファイル名・ディレクトリ名のリストから除外対象を取り除く関数"""
+    with _profiler.stage("ignore_match"):
+        return (
+            [f for f in files if not matcher.match(rel_dir + f)],
+            [d for d in dirs if not matcher.match(rel_dir + d, True)],
+        )
 
 
-if __name__ == "__main__":
-    import argparse
+def _scan_directory(abs_dir, rel_dir, matcher, cache=None, ignore_key=""):
+    """
+    1つのディレクトリを走査し、除外されないファイル名とサブディレクトリ名、
+    および子ディレクトリに引き継ぐ ignore_key を返す関数。
+    """
+    if cache is not None:
+        return cache.scan(abs_dir, rel_dir, matcher, ignore_key)
+    files, dirs = _list_directory(abs_dir)
+    if matcher.load_nested and ".gitignore" in files:
+        matcher.add_ignore_file(rel_dir, os.path.join(abs_dir, ".gitignore"))
+    files, dirs = _filter_entries(rel_dir, files, dirs, matcher)
+    return files, dirs, ignore_key
 
-    parser = argparse.ArgumentParser(description="Create input prompt")
-    parser.add_argument(
-        "--old_folder", type=str, default="src", help="Old folder name to be replaced"
-    )
-    parser.add_argument(
-        "--new_folder",
+
+class DirectoryCache:
+    """
+    ディレクトリ走査結果のディスクキャッシュ。
+    ディレクトリごとに mtime と一覧を保存し、mtime が変わったディレクトリだけを再走査する。
+    除外判定の結果は ignore_key（ルートのパターンと上位 .gitignore の状態から計算）が
+    一致する場合のみ再利用するため、ignore ファイルが変わると該当部分は再判定される。
+    """
+
+    VERSION = 1
+    # 保存直前に更新されたディレクトリは、同じ mtime のまま再度更新される可能性があるため信用しない
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        self.path = path
+        # rel_dir -> [mtime_ns, files, dirs, ignore_key, kept_files, kept_dirs]
+        # kept_* は除外後の一覧で、除外がない場合は None
+        self.entries = {}
+        self.updated = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, root, cache_dir=CACHE_DIR):
+        """root に対応するキャッシュファイルを読み込む（存在しなければ空のキャッシュ）"""
+        root = os.path.abspath(root)
+        digest = hashlib.sha1(root.encode("utf-8", errors="ignore")).hexdigest()
+        cache = cls(root, os.path.join(cache_dir, f"tree_{digest[:16]}.json"))
+        try:
+            with open(cache.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == cls.VERSION and data.get("root") == root:
+                cache.entries = data["entries"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return cache
+
+    def save(self):
+        """今回の走査で得た一覧を保存する（走査されなかったディレクトリは破棄される）"""
+        changed = self.changed or len(self.updated) != len(self.entries)
+        self.entries, self.updated, self.changed = self.updated, {}, False
+        if self.path is None or not changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        data = {"version": self.VERSION, "root": self.root, "entries": self.entries}
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        os.replace(tmp_path, self.path)
+
+    def scan(self, abs_dir, rel_dir, matcher, ignore_key):
+        """キャッシュを使って1つのディレクトリを走査する（_scan_directory と同じ戻り値）"""
+        try:
+            mtime = os.stat(abs_dir).st_mtime_ns
+        except OSError:
+            return [], [], ignore_key
+        entry = self.entries.get(rel_dir)
+        if entry is not None and entry[0] >= 0 and entry[0] == mtime:
+            files, dirs = entry[1], entry[2]
+            self.hits += 1
+        else:
+            files, dirs = _list_directory(abs_dir)
+            entry = None
+            self.misses += 1
+        if matcher.load_nested and ".gitignore" in files:
+            gitignore_path = os.path.join(abs_dir, ".gitignore")
+            matcher.add_ignore_file(rel_dir, gitignore_path)
+            try:
+                st = os.stat(gitignore_path)
+                stamp = f"{st.st_mtime_ns}:{st.st_size}"
+            except OSError:
+                stamp = ""
+            ignore_key = hashlib.sha1(
+                f"{ignore_key}|{rel_dir}|{stamp}".encode("utf-8", errors="ignore")
+            ).hexdigest()[:16]
+        if entry is not None and entry[3] == ignore_key:
+            kept_files = files if entry[4] is None else entry[4]
+            kept_dirs = dirs if entry[5] is None else entry[5]
+        else:
+            kept_files, kept_dirs = _filter_entries(rel_dir, files, dirs, matcher)
+        if entry is None or entry[3] != ignore_key:
+            if time.time_ns() - mtime < self.RACY_NS:
+                mtime = -1
+            entry = [
+                mtime,
+                files,
+                dirs,
+                ignore_key,
+                None if len(kept_files) == len(files) else kept_files,
+                None if len(kept_dirs) == len(dirs) else kept_dirs,
+            ]
+            self.changed = True
+        self.updated[rel_dir] = entry
+        return kept_files, kept_dirs, ignore_key
+
+
+def walk_directory_tree(new_folder, matcher, max_workers=DEFAULT_WORKERS, cache=None):
+    """
+    ディレクトリを走査し、(深さ, 相対パス, ファイル名リスト) のリストを深さ優先順で返す関数。
+    相対パスはルートが ""、それ以外は "a/b/" のように末尾に / を付ける。
+    サブディレクトリの走査はスレッドプールに分散するが、結果の順序は常に名前順で決定的。
+    cache に DirectoryCache を渡すと、mtime が変わっていないディレクトリの一覧を再利用する。
+    """
+    with _profiler.stage("walk"):
+        result = _walk_directory_tree(new_folder, matcher, max_workers, cache)
+    if _profiler.enabled:
+        _profiler.count("directories", len(result))
+        _profiler.count("files_listed", sum(len(files) for _, _, files in result))
+    return result
+
+
+def _walk_directory_tree(new_folder, matcher, max_workers, cache):
+    """walk_directory_tree の本体"""
+    root_key = matcher.signature
+    if max_workers <= 1:
+        result = []
+        stack = [(0, new_folder, "", root_key)]
+        while stack:
+            depth, abs_dir, rel_dir, key = stack.pop()
+            files, dirs, key = _scan_directory(abs_dir, rel_dir, matcher, cache, key)
+            result.append((depth, rel_dir, files))
+            stack.extend(
+                (depth + 1, os.path.join(abs_dir, name), rel_dir + name + "/", key)
+                for name in reversed(dirs)
+            )
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def scan(abs_dir, rel_dir, key):
+            files, dirs, key = _scan_directory(abs_dir, rel_dir, matcher, cache, key)
+            children = [
+                (
+                    name,
+                    executor.submit(
+                        scan, os.path.join(abs_dir, name), rel_dir + name + "/", key
+                    ),
+                )
+                for name in dirs
+            ]
+            return files, children
+
+        result = []
+        stack = [(0, "", executor.submit(scan, new_folder, "", root_key))]
+        while stack:
+            depth, rel_dir, future = stack.pop()
+            files, children = future.result()
+            result.append((depth, rel_dir, files))
+            stack.extend(
+                (depth + 1, rel_dir + name + "/", child)
+                for name, child in reversed(children)
+            )
+    return result
+
+
+def get_directory_structure(
+    new_folder, ignore_patterns, max_workers=DEFAULT_WORKERS, cache=None
+):
+    """
+    ディレクトリ構造を取得する関数。
+    ignore_patterns にはパターンのリストか IgnoreMatcher を渡す。
+    """
+    if isinstance(ignore_patterns, IgnoreMatcher):
+        matcher = ignore_patterns
+    else:
+        matcher = IgnoreMatcher(ignore_patterns)
+    root_name = os.path.basename(new_folder.rstrip(os.sep))
+    return [
+        {
+            "depth": depth,
+            "dirname": os.path.basename(rel_dir.rstrip("/")) if rel_dir else root_name,
+            "files": files,
+        }
+        for depth, rel_dir, files in walk_directory_tree(
+            new_folder, matcher, max_workers, cache
+        )
+    ]
+
+
+class DirectoryTree:
+    """
+    ディレクトリ構造をコンパクトに保持するクラス。
+    ディレクトリは深さ優先順の番号で表し、名前・深さ・親の番号・ファイル一覧の範囲を配列で持つ。
+    名前は sys.intern で共有し、ディレクトリごとの辞書やリストは作らない。
+    描画は出力する行の分だけ処理し、まとめたディレクトリの中身は辿らない。
+    """
+
+    __slots__ = (
+        "names",
+        "depths",
+        "parents",
+        "file_starts",
+        "file_chars",
+        "files",
+        "_stack",
+        "_ends",
+        "_entry_counts",
+    )
+
+    def __init__(self):
+        self.names = []
+        self.depths = array.array("i")
+        self.parents = array.array("i")
+        # ディレクトリ i のファイルは files[file_starts[i]:file_starts[i + 1]]
+        self.file_starts = array.array("q", [0])
+        self.file_chars = array.array("q")  # ファイル名の文字数の合計（見積もり用）
+        self.files = []
+        self._stack = []  # 追加中の祖先ディレクトリの番号
+        self._ends = None
+        self._entry_counts = None
+
+    @classmethod
+    def from_walk(cls, walk_result, root_name):
+        """walk_directory_tree の結果から作る"""
+        tree = cls()
+        for depth, rel_dir, files in walk_result:
+            name = os.path.basename(rel_dir.rstrip("/")) if rel_dir else root_name
+            tree.append(depth, name, files)
+        return tree
+
+    @classmethod
+    def from_structure(cls, dir_structure):
+        """get_directory_structure の結果（辞書のリスト）から作る"""
+        tree = cls()
+        for dir_info in dir_structure:
+            tree.append(dir_info["depth"], dir_info["dirname"], dir_info["files"])
+        return tree
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, depth, name, files):
+        """深さ優先順で次のディレクトリを追加する"""
+        del self._stack[depth:]
+        self.parents.append(self._stack[-1] if self._stack else -1)
+        self._stack.append(len(self.names))
+        self.names.append(sys.intern(name))
+        self.depths.append(depth)
+        self.files.extend(map(sys.intern, files))
+        self.file_starts.append(len(self.files))
+        self.file_chars.append(sum(map(len, files)))
+        self._ends = self._entry_counts = None
+
+    def to_structure(self):
+        """get_directory_structure と同じ辞書のリストにする"""
+        return [
+            {
+                "depth": self.depths[i],
+                "dirname": self.names[i],
+                "files": self.dir_files(i),
+            }
+            for i in range(len(self))
+        ]
+
+    def dir_files(self, i, limit=None):
+        """ディレクトリ i のファイル名のリスト（limit を指定すると先頭の limit 件）"""
+        start, end = self.file_starts[i], self.file_starts[i + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return self.files[start:end]
+
+    def _index(self):
+        """部分木の終わりの番号と、部分木に含まれるエントリ数を計算する（1度だけ）"""
+        if self._ends is None:
+            count = len(self)
+            ends = array.array("i", [count]) * count
+            entry_counts = array.array("q", [0]) * count
+            starts = self.file_starts
+            for i in range(count - 1, -1, -1):
+                entry_counts[i] += starts[i + 1] - starts[i]
+                parent = self.parents[i]
+                if parent >= 0:
+                    entry_counts[parent] += 1 + entry_counts[i]
+            stack = []
+            for i, depth in enumerate(self.depths):
+                while stack and self.depths[stack[-1]] >= depth:
+                    ends[stack.pop()] = i
+                stack.append(i)
+            self._ends, self._entry_counts = ends, entry_counts
+        return self._ends, self._entry_counts
+
+    def find(self, rel_dir):
+        """ルートからの相対パス（"a/b"）のディレクトリの番号を返す（なければ None）"""
+        ends, _ = self._index()
+        i = 0
+        for part in rel_dir.replace(os.sep, "/").strip("/").split("/"):
+            if not part or part == ".":
+                continue
+            child = i + 1
+            while child < ends[i] and self.names[child] != part:
+                child = ends[child]
+            if child >= ends[i]:
+                return None
+            i = child
+        return i if len(self) else None
+
+    def write(
+        self, out, root_path, max_depth=None, max_files=None, start=0, header=True
+    ):
+        """
+        start のディレクトリ以下を1行ずつ out に書き込む。
+        max_depth より深いディレクトリは "name/ (+N more)" の1行にまとめ、
+        max_files を指定するとディレクトリごとのファイルを先頭の max_files 件にする。
+        header=False の場合は見出しを書かない（複数のルートを続けて書く場合）。
+        """
+        if header:
+            out.write("# ディレクトリ構造\n")
+        if not len(self):
+            return
+        ends, entry_counts = self._index()
+        base_depth = self.depths[start]
+        i = start
+        while i < ends[start]:
+            depth = self.depths[i] - base_depth
+            indent = " " * 4 * depth
+            if max_depth is not None and depth > max_depth:
+                line = f"{indent}{self.names[i]}/ (+{entry_counts[i]} more)\n"
+                out.write(sanitize_string(line))
+                i = ends[i]
+                continue
+            if i == start:
+                line = "{}/\n".format(root_path.rstrip(os.sep))  # フルパスを表示
+            else:
+                line = f"{indent}{self.names[i]}/\n"
+            sub_indent = " " * 4 * (depth + 1)
+            files = self.dir_files(i, max_files)
+            lines = [line] + [f"{sub_indent}{name}\n" for name in files]
+            hidden = self.file_starts[i + 1] - self.file_starts[i] - len(files)
+            if hidden:
+                lines.append(f"{sub_indent}... (+{hidden} more)\n")
+            out.write(sanitize_string("".join(lines)))
+            i += 1
+
+    def token_estimates(self, max_files=None, start=0):
+        """
+        max_depth = 0, 1, 2, ... で描画した場合のトークン数の見積もりをリストで返す
+        （最後の要素が省略なしの場合）。1行あたり「名前の文字数 / 4 + インデントと改行の分」。
+        """
+        if not len(self):
+            return []
+        ends, _ = self._index()
+        base_depth = self.depths[start]
+        full = []  # 深さごとの、ディレクトリ行とファイル行の合計
+        lines = []  # 深さごとの、ディレクトリ行だけの合計（まとめた場合）
+        for i in range(start, ends[start]):
+            depth = self.depths[i] - base_depth
+            while len(full) <= depth:
+                full.append(0)
+                lines.append(0)
+            count = self.file_starts[i + 1] - self.file_starts[i]
+            chars = self.file_chars[i]
+            extra = 0
+            if max_files is not None and count > max_files:
+                chars = chars * max_files // count
+                count = max_files
+                extra = 4  # "... (+N more)" の行
+            line = (len(self.names[i]) + 7) // 4
+            lines[depth] += line + 2
+            full[depth] += line + (chars + 7 * count) // 4 + extra
+        estimates = []
+        total = 0
+        for depth in range(len(full)):
+            total += full[depth]
+            collapsed = lines[depth + 1] if depth + 1 < len(lines) else 0
+            estimates.append(total + collapsed)
+        return estimates
+
+
+def build_directory_tree(
+    new_folder, ignore_patterns, max_workers=DEFAULT_WORKERS, cache=None
+):
+    """
+    ディレクトリ構造を走査して DirectoryTree を返す関数。
+    ignore_patterns にはパターンのリストか IgnoreMatcher を渡す。
+    """
+    if isinstance(ignore_patterns, IgnoreMatcher):
+        matcher = ignore_patterns
+    else:
+        matcher = IgnoreMatcher(ignore_patterns)
+    root_name = os.path.basename(new_folder.rstrip(os.sep))
+    return DirectoryTree.from_walk(
+        walk_directory_tree(new_folder, matcher, max_workers, cache), root_name
+    )
+
+
+def write_directory_structure(
+    out, dir_structure, new_folder, max_depth=None, max_files=None
+):
+    """
+    ディレクトリ構造を1行ずつ out に書き込む関数。
+    dir_structure には DirectoryTree か get_directory_structure の結果を渡す。
+    max_depth を指定すると、それより深いディレクトリは "name/ (+N more)" の1行にまとめる。
+    max_files を指定すると、ディレクトリごとのファイルを先頭の max_files 件にする。
+    """
+    if not isinstance(dir_structure, DirectoryTree):
+        dir_structure = DirectoryTree.from_structure(dir_structure)
+    dir_structure.write(out, new_folder, max_depth, max_files)
+
+
+def format_directory_structure(
+    dir_structure, new_folder, max_depth=None, max_files=None
+):
+    """ディレクトリ構造を文字列に整形する関数"""
+    buffer = io.StringIO()
+    write_directory_structure(buffer, dir_structure, new_folder, max_depth, max_files)
+    return buffer.getvalue()
+
+
+def estimate_tree_tokens(dir_structure):
+    """
+    ディレクトリ構造を max_depth = 0, 1, 2, ... で描画した場合のトークン数の見積もりを
+    リストで返す関数（最後の要素が省略なしの場合）。
+    """
+    if not isinstance(dir_structure, DirectoryTree):
+        dir_structure = DirectoryTree.from_structure(dir_structure)
+    return dir_structure.token_estimates()
+
+
+class TreeSection:
+    """
+    {directory_structure} に埋め込むディレクトリ構造を、書き込み時に描画するクラス。
+    start を指定すると、その番号のディレクトリ以下（部分木）だけを描画する。
+    """
+
+    def __init__(
+        self, dir_structure, new_folder, max_depth=None, max_files=None, start=0
+    ):
+        if not isinstance(dir_structure, DirectoryTree):
+            dir_structure = DirectoryTree.from_structure(dir_structure)
+        self.dir_structure = dir_structure
+        self.new_folder = new_folder
+        self.max_depth = max_depth
+        self.max_files = max_files
+        self.start = start
+        # apply_token_budget で設定される（None の場合は省略しない）
+        self.max_tokens = None
+        self.token_budget = None
+
+    def __bool__(self):
+        return True
+
+    def _token_estimates(self):
+        estimates = self.dir_structure.token_estimates(self.max_files, self.start)
+        if self.max_depth is not None:
+            estimates = estimates[: self.max_depth + 1]
+        return estimates
+
+    def estimate_tokens(self):
+        """省略なしで描画した場合のトークン数の見積もり"""
+        estimates = self._token_estimates()
+        return estimates[-1] if estimates else 0
+
+    def fingerprint(self):
+        """
+        描画結果のハッシュ（ツリーの走査結果は保持しているため、描画し直して比べる）。
+        描画した文字列は溜めずに、そのままハッシュに流し込む。
+        """
+        writer = _HashWriter()
+        self._write_tree(writer, self.max_depth)
+        return writer.hexdigest()
+
+    def write(self, out):
+        max_depth = self.max_depth
+        if self.max_tokens is not None:
+            estimates = self._token_estimates()
+            fitting = [
+                depth
+                for depth, tokens in enumerate(estimates)
+                if tokens <= self.max_tokens
+            ]
+            if not fitting:
+                print("警告: トークン数の上限のため、ディレクトリ構造を省略しました。")
+                out.write("# ディレクトリ構造\n(トークン数の上限のため省略)\n")
+                return
+            if fitting[-1] < len(estimates) - 1:
+                max_depth = fitting[-1]
+                print(
+                    "警告: トークン数の上限のため、"
+                    f"ディレクトリ構造を深さ{max_depth}までに省略しました。"
+                )
+            if self.token_budget is not None:
+                self.token_budget.consume(estimates[fitting[-1]])
+        with _profiler.stage("tree_render"):
+            self._write_tree(out, max_depth)
+
+    def _write_tree(self, out, max_depth):
+        self.dir_structure.write(
+            out, self.new_folder, max_depth, self.max_files, self.start
+        )
+
+
+class MultiTreeSection(TreeSection):
+    """
+    フォルダの対応ごとのルート（TreeSection のリスト）を、1つの {directory_structure} として
+    見出しの下に続けて描画するクラス。深さ・ファイル数・トークン数の上限は全ルートに共通で適用する。
+    """
+
+    def __init__(self, sections, max_depth=None, max_files=None):
+        self.sections = list(sections)
+        self.max_depth = max_depth
+        self.max_files = max_files
+        self.max_tokens = None
+        self.token_budget = None
+
+    def _token_estimates(self):
+        # 深さごとの見積もりをルート間で合計する（浅いルートは最後の値のまま）
+        per_root = [
+            section.dir_structure.token_estimates(self.max_files, section.start)
+            for section in self.sections
+        ]
+        per_root = [estimates for estimates in per_root if estimates]
+        depth = max((len(estimates) for estimates in per_root), default=0)
+        if self.max_depth is not None:
+            depth = min(depth, self.max_depth + 1)
+        return [
+            sum(estimates[min(d, len(estimates) - 1)] for estimates in per_root)
+            for d in range(depth)
+        ]
+
+    def _write_tree(self, out, max_depth):
+        out.write("# ディレクトリ構造\n")
+        for section in self.sections:
+            section.dir_structure.write(
+                out,
+                section.new_folder,
+                max_depth,
+                self.max_files,
+                section.start,
+                header=False,
+            )
+
+
+def load_ignore_patterns(include_ignore=False):
+    """カレントディレクトリの .gitignore と .dirignore から除外パターンを読み込む関数"""
+    ignore_patterns = []
+    if not include_ignore:
+        for ignore_file in (".gitignore", ".dirignore"):
+            if os.path.exists(ignore_file):
+                with open(ignore_file, "r") as f:
+                    ignore_patterns += [
+                        line.strip()
+                        for line in f.readlines()
+                        if line.strip() and not line.startswith("#")
+                    ]
+    return [".git/", "agent_simple/"] + ignore_patterns
+
+
+def build_ignore_matcher(include_ignore=False):
+    """load_ignore_patterns のパターンと、サブディレクトリの .gitignore を使う IgnoreMatcher を作る"""
+    return IgnoreMatcher(
+        load_ignore_patterns(include_ignore), load_nested=not include_ignore
+    )
+
+
+def list_directory_section(
+    work_directory: str,
+    folder_mapping=("src", "/var/www"),
+    include_ignore=False,
+    workers=DEFAULT_WORKERS,
+    use_cache=False,
+    cache=None,
+    max_depth=None,
+    max_files=None,
+):
+    """
+    ディレクトリ構造を走査して TreeSection を返す関数（描画は書き込み時に行う）。
+    走査中のエラーはエラーメッセージの文字列として返す。
+    use_cache=True の場合は agent_simple/.cache の走査キャッシュを読み書きする。
+    cache に DirectoryCache を渡すと、それを使って走査する（繰り返し走査する場合に使う）。
+    max_depth / max_files は描画する深さとディレクトリごとのファイル数の上限。
+    work_directory に複数のディレクトリ（タプル）を渡すと、ルートごとに並行に走査して
+    （走査キャッシュもルートごと）MultiTreeSection にまとめる。
+    """
+    if not isinstance(work_directory, str):
+        with ThreadPoolExecutor(max_workers=max(len(work_directory), 1)) as executor:
+            sections = list(
+                executor.map(
+                    lambda directory: list_directory_section(
+                        directory,
+                        folder_mapping,
+                        include_ignore,
+                        workers,
+                        use_cache,
+                        max_depth=max_depth,
+                        max_files=max_files,
+                    ),
+                    work_directory,
+                )
+            )
+        errors = [section for section in sections if isinstance(section, str)]
+        if errors:
+            return "\n".join(errors)
+        return MultiTreeSection(sections, max_depth, max_files)
+    new_folder = map_folder(work_directory, folder_mapping)[0]
+    if not os.path.exists(new_folder):
+        raise FileNotFoundError(
+            f"'{new_folder}' does not exist. You should input full path."
+        )
+    try:
+        matcher = build_ignore_matcher(include_ignore)
+        if cache is None and use_cache:
+            cache = DirectoryCache.load(new_folder)
+        tree = build_directory_tree(new_folder, matcher, workers, cache)
+        if cache is not None:
+            _profiler.count("directory_cache_hits", cache.hits)
+            _profiler.count("directory_cache_misses", cache.misses)
+            try:
+                cache.save()
+            except OSError as e:
+                warnings.warn(f"Failed to save directory cache: {e}", UserWarning)
+        return TreeSection(tree, new_folder, max_depth, max_files)
+    except Exception as e:
+        return f"An error occurred: {e}"
+
+
+def list_directory_structure(
+    work_directory: str,
+    folder_mapping=("src", "/var/www"),
+    include_ignore=False,
+    workers=DEFAULT_WORKERS,
+    use_cache=False,
+) -> str:
+    """ディレクトリ構造をツリー形式で出力（.ignoreに準拠)"""
+    section = list_directory_section(
+        work_directory, folder_mapping, include_ignore, workers, use_cache
+    )
+    if isinstance(section, str):
+        return section
+    buffer = io.StringIO()
+    section.write(buffer)
+    return buffer.getvalue()
+
+
+_GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_glob_segment(segment):
+    """パスの1要素分のワイルドカードを正規表現にコンパイルする関数"""
+    return re.compile(fnmatch.translate(segment))
+
+
+def expand_file_specs(file_specs, root=None, matcher=None):
+    """
+    複数のファイルスペック（ファイル・ディレクトリ・ワイルドカード）をまとめて展開する関数。
+    ディレクトリの読み込みはスペック間で共有し、同じディレクトリを2度読まない。
+    ワイルドカードの ** は0個以上のディレクトリに一致する（隠しファイルは glob と同様に除く）。
+    matcher を渡すと、root からの相対パスで除外対象を取り除く（明示したファイルは除外しない）。
+    ワイルドカードの起点ディレクトリが除外対象なら、** で辿った場合と同じく何も返さない。
+    スペックごとのファイルリストを指定順に返す。先のスペックで見つかったファイルは
+    後のスペックからは取り除き、何にも一致しなかったスペックは None になる。
+    """
+    root = os.path.abspath(root) if root and matcher is not None else None
+    listings = {}
+    loaded = set()
+
+    def relative(abs_dir):
+        # root の外側は除外判定の対象にしない
+        if root is None:
+            return None
+        rel = os.path.relpath(abs_dir, root).replace(os.sep, "/")
+        if rel == ".":
+            return ""
+        if rel == ".." or rel.startswith("../"):
+            return None
+        return rel + "/"
+
+    def load_parent_ignores(rel_dir):
+        # 走査を途中のディレクトリから始めるため、上位の .gitignore を先に読み込む
+        parts = rel_dir.split("/")[:-1]
+        for i in range(len(parts)):
+            base = "".join(p + "/" for p in parts[:i])
+            if base not in loaded:
+                loaded.add(base)
+                gitignore_path = os.path.join(root, base, ".gitignore")
+                if os.path.isfile(gitignore_path):
+                    matcher.add_ignore_file(base, gitignore_path)
+
+    def ignored_dir(path):
+        rel_dir = relative(os.path.abspath(path or os.curdir))
+        if not rel_dir:
+            return False
+        if matcher.load_nested:
+            load_parent_ignores(rel_dir)
+        return matcher.is_ignored(rel_dir[:-1], is_dir=True)
+
+    def listing(path):
+        abs_dir = os.path.abspath(path or os.curdir)
+        result = listings.get(abs_dir)
+        if result is not None:
+            return result
+        rel_dir = relative(abs_dir)
+        if rel_dir is None:
+            result = _list_directory(abs_dir)
+        else:
+            if matcher.load_nested:
+                load_parent_ignores(rel_dir)
+                loaded.add(rel_dir)
+            files, dirs, _ = _scan_directory(abs_dir, rel_dir, matcher)
+            result = (files, dirs)
+        listings[abs_dir] = result
+        return result
+
+    def match(base, segments):
+        """base 以下で segments（パスの要素のリスト）に一致するファイルを名前順に返す"""
+        segment, rest = segments[0], segments[1:]
+        files, dirs = listing(base)
+        if segment == "**":
+            if rest:
+                yield from match(base, rest)
+            else:
+                yield from (os.path.join(base, f) for f in files if f[0] != ".")
+            for d in dirs:
+                if d[0] != ".":
+                    yield from match(os.path.join(base, d), segments)
+            return
+        names = dirs if rest else files
+        if _GLOB_MAGIC.search(segment):
+            pattern = _compile_glob_segment(segment)
+            hidden = segment[0] == "."
+            names = [n for n in names if (hidden or n[0] != ".") and pattern.match(n)]
+        else:
+            names = [segment] if segment in names else []
+        for name in names:
+            path = os.path.join(base, name)
+            if rest:
+                yield from match(path, rest)
+            else:
+                yield path
+
+    seen = set()
+    results = []
+    for file_spec in file_specs:
+        if os.path.isdir(file_spec):
+            files = [os.path.join(file_spec, f) for f in listing(file_spec)[0]]
+        elif os.path.isfile(file_spec):
+            files = [file_spec]
+        elif _GLOB_MAGIC.search(file_spec):
+            parts = file_spec.replace(os.sep, "/").split("/")
+            i = next(i for i, p in enumerate(parts) if _GLOB_MAGIC.search(p))
+            base = "/".join(parts[:i]) or ("/" if file_spec.startswith("/") else "")
+            segments = [p for p in parts[i:] if p]
+            if not os.path.isdir(base or ".") or ignored_dir(base):
+                files = []
+            else:
+                files = list(match(base, segments))
+        else:
+            files = []
+        if not files:
+            results.append(None)
+            continue
+        unique = []
+        for f in files:
+            key = os.path.abspath(f)
+            if key not in seen:
+                seen.add(key)
+                unique.append(f)
+        results.append(unique)
+    return results
+
+
+def expand_mapped_specs(adjusted_specs, mapped, matcher=None):
+    """
+    ルート（map_folder の new_folder）ごとにスペックをまとめて expand_file_specs で展開する関数。
+    .gitignore はルートごとに読み込むため、各ルートには展開を始める前に作った
+    matcher の複製を使う（他のルートの規則を引き継がない）。
+    ルートをまたいで重複したファイルも最初の1つだけ残す。
+    """
+    roots = list(dict.fromkeys(root for _, root in mapped))
+    if len(roots) <= 1:
+        return expand_file_specs(
+            adjusted_specs, root=roots[0] if roots else None, matcher=matcher
+        )
+    expanded = [None] * len(adjusted_specs)
+    root_matchers = [None if matcher is None else matcher.copy() for _ in roots]
+    for root, root_matcher in zip(roots, root_matchers):
+        indices = [i for i, (_, r) in enumerate(mapped) if r == root]
+        results = expand_file_specs(
+            [adjusted_specs[i] for i in indices], root=root, matcher=root_matcher
+        )
+        for i, files in zip(indices, results):
+            expanded[i] = files
+    seen = set()
+    for i, files in enumerate(expanded):
+        if files is None:
+            continue
+        unique = []
+        for f in files:
+            key = os.path.abspath(f)
+            if key not in seen:
+                seen.add(key)
+                unique.append(f)
+        expanded[i] = unique or None
+    return expanded
+
+
+def get_files_from_spec(file_spec):
+    """ファイルスペックからファイルリストを取得する関数"""
+    return expand_file_specs([file_spec])[0] or []
+
+
+def iter_file_contents(files, workers=DEFAULT_WORKERS, max_bytes=None, reader=None):
+    """
+    files を先頭から順に読み込み、(パス, 内容) を返すジェネレータ。
+    workers > 1 の場合はスレッドプールで先読みするが、先読みは workers * 2 件までに抑える。
+    reader には read_file と同じ引数を取る関数（キャッシュ付きの読み込みなど）を渡せる。
+    """
+    reader = reader or read_file
+    if workers <= 1 or len(files) <= 1:
+        for f in files:
+            yield f, reader(f, max_bytes)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(files)
+        pending = collections.deque(
+            (f, executor.submit(reader, f, max_bytes))
+            for f in itertools.islice(remaining, workers * 2)
+        )
+        while pending:
+            f, future = pending.popleft()
+            for next_file in itertools.islice(remaining, 1):
+                pending.append(
+                    (next_file, executor.submit(reader, next_file, max_bytes))
+                )
+            yield f, future.result()
+
+
+def _utf8_size(text):
+    """text の UTF-8 でのバイト数を返す（ASCII のみの場合はエンコードを省く）"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-8"))
+
+
+class CodeSection:
+    """
+    {code} に埋め込むファイル群を表すクラス。
+    ファイルの特定は生成時に行い、内容は書き込み時に読み込んで1ファイルずつ出力する。
+    max_file_bytes / max_total_bytes で1ファイルと合計の読み込み量を制限する（None で無制限）。
+    matcher（IgnoreMatcher）を渡すと、ディレクトリ・ワイルドカードの展開で除外対象を取り除く。
+    folder_mapping には複数の対応を渡せる（スペックはそれぞれのルートで展開する）。
+    """
+
+    def __init__(
+        self,
+        file_list,
+        folder_mapping=("src", "/var/www"),
+        workers=1,
+        max_file_bytes=None,
+        max_total_bytes=None,
+        reader=None,
+        matcher=None,
+    ):
+        self.workers = workers
+        self.reader = reader
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.files = []
+        self.omitted_files = []
+        # apply_token_budget で設定される（None の場合はトークン数で制限しない）
+        self.token_budget = None
+        # 見つからなかったスペックを (直前までに見つかったファイル数, スペック) で記録する
+        self._missing_specs = []
+        file_list = list(file_list or [])
+        # 置き換え前のスペック（--refresh のマニフェストに記録する）
+        self.specs = file_list
+        mapped = [map_folder(file_spec, folder_mapping) for file_spec in file_list]
+        adjusted_specs = [adjusted for adjusted, _ in mapped]
+        # すべてのスペックを1度に展開する（重複したファイルは最初の1つだけ残る）
+        with _profiler.stage("expand_specs"):
+            expanded = expand_mapped_specs(adjusted_specs, mapped, matcher)
+        for file_spec, adjusted_file_spec, files in zip(
+            file_list, adjusted_specs, expanded
+        ):
+            if files is None:
+                print(f"警告: '{file_spec}'に該当するファイルが見つかりませんでした。")
+                self._missing_specs.append((len(self.files), adjusted_file_spec))
+                continue
+            self.files.extend(files)
+        self.not_found_files = [spec for _, spec in self._missing_specs]
+
+    def __bool__(self):
+        return bool(self.files)
+
+    def fingerprint(self):
+        """
+        ファイルの一覧・各ファイルのサイズと mtime・上限から作る指紋。
+        ファイルを読み込まずに、前回の出力から内容が変わったかを判定するために使う。
+        mtime が現在時刻に近いファイルは、同じ時刻のうちに再度変更されうるため常に変更扱いにする。
+        """
+        digest = hashlib.sha1(
+            repr(
+                (self.max_file_bytes, self.max_total_bytes, self.not_found_files)
+            ).encode("utf-8", "surrogateescape")
+        )
+        now = time.time_ns()
+        for f in self.files:
+            try:
+                st = os.stat(f)
+                stamp = (st.st_size, st.st_mtime_ns)
+                if now - st.st_mtime_ns < DirectoryCache.RACY_NS:
+                    stamp = ("racy", now)
+            except OSError:
+                stamp = None
+            digest.update(f"{f}\0{stamp}\n".encode("utf-8", "surrogateescape"))
+        return digest.hexdigest()
+
+    def estimate_tokens(self):
+        """ファイルサイズから見積もった、全ファイルを出力した場合のトークン数"""
+        total = 0
+        for f in self.files:
+            try:
+                size = os.path.getsize(f)
+            except OSError:
+                continue
+            if self.max_file_bytes:
+                size = min(size, self.max_file_bytes)
+            total += size
+        if self.max_total_bytes:
+            total = min(total, self.max_total_bytes)
+        return total // 4 + 16 * len(self.files)
+
+    def write(self, out):
+        # not_found_files はスペックの指定順に並ぶよう、読み込み失敗と合わせて作り直す
+        not_found_files = []
+        self.omitted_files = []
+        omit_reason = ""
+        missing = collections.deque(self._missing_specs)
+        remaining = self.max_total_bytes
+        budget = self.token_budget
+        contents = iter_file_contents(
+            self.files, self.workers, self.max_file_bytes, self.reader
+        )
+        for i, (f, code) in enumerate(contents):
+            while missing and missing[0][0] <= i:
+                not_found_files.append(missing.popleft()[1])
+            if code is None:
+                not_found_files.append(f)
+                continue
+            if remaining is not None:
+                if remaining <= 0:
+                    # 合計の上限に達したら残りのファイルは読み込まない
+                    self.omitted_files = self.files[i:]
+                    omit_reason = "合計サイズの上限"
+                    contents.close()
+                    break
+                size = _utf8_size(code)
+                if size > remaining:
+                    code = _decode_excerpt(code.encode("utf-8"), remaining)[0]
+                remaining -= size
+            if budget is not None:
+                title_tokens = 16
+                if budget.remaining < MIN_EXCERPT_TOKENS + title_tokens:
+                    self.omitted_files = self.files[i:]
+                    omit_reason = "トークン数の上限"
+                    contents.close()
+                    break
+                tokens = estimate_tokens(code)
+                available = budget.remaining - title_tokens
+                if tokens > available:
+                    # 入りきらないファイルは、残りのトークン数に収まる抜粋にする
+                    # （中略の注記の分を差し引いて切り出す）
+                    data = code.encode("utf-8")
+                    limit = len(data) * (available - 16) // tokens
+                    code = _decode_excerpt(data, limit)[0]
+                    tokens = estimate_tokens(code)
+                budget.consume(tokens + title_tokens)
+            write_markdown_block(out, title=f"File {os.path.basename(f)}", code=code)
+        not_found_files.extend(spec for _, spec in missing)
+        self.not_found_files = not_found_files
+        if self.omitted_files:
+            print(
+                f"警告: {omit_reason}に達したため、{len(self.omitted_files)}"
+                "個のファイルを省略しました。"
+            )
+            write_markdown_block(
+                out,
+                title=f"省略したファイル（{omit_reason}を超えたため）",
+                code="\n".join(self.omitted_files),
+            )
+
+
+def read_code_as_markdown(
+    file_list: list,
+    folder_mapping=("src", "/var/www"),
+    workers=1,
+    max_file_bytes=None,
+    max_total_bytes=None,
+):
+    """
+    コードをMarkdown形式で読み込む関数。
+    workers > 1 の場合は複数ファイルを並行して読み込む（出力順は指定順のまま）。
+    """
+    if not file_list:
+        return ""
+    buffer = io.StringIO()
+    CodeSection(
+        file_list, folder_mapping, workers, max_file_bytes, max_total_bytes
+    ).write(buffer)
+    return buffer.getvalue()
+
+
+def _is_binary(head):
+    """ファイル先頭のバイト列から、バイナリファイルかどうかを判定する関数"""
+    return head.startswith(_BINARY_SIGNATURES) or b"\0" in head
+
+
+def _char_boundary(data, pos):
+    """pos が UTF-8 の文字の途中であれば、その文字の先頭位置まで戻した位置を返す関数"""
+    while 0 < pos < len(data) and data[pos] & 0xC0 == 0x80:
+        pos -= 1
+    return pos
+
+
+def _decode_excerpt(data, max_bytes):
+    """
+    data（bytes または mmap）が max_bytes を超える場合は先頭と末尾だけを残して
+    デコードする関数。区切りはなるべく改行位置に合わせ、文字の途中では切らない。
+    (テキスト, 取り除いた不正なバイト範囲) を返す。
+    """
+    size = len(data)
+    if not max_bytes or size <= max_bytes:
+        return decode_utf8(data)
+    half = max_bytes // 2
+    head_end = data.rfind(b"\n", 0, half)
+    if head_end < half // 2:
+        head_end = _char_boundary(data, half)
+    tail_start = data.find(b"\n", size - half)
+    if tail_start < 0 or tail_start > size - half // 2:
+        tail_start = _char_boundary(data, size - half)
+    head, head_dropped = decode_utf8(data[:head_end])
+    tail, tail_dropped = decode_utf8(data[tail_start:])
+    dropped = head_dropped + [(s + tail_start, e + tail_start) for s, e in tail_dropped]
+    text = (
+        head
+        + f"\n... (中略: {tail_start - head_end} bytes) ...\n"
+        + tail.lstrip("\n")
+    )
+    return text, dropped
+
+
+class _HeadTailBuffer:
+    """
+    mmap できない大きなファイルの先頭と末尾だけを保持し、元のファイルと同じ位置で
+    参照できるようにするクラス（_decode_excerpt が使う操作だけに対応する）。
+    """
+
+    def __init__(self, head, tail, size):
+        self.head = head
+        self.tail = tail
+        self.size = size
+        self.tail_start = size - len(tail)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(self.size)
+            if stop <= len(self.head):
+                return self.head[start:stop]
+            if start >= self.tail_start:
+                return self.tail[start - self.tail_start : stop - self.tail_start]
+            raise IndexError("range spans the unread middle of the file")
+        if key < 0:
+            key += self.size
+        if key < len(self.head):
+            return self.head[key]
+        if key >= self.tail_start:
+            return self.tail[key - self.tail_start]
+        return 0  # 読み込んでいない部分は文字の先頭として扱う
+
+    def find(self, sub, start=0, end=None):
+        end = self.size if end is None else end
+        if start < self.tail_start:
+            raise IndexError("range spans the unread middle of the file")
+        pos = self.tail.find(sub, start - self.tail_start, end - self.tail_start)
+        return pos + self.tail_start if pos >= 0 else -1
+
+    def rfind(self, sub, start=0, end=None):
+        end = self.size if end is None else end
+        if end > len(self.head):
+            raise IndexError("range spans the unread middle of the file")
+        return self.head.rfind(sub, start, end)
+
+
+def _read_unmapped(file, size, max_bytes):
+    """
+    mmap できないファイルを読み込む関数。max_bytes を超える場合は先頭と末尾だけを読み、
+    _HeadTailBuffer にする（抜粋の末尾がファイルの本当の末尾になるように）。
+    """
+    if not max_bytes or size <= max_bytes:
+        # 空ファイルや、サイズが 0 と報告される特殊なファイルは先頭から読む
+        return file.read(max_bytes + 1 if max_bytes else -1)
+    half = max_bytes // 2
+    # 区切りを文字の先頭に合わせるため、前後に数バイト余分に読む
+    head_bytes = max(half + 1, BINARY_SNIFF_BYTES)
+    tail_bytes = half + 4
+    if head_bytes + tail_bytes >= size:
+        return file.read()
+    head = file.read(head_bytes)
+    file.seek(size - tail_bytes)
+    return _HeadTailBuffer(head, file.read(tail_bytes), size)
+
+
+def read_file(file_path, max_bytes=None):
+    """
+    ファイルを読み込む関数。
+    mmap で先頭だけを見てバイナリを判定し、バイナリの場合は内容の代わりに注記を返す。
+    max_bytes を超えるファイルは先頭と末尾の抜粋にする。
+    UTF-8 として不正なバイトは取り除き、その位置を警告する（返すテキストは検査済み）。
+    """
+    with _profiler.stage("read"):
+        return _read_file(file_path, max_bytes)
+
+
+def _read_file(file_path, max_bytes):
+    """read_file の本体"""
+    try:
+        with open(file_path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            _profiler.count("files_read")
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # 空ファイルや mmap できないファイルは通常の読み込みにする
+                data = _read_unmapped(file, size, max_bytes)
+                size = len(data)
+            try:
+                if _is_binary(data[:BINARY_SNIFF_BYTES]):
+                    print(f"警告: '{file_path}'はバイナリファイルのため内容を省略します。")
+                    return f"(バイナリファイルのため省略: {size} bytes)"
+                text, dropped = _decode_excerpt(data, max_bytes)
+                _profiler.count("bytes_read", min(size, max_bytes or size))
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+    except FileNotFoundError as e:
+        print(f"ファイル'{file_path}'の読み込み中にエラーが発生しました: {e}")
+        return None
+    if dropped:
+        warnings.warn(
+            f"Some bytes in '{file_path}' were removed due to decode errors "
+            f"(byte offsets: {_format_offsets(dropped)}).",
+            UserWarning,
+        )
+    return text
+
+
+class FileCache:
+    """
+    読み込んだファイル内容のキャッシュ。(パス, サイズ, mtime_ns) が同じ間は、
+    デコード済みのテキストを再利用する。メモリ上は合計サイズで LRU 破棄し、
+    cache_dir を指定するとパスごとに1ファイルでディスクにも保存する。
+    read は read_file と同じ引数・戻り値なので、CodeSection の reader に渡せる。
+    """
+
+    # 保存直前に更新されたファイルは、同じサイズ・mtime のまま再度更新される可能性があるため保存しない
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, max_bytes=DEFAULT_FILE_CACHE_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = collections.OrderedDict()  # キー -> テキスト
+        self._size = 0
+        self._lock = threading.Lock()
+        self._pending = {}  # 読み込み中のキー -> ロック（同じファイルの同時読み込みを1回にする）
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def read(self, file_path, max_bytes=None):
+        """キャッシュを使ってファイルを読み込む（read_file と同じ戻り値）"""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return read_file(file_path, max_bytes)
+        abs_path = os.path.abspath(file_path)
+        stamp = [st.st_size, st.st_mtime_ns, max_bytes or 0]
+        key = (abs_path, *stamp)
+        with self._lock:
+            text = self._lookup(key)
+            if text is not None:
+                return text
+            pending = self._pending.setdefault(key, threading.Lock())
+        with pending:
+            with self._lock:
+                text = self._lookup(key)
+            if text is not None:
+                return text
+            try:
+                text = self._load(abs_path, stamp)
+                if text is not None:
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+                    text = read_file(file_path, max_bytes)
+                    if text is None:
+                        return None
+                    if time.time_ns() - st.st_mtime_ns < self.RACY_NS:
+                        return text
+                    self._save(abs_path, stamp, text)
+                self._store(key, text)
+                return text
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+
+    def _lookup(self, key):
+        """メモリ上のキャッシュを引く（self._lock を取得した状態で呼ぶ）"""
+        text = self._entries.get(key)
+        if text is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return text
+
+    def _store(self, key, text):
+        size = sys.getsizeof(text)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = text
+            self._size += size
+            while self._size > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._size -= sys.getsizeof(old)
+
+    def _disk_path(self, abs_path):
+        digest = hashlib.sha1(abs_path.encode("utf-8", errors="ignore")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".txt")
+
+    def _load(self, abs_path, stamp):
+        """ディスクから読み込む。1行目の (サイズ, mtime_ns, 上限) が一致する場合のみ使う"""
+        if self.cache_dir is None:
+            return None
+        try:
+            # newline="" で、CRLF や CR を read_file の結果のまま読み書きする
+            path = self._disk_path(abs_path)
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                if json.loads(f.readline()) != stamp:
+                    return None
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, abs_path, stamp, text):
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(abs_path)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(
+                tmp_path, "w", encoding="utf-8", errors="ignore", newline=""
+            ) as f:
+                f.write(json.dumps(stamp) + "\n")
+                f.write(text)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            warnings.warn(f"Failed to save file cache: {e}", UserWarning)
+
+
+# トレースバックの1フレーム（Python: File "x.py", line 3 / PHP: x.php(3), x.php:3, x.php on line 3）
+_TRACEBACK_FRAME_PATTERN = re.compile(
+    r'File "(?P<py>[^"]+)", line (?P<py_line>\d+)'
+    r"|(?P<php>[^\s:()\"'#]+\.php)(?:\((?P<paren>\d+)\)|:(?P<colon>\d+)"
+    r"| on line (?P<on>\d+))"
+)
+# ライブラリのフレームとみなすディレクトリ
+_LIBRARY_DIRS = frozenset(["vendor", "site-packages", "dist-packages", "node_modules"])
+# 行の位置を探すときに、改行をまとめて数える単位（バイト）
+LINE_SCAN_CHUNK = 1024 * 1024
+
+
+def parse_traceback(text):
+    """エラー文に含まれるトレースバックから (ファイルパス, 行番号) を出現順に重複なく返す関数"""
+    frames = []
+    for match in _TRACEBACK_FRAME_PATTERN.finditer(text):
+        path = match.group("py") or match.group("php")
+        line = next(g for g in match.group("py_line", "paren", "colon", "on") if g)
+        frames.append((path, int(line)))
+    return list(dict.fromkeys(frames))
+
+
+def resolve_traceback_frames(frames, folder_mapping=("src", "/var/www")):
+    """
+    トレースバックのパスを replace_top_folder で変換し、new_folder 以下に存在する
+    プロジェクトのファイルのフレームだけを返す関数。
+    コンテナ内のパスなどで見つからない場合は、new_folder からの末尾部分で照合する。
+    フォルダの対応が複数ある場合は、先頭のフォルダが一致する対応から順に探す。
+    """
+    resolved = []
+    for path, line in frames:
+        top = path.replace("\\", "/").strip("/").split("/")[0]
+        mappings = sorted(folder_mappings(folder_mapping), key=lambda m: m[0] != top)
+        for old_folder, new_folder in mappings:
+            candidate = _resolve_frame_path(path, old_folder, new_folder)
+            if candidate is not None:
+                resolved.append((candidate, line))
+                break
+    return resolved
+
+
+def _resolve_frame_path(path, old_folder, new_folder):
+    """
+    トレースバックのパスを new_folder 以下のファイルに対応づける（なければ None）。
+    ライブラリのパスは対応づけず、末尾での照合はファイル名と親ディレクトリの
+    2要素以上が一致する場合だけにする（同名のプロジェクトのファイルと取り違えないため）。
+    """
+    parts = path.replace("\\", "/").strip("/").split("/")
+    if _LIBRARY_DIRS.intersection(parts):
+        return None
+    root = os.path.abspath(new_folder)
+    candidate = replace_top_folder(path, old_folder, new_folder)
+    if not os.path.isabs(candidate):
+        candidate = os.path.join(root, candidate)
+    if not os.path.isfile(candidate):
+        candidates = (
+            os.path.join(root, *parts[i:]) for i in range(1, len(parts) - 1)
+        )
+        candidate = next((c for c in candidates if os.path.isfile(c)), None)
+        if candidate is None:
+            return None
+    candidate = os.path.abspath(candidate)
+    # ルート内のシンボリックリンクが外側を指す場合も対応づけない
+    real_root = os.path.realpath(root)
+    rel_parts = os.path.relpath(os.path.realpath(candidate), real_root).split(os.sep)
+    if rel_parts[0] == os.pardir or _LIBRARY_DIRS.intersection(rel_parts):
+        return None
+    return candidate
+
+
+def _find_line_starts(data, line_numbers):
+    """
+    data（bytes または mmap）の中で、各行番号（1始まり）の行頭のバイト位置を返す関数。
+    改行はチャンクごとにまとめて数えるため、行を1つずつ辿るのは目的のチャンク内だけになる。
+    ファイルの行数を超える行番号は結果に含まれない。
+    """
+    starts = {}
+    size = len(data)
+    line = 1
+    pos = 0
+    for target in sorted(set(line_numbers)):
+        while line < target:
+            chunk_end = min(pos + LINE_SCAN_CHUNK, size)
+            count = data[pos:chunk_end].count(b"\n")
+            if line + count < target and chunk_end < size:
+                line += count
+                pos = chunk_end
+                continue
+            newline = data.find(b"\n", pos)
+            if newline < 0:
+                return starts
+            pos = newline + 1
+            line += 1
+        if pos > size or (pos == size and target > 1):
+            return starts
+        starts[target] = pos
+    return starts
+
+
+def _merge_line_windows(lines, context):
+    """対象の行の前後 context 行を、重なりをまとめた (開始行, 終了行) のリストにする関数"""
+    windows = []
+    for line in sorted(set(lines)):
+        start, end = max(line - context, 1), line + context
+        if windows and start <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def read_line_excerpts(file_path, lines, context=5):
+    """
+    ファイルのうち、lines の各行の前後 context 行だけを行番号付きで読み込む関数。
+    mmap 上で行の位置だけを探し、必要な範囲だけをデコードする。対象の行には > を付ける。
+    行がすべてファイルの末尾より後ろにある場合は、空の抜粋の代わりに1行の注記を返す。
+    """
+    windows = _merge_line_windows(lines, context)
+    targets = set(lines)
+    try:
+        with open(file_path, "rb") as file:
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                data = file.read()
+            try:
+                if _is_binary(data[:BINARY_SNIFF_BYTES]):
+                    return None
+                bounds = [line for start, end in windows for line in (start, end + 1)]
+                starts = _find_line_starts(data, bounds)
+                excerpts = []
+                for start, end in windows:
+                    if start not in starts:
+                        break
+                    chunk = data[starts[start] : starts.get(end + 1, len(data))]
+                    excerpt = decode_utf8(chunk)[0].splitlines()
+                    if excerpt:
+                        excerpts.append((start, excerpt))
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+    except OSError as e:
+        print(f"ファイル'{file_path}'の読み込み中にエラーが発生しました: {e}")
+        return None
+    if not excerpts:
+        numbers = ", ".join(str(n) for n in sorted(targets))
+        return f"（{numbers} 行目はファイルの範囲外です）"
+    width = len(str(windows[-1][1])) if windows else 1
+    blocks = []
+    for start, excerpt in excerpts:
+        blocks.append(
+            "\n".join(
+                f"{'>' if n in targets else ' '} {n:>{width}} | {text}"
+                for n, text in enumerate(excerpt, start)
+            )
+        )
+    return "\n...\n".join(blocks)
+
+
+class TracebackSection(CodeSection):
+    """
+    {error} のトレースバックが指すファイルのうち、該当する行の前後だけを添付する {code}。
+    ファイル全体は読み込まず、出力方法や上限の扱いは CodeSection と同じ。
+    """
+
+    def __init__(
+        self,
+        frames,
+        folder_mapping=("src", "/var/www"),
+        context_lines=5,
+        workers=1,
+        max_file_bytes=None,
+        max_total_bytes=None,
+    ):
+        self.context_lines = context_lines
+        # ファイルごとの対象行（ファイルはトレースバックに現れた順）
+        self.lines = {}
+        for path, line in frames:
+            self.lines.setdefault(path, []).append(line)
+        super().__init__(
+            list(self.lines),
+            folder_mapping=folder_mapping,
+            workers=workers,
+            max_file_bytes=max_file_bytes,
+            max_total_bytes=max_total_bytes,
+            reader=self._read_excerpt,
+        )
+
+    def _read_excerpt(self, file_path, max_bytes=None):
+        with _profiler.stage("read_excerpt"):
+            text = read_line_excerpts(
+                file_path, self.lines[file_path], self.context_lines
+            )
+        if text is not None and max_bytes and _utf8_size(text) > max_bytes:
+            text = _decode_excerpt(text.encode("utf-8"), max_bytes)[0]
+        return text
+
+    def fingerprint(self):
+        """CodeSection の指紋に、抜粋する行と前後の行数を加えたもの"""
+        lines = repr((self.context_lines, sorted(self.lines.items())))
+        return hashlib.sha1(
+            (super().fingerprint() + lines).encode("utf-8", "surrogateescape")
+        ).hexdigest()
+
+    def estimate_tokens(self):
+        """抜粋の行数から見積もったトークン数（1行あたり約12トークンとする）"""
+        total = 0
+        for lines in self.lines.values():
+            windows = _merge_line_windows(lines, self.context_lines)
+            total += sum(end - start + 1 for start, end in windows) * 12 + 16
+        return total
+
+
+def traceback_section(
+    error_text,
+    folder_mapping=("src", "/var/www"),
+    context_lines=5,
+    workers=1,
+    max_file_bytes=None,
+    max_total_bytes=None,
+):
+    """エラー文のトレースバックから TracebackSection を作る（該当するフレームがなければ None）"""
+    frames = resolve_traceback_frames(parse_traceback(error_text), folder_mapping)
+    if not frames:
+        return None
+    return TracebackSection(
+        frames,
+        folder_mapping=folder_mapping,
+        context_lines=context_lines,
+        workers=workers,
+        max_file_bytes=max_file_bytes,
+        max_total_bytes=max_total_bytes,
+    )
+
+
+def write_markdown_block(out, title, code):
+    """Markdownブロックを out に書き込む関数"""
+    out.write(f"\n## {title}\n```\n")
+    out.write(code)
+    out.write("\n```")
+
+
+def add_markdown_block(markdown_content, title, code):
+    """Markdownブロックを追加する関数"""
+    buffer = io.StringIO()
+    write_markdown_block(buffer, title, code)
+    return markdown_content + buffer.getvalue()
+
+
+def estimate_tokens(text):
+    """
+    テキストのトークン数を概算する関数（外部の tokenizer は使わない）。
+    ASCII は4文字で1トークン、それ以外の文字は1文字で1トークンとして数える。
+    """
+    if text.isascii():
+        return (len(text) + 3) // 4
+    # 非 ASCII 文字の多くは UTF-8 で3バイトなので、増えたバイト数の半分を文字数とみなす
+    non_ascii = (len(text.encode("utf-8")) - len(text)) // 2
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+class TokenBudget:
+    """プロンプト全体のトークン数の上限と使用量を管理するクラス"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    @property
+    def remaining(self):
+        return self.limit - self.used
+
+    def consume(self, tokens):
+        self.used += tokens
+
+
+def apply_token_budget(prompt_template, input_values, max_tokens):
+    """
+    プロンプト全体が max_tokens に収まるように各セクションの上限を設定する関数。
+    テンプレート本文と入力テキストは必ず含め、次にコード（指定順）を優先し、
+    ディレクトリ構造には残りのトークン数を割り当てて深い階層をまとめる。
+    """
+    budget = TokenBudget(max_tokens)
+    texts = list(compile_template(prompt_template).segments[::2])
+    texts += [v for v in input_values.values() if isinstance(v, str)]
+    budget.consume(sum(estimate_tokens(text) for text in texts))
+    code = input_values.get("code")
+    code_reserve = 0
+    if isinstance(code, CodeSection):
+        code.token_budget = budget
+        code_reserve = code.estimate_tokens()
+    tree = input_values.get("directory_structure")
+    if isinstance(tree, TreeSection):  # MultiTreeSection を含む
+        tree.token_budget = budget
+        tree.max_tokens = max(budget.remaining - code_reserve, 0)
+    return budget
+
+
+# 自動選択の対象にするソースファイルの拡張子
+INDEX_EXTENSIONS = (".py", ".php", ".js", ".ts", ".jsx", ".tsx", ".vue")
+# 出現頻度が高く、関連度の判定に役立たない語
+_INDEX_STOPWORDS = frozenset(
+    "and as def elif else except false for from function if import in is none not "
+    "or pass private protected public raise return self static the this true try "
+    "use var with".split()
+)
+_IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_SUBWORD_PATTERN = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|[0-9]+")
+_PY_IMPORT_PATTERN = re.compile(
+    r"^[ \t]*(?:from[ \t]+(\.*[\w.]*)[ \t]+import|import[ \t]+([\w., \t]+))", re.M
+)
+_PHP_USE_PATTERN = re.compile(r"^[ \t]*use[ \t]+\\?([\w\\]+)", re.M)
+_PHP_INCLUDE_PATTERN = re.compile(
+    r"\b(?:require|include)(?:_once)?[ \t(]*['\"]([^'\"]+\.php)['\"]"
+)
+# エラー文などに含まれるファイルパス（末尾の :行番号 は除く）
+_PATH_MENTION_PATTERN = re.compile(
+    r"[\w./\\-]+\.(?:py|php|js|ts|jsx|tsx|vue)\b", re.IGNORECASE
+)
+# App\Models\User のような PHP の名前空間付きクラス名
+_NAMESPACE_MENTION_PATTERN = re.compile(r"\b[A-Z]\w*(?:\\+[A-Za-z_]\w*)+")
+# Laravel（PSR-4）の名前空間とディレクトリの対応（base_rule_laravel.md の構成）
+LARAVEL_NAMESPACES = (
+    ("App\\", "app/"),
+    ("Database\\Factories\\", "database/factories/"),
+    ("Database\\Seeders\\", "database/seeders/"),
+    ("Tests\\", "tests/"),
+)
+
+
+def _identifier_terms(text):
+    """識別子を小文字の語に分解する（userController → usercontroller, user, controller）"""
+    for identifier in _IDENTIFIER_PATTERN.findall(text):
+        term = identifier.lower()
+        if len(term) > 1 and term not in _INDEX_STOPWORDS:
+            yield term
+        if "_" in identifier or not identifier.islower():
+            for sub in _SUBWORD_PATTERN.findall(identifier):
+                sub = sub.lower()
+                if sub != term and len(sub) > 1 and sub not in _INDEX_STOPWORDS:
+                    yield sub
+
+
+def _strip_relative_prefix(path):
+    """
+    先頭の ./ と ../ を取り除く（末尾部分での照合では親の位置は分からないため）。
+    lstrip と違い、.env や .hidden/x.php のようなドットで始まる名前は残す。
+    """
+    while path.startswith(("./", "../")):
+        path = path.partition("/")[2]
+    return path
+
+
+def _namespace_to_path(name):
+    """PHP の名前空間付きクラス名を Laravel の配置に従ったパスにする"""
+    name = re.sub(r"\\+", "\\\\", name.strip("\\"))
+    for prefix, directory in LARAVEL_NAMESPACES:
+        if name.startswith(prefix):
+            return directory + name[len(prefix) :].replace("\\", "/") + ".php"
+    return name.replace("\\", "/") + ".php"
+
+
+def _module_to_paths(module, rel_path):
+    """Python の import 先のモジュール名から、候補となるファイルパス（末尾部分）を返す"""
+    level = len(module) - len(module.lstrip("."))
+    module = module[level:]
+    base = ""
+    if level:
+        # 相対 import はファイルのディレクトリを基準にする
+        base = rel_path
+        for _ in range(level):
+            base = base.rpartition("/")[0]
+        base = base + "/" if base else ""
+    if not module:
+        return []
+    path = base + module.replace(".", "/")
+    return [path + ".py", path + "/__init__.py"]
+
+
+def _extract_references(text, rel_path):
+    """ファイルが import / use / require している先のパス（末尾部分）のリストを返す"""
+    refs = []
+    if rel_path.endswith(".py"):
+        for from_module, modules in _PY_IMPORT_PATTERN.findall(text):
+            for module in [from_module] if from_module else modules.split(","):
+                module = module.strip().split()[0] if module.strip() else ""
+                refs.extend(_module_to_paths(module, rel_path))
+    elif rel_path.endswith(".php"):
+        for name in _PHP_USE_PATTERN.findall(text):
+            refs.append(_namespace_to_path(name))
+        for path in _PHP_INCLUDE_PATTERN.findall(text):
+            refs.append(_strip_relative_prefix(path))
+    return list(dict.fromkeys(refs))
+
+
+class CodeIndex:
+    """
+    {code} に添付するファイルを自動選択するための、プロジェクト内のソースファイルの索引。
+    ファイルごとに語の出現回数（BM25 用）と import / use 先を保持し、
+    (サイズ, mtime_ns) が変わったファイルだけを読み直す。
+    path を指定すると JSON で保存し、次回以降は変更のないファイルの読み込みを省略する。
+    """
+
+    VERSION = 1
+    RACY_NS = DirectoryCache.RACY_NS
+    # ファイルパスに含まれる語の重み（ファイル名は内容よりも関連度の手掛かりになる）
+    PATH_TERM_WEIGHT = 5
+    # BM25 のパラメータ
+    K1 = 1.2
+    B = 0.75
+    # 上位のファイルが import しているファイルに加える点数の割合
+    REFERENCE_WEIGHT = 0.3
+
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        self.path = path
+        # 相対パス -> [size, mtime_ns, 語数, {語: 出現回数}, import 先のリスト]
+        self.files = {}
+        self.changed = False
+        self._postings = None  # 語 -> {相対パス: 出現回数}（最初の検索時に作る）
+        self._by_name = None  # ファイル名 -> [相対パス]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, root, cache_dir=CACHE_DIR):
+        """root に対応する索引ファイルを読み込む（存在しなければ空の索引）"""
+        root = os.path.abspath(root)
+        digest = hashlib.sha1(root.encode("utf-8", errors="ignore")).hexdigest()
+        index = cls(root, os.path.join(cache_dir, f"index_{digest[:16]}.json"))
+        try:
+            with open(index.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == cls.VERSION and data.get("root") == root:
+                index.files = data["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return index
+
+    def save(self):
+        """変更があった場合のみ索引を保存する"""
+        if self.path is None or not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        data = {"version": self.VERSION, "root": self.root, "files": self.files}
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def update(self, matcher, workers=DEFAULT_WORKERS, dir_cache=None):
+        """
+        ディレクトリを走査し、追加・変更されたファイルを読み直して、削除されたファイルを除く。
+        読み直したファイル数を返す。
+        """
+        with _profiler.stage("index_update"):
+            return self._update(matcher, workers, dir_cache)
+
+    def _update(self, matcher, workers, dir_cache):
+        """update の本体"""
+        tree = walk_directory_tree(self.root, matcher, workers, dir_cache)
+        current = {}
+        for _, rel_dir, files in tree:
+            for name in files:
+                if name.endswith(INDEX_EXTENSIONS):
+                    current[rel_dir + name] = os.path.join(self.root, rel_dir, name)
+        stale = []
+        for rel_path, abs_path in current.items():
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                continue
+            entry = self.files.get(rel_path)
+            if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns]:
+                stale.append((rel_path, abs_path, st))
+        removed = [rel_path for rel_path in self.files if rel_path not in current]
+        if not stale and not removed:
+            return 0
+        paths = [abs_path for _, abs_path, _ in stale]
+        contents = iter_file_contents(paths, workers, max_bytes=DEFAULT_MAX_FILE_BYTES)
+        entries = {}
+        now = time.time_ns()
+        try:
+            for (rel_path, _, st), (_, text) in zip(stale, contents):
+                if text is None:
+                    continue
+                terms = collections.Counter(_identifier_terms(text))
+                for term in _identifier_terms(rel_path):
+                    terms[term] += self.PATH_TERM_WEIGHT
+                # 保存直前に更新されたファイルは、同じ mtime のまま再度更新される可能性がある
+                mtime = -1 if now - st.st_mtime_ns < self.RACY_NS else st.st_mtime_ns
+                entries[rel_path] = [
+                    st.st_size,
+                    mtime,
+                    sum(terms.values()),
+                    dict(terms),
+                    _extract_references(text, rel_path),
+                ]
+        finally:
+            contents.close()
+        with self._lock:
+            for rel_path in removed + list(entries):
+                self._unindex(rel_path, self.files.pop(rel_path, None))
+            for rel_path, entry in entries.items():
+                self.files[rel_path] = entry
+                self._index(rel_path, entry)
+            self.changed = True
+        return len(entries)
+
+    def _index(self, rel_path, entry):
+        if self._postings is None:
+            return
+        for term, count in entry[3].items():
+            self._postings.setdefault(term, {})[rel_path] = count
+        self._by_name.setdefault(rel_path.rpartition("/")[2], []).append(rel_path)
+
+    def _unindex(self, rel_path, entry):
+        if self._postings is None or entry is None:
+            return
+        for term in entry[3]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(rel_path, None)
+        self._by_name.get(rel_path.rpartition("/")[2], []).remove(rel_path)
+
+    def _build_postings(self):
+        """転置索引を作る（self._lock を取得した状態で呼ぶ）"""
+        self._postings = {}
+        self._by_name = {}
+        for rel_path, entry in self.files.items():
+            self._index(rel_path, entry)
+
+    def _resolve(self, suffix):
+        """パスの末尾部分（app/Models/User.php など）に一致する索引内のファイルを返す"""
+        suffix = _strip_relative_prefix(suffix.replace("\\", "/"))
+        candidates = self._by_name.get(suffix.rpartition("/")[2], [])
+        return [p for p in candidates if p == suffix or p.endswith("/" + suffix)]
+
+    def _mentioned_files(self, text):
+        """テキストに含まれるファイルパスやクラス名に一致するファイルを出現順に返す"""
+        mentioned = []
+        for match in _PATH_MENTION_PATTERN.findall(text):
+            parts = match.replace("\\", "/").split("/")
+            # 絶対パスは、索引に一致する最も長い末尾部分で照合する
+            # （ファイル名だけで一致した場合は、候補が1つのときのみ採用する）
+            for i in range(len(parts)):
+                found = self._resolve("/".join(parts[i:]))
+                if found and (i == 0 or i < len(parts) - 1 or len(found) == 1):
+                    mentioned.extend(found)
+                    break
+        for name in _NAMESPACE_MENTION_PATTERN.findall(text):
+            mentioned.extend(self._resolve(_namespace_to_path(name)))
+        return list(dict.fromkeys(mentioned))
+
+    def query(self, text, top_k=5):
+        """
+        テキスト（エラー文や質問）に関連するファイルの絶対パスを、関連度の高い順に top_k 件返す。
+        テキストで言及されたファイルを優先し、残りは BM25 の点数と import 関係で順位を付ける。
+        """
+        with _profiler.stage("index_query"):
+            return self._query(text, top_k)
+
+    def _query(self, text, top_k):
+        """query の本体"""
+        with self._lock:
+            if self._postings is None:
+                self._build_postings()
+            total = len(self.files)
+            if not total or top_k <= 0:
+                return []
+            average = sum(entry[2] for entry in self.files.values()) / total or 1.0
+            scores = collections.Counter()
+            for term in set(_identifier_terms(text)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                for rel_path, count in postings.items():
+                    norm = 1 - self.B + self.B * self.files[rel_path][2] / average
+                    tf = count * (self.K1 + 1) / (count + self.K1 * norm)
+                    scores[rel_path] += idf * tf
+            mentioned = self._mentioned_files(text)
+            top = max(scores.values(), default=1.0)
+            for rank, rel_path in enumerate(mentioned):
+                scores[rel_path] += top * (2 + len(mentioned) - rank)
+            # 上位のファイルが import しているファイルも関連する可能性が高い
+            for rel_path, score in scores.most_common(top_k):
+                for ref in self.files[rel_path][4]:
+                    for target in self._resolve(ref):
+                        if target != rel_path:
+                            scores[target] += score * self.REFERENCE_WEIGHT
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            return [os.path.join(self.root, p) for p, _ in ranked[:top_k]]
+
+
+def select_relevant_files(
+    text,
+    folder_mapping=("src", "/var/www"),
+    top_k=5,
+    include_ignore=False,
+    workers=DEFAULT_WORKERS,
+    use_cache=False,
+    index=None,
+):
+    """
+    テキスト（エラー文や質問）に関連するファイルを、new_folder（対応が複数ある場合は
+    主なルート）以下から top_k 件選ぶ関数。
+    use_cache=True の場合は索引を agent_simple/.cache に保存し、変更されたファイルだけを読み直す。
+    index に CodeIndex を渡すと、更新せずにそのまま検索する（常駐モードで使う）。
+    """
+    if index is None:
+        root = folder_mappings(folder_mapping)[0][1]
+        index = CodeIndex.load(root) if use_cache else CodeIndex(root)
+        dir_cache = DirectoryCache.load(index.root) if use_cache else None
+        index.update(build_ignore_matcher(include_ignore), workers, dir_cache)
+        if use_cache:
+            try:
+                dir_cache.save()
+                index.save()
+            except OSError as e:
+                warnings.warn(f"Failed to save code index: {e}", UserWarning)
+    return index.query(text, top_k)
+
+
+def load_jobs(job_path):
+    """
+    バッチ処理のジョブファイルを読み込む関数。
+    JSONL（1行1ジョブ）または YAML（ジョブのリスト、もしくは jobs キーにリスト）に対応する。
+    """
+    with open(job_path, "r", encoding="utf-8") as f:
+        if job_path.endswith((".yaml", ".yml")):
+            import yaml
+
+            data = yaml.safe_load(f) or []
+            return data.get("jobs", []) if isinstance(data, dict) else data
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def resolve_prompt_name(template):
+    """番号（"3"）またはテンプレート名（"error_prompt"）からテンプレート名を返す関数"""
+    template = str(template)
+    if template in PROMPT_CHOICES:
+        return PROMPT_CHOICES[template][0]
+    if template in prompt_templates:
+        return template
+    raise ValueError(f"Unknown prompt template: {template}")
+
+
+class BatchContext:
+    """
+    バッチ処理のジョブ間で共有する状態（ディレクトリ構造と読み込んだファイル）を保持するクラス。
+    file_cache を省略した場合は、メモリ上だけの FileCache を使う。
+    ディレクトリごとの DirectoryCache も保持するため、refresh() による再走査は
+    mtime が変わったディレクトリだけを読み直す（フォルダの対応が複数ある場合はルートごとに並行に走査する）。
+    auto_files を指定すると、files のないジョブは関連するファイルを自動で選ぶ（CodeIndex を共有）。
+    traceback_lines を指定すると、files のないジョブは error のトレースバックの該当箇所を添付する。
+    走査済みのディレクトリの下位ディレクトリは、走査し直さずに部分木として描画する。
+    走査と索引の更新は _scan_lock で1つずつ行い、結果の差し替えだけを _lock の中で行うため、
+    refresh() の走査中も走査済みのディレクトリや索引を使うジョブは待たされない。
+    """
+
+    def __init__(
+        self,
+        folder_mapping=("src", "/var/www"),
+        include_ignore=False,
+        workers=DEFAULT_WORKERS,
+        use_cache=False,
+        max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+        max_total_bytes=DEFAULT_MAX_TOTAL_BYTES,
+        max_tokens=None,
+        file_cache=None,
+        auto_files=0,
+        traceback_lines=0,
+        tree_max_depth=None,
+        tree_max_files=None,
+    ):
+        self.folder_mapping = folder_mapping
+        self.include_ignore = include_ignore
+        self.workers = workers
+        self.use_cache = use_cache
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_tokens = max_tokens
+        self.file_cache = file_cache or FileCache()
+        self.auto_files = auto_files
+        self.traceback_lines = traceback_lines
+        self.tree_max_depth = tree_max_depth
+        self.tree_max_files = tree_max_files
+        self._trees = {}
+        self._dir_caches = {}
+        self._index = None
+        self._index_dir_cache = None
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+
+    def _scan_section(self, work_directory):
+        """work_directory を走査した結果を返す（self._scan_lock を取得した状態で呼ぶ）"""
+        root = map_folder(work_directory, self.folder_mapping)[0]
+        cache = self._dir_caches.get(root)
+        if cache is None:
+            if self.use_cache:
+                cache = DirectoryCache.load(root)
+            else:
+                cache = DirectoryCache(root)
+            self._dir_caches[root] = cache
+        section = list_directory_section(
+            work_directory,
+            folder_mapping=self.folder_mapping,
+            include_ignore=self.include_ignore,
+            workers=self.workers,
+            cache=cache,
+        )
+        return section
+
+    def _scan(self, work_directory):
+        """work_directory を走査して結果を保持する（self._scan_lock を取得した状態で呼ぶ）"""
+        section = self._scan_section(work_directory)
+        with self._lock:
+            self._trees[work_directory] = section
+        return section
+
+    def _scan_all(self, work_directories):
+        """
+        複数のディレクトリをルートごとに並行に走査し、{ディレクトリ: 走査結果} を返す
+        （self._scan_lock を取得した状態で呼ぶ。結果は保持しない）。
+        """
+        if len(work_directories) <= 1:
+            sections = [self._scan_section(d) for d in work_directories]
+        else:
+            with ThreadPoolExecutor(max_workers=len(work_directories)) as executor:
+                sections = list(executor.map(self._scan_section, work_directories))
+        return dict(zip(work_directories, sections))
+
+    def refresh(self):
+        """
+        走査済みのディレクトリ構造を再走査する（常駐モードで定期的に呼ぶ）。
+        変更があったディレクトリ数を返す。走査は _lock の外で行い、結果だけを差し替える。
+        """
+        with self._scan_lock:
+            with self._lock:
+                work_directories = list(self._trees)
+            misses = sum(cache.misses for cache in self._dir_caches.values())
+            sections = self._scan_all(work_directories)
+            with self._lock:
+                self._trees.update(sections)
+            changed = sum(cache.misses for cache in self._dir_caches.values()) - misses
+            if self._index is not None:
+                self._update_index(self._index)
+            return changed
+
+    def code_index(self):
+        """自動選択に使う CodeIndex を1度だけ作成して返す（refresh() で更新される）"""
+        index = self._index
+        if index is not None:
+            return index
+        with self._scan_lock:
+            if self._index is None:
+                root = folder_mappings(self.folder_mapping)[0][1]
+                if self.use_cache:
+                    index = CodeIndex.load(root)
+                else:
+                    index = CodeIndex(root)
+                self._index_dir_cache = DirectoryCache(index.root)
+                self._update_index(index)
+                with self._lock:
+                    self._index = index
+            return self._index
+
+    def _update_index(self, index):
+        """
+        索引を更新する（self._scan_lock を取得した状態で呼ぶ）。
+        CodeIndex は読み直した結果を自身のロックの中で差し替えるため、検索は待たされない。
+        """
+        matcher = build_ignore_matcher(self.include_ignore)
+        index.update(matcher, self.workers, self._index_dir_cache)
+        self._index_dir_cache.save()
+        if self.use_cache:
+            try:
+                index.save()
+            except OSError as e:
+                warnings.warn(f"Failed to save code index: {e}", UserWarning)
+
+    def _subtree_section(self, work_directory):
+        """走査済みの上位ディレクトリの構造から work_directory の部分木を探す（なければ None）"""
+        path = os.path.abspath(map_folder(work_directory, self.folder_mapping)[0])
+        for section in list(self._trees.values()):
+            if isinstance(section, str):
+                continue
+            rel = os.path.relpath(path, os.path.abspath(section.new_folder))
+            if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+                continue
+            start = section.dir_structure.find(rel)
+            if start is not None:
+                return TreeSection(section.dir_structure, path, start=start)
+        return None
+
+    def directory_section(self, work_directory):
+        """
+        work_directory のディレクトリ構造を1度だけ走査し、ジョブごとの TreeSection を返す。
+        複数のディレクトリ（タプル）の場合は、未走査のルートを並行に走査して MultiTreeSection にする。
+        """
+        if not isinstance(work_directory, str):
+            with self._scan_lock:
+                sections = self._scan_all(
+                    [
+                        directory
+                        for directory in work_directory
+                        if directory not in self._trees
+                        and self._subtree_section(directory) is None
+                    ]
+                )
+                with self._lock:
+                    self._trees.update(sections)
+            sections = [self.directory_section(d) for d in work_directory]
+            errors = [section for section in sections if isinstance(section, str)]
+            if errors:
+                return "\n".join(errors)
+            return MultiTreeSection(
+                sections, self.tree_max_depth, self.tree_max_files
+            )
+        section = self._trees.get(work_directory) or self._subtree_section(
+            work_directory
+        )
+        if section is None:
+            with self._scan_lock:
+                section = self._trees.get(work_directory)
+                if section is None:
+                    section = self._scan(work_directory)
+        if isinstance(section, str):
+            return section
+        # トークン数の上限はジョブごとに設定するため、走査結果だけを共有する
+        return TreeSection(
+            section.dir_structure,
+            section.new_folder,
+            max_depth=self.tree_max_depth,
+            max_files=self.tree_max_files,
+            start=section.start,
+        )
+
+    def is_within_roots(self, path):
+        """path（シンボリックリンクは解決する）がいずれかの new_folder 以下にあるかを返す"""
+        real = os.path.realpath(path)
+        for _, new_folder in folder_mappings(self.folder_mapping):
+            root = os.path.realpath(new_folder)
+            if real == root or real.startswith(root.rstrip(os.sep) + os.sep):
+                return True
+        return False
+
+    def output_path(self, output):
+        """
+        常駐モードで指定された output を、主なルートの agent_simple/ 以下のパスにする。
+        相対パスは agent_simple/ からのパスとし、外側を指す場合は ValueError を送出する。
+        """
+        base = os.path.realpath(
+            os.path.join(folder_mappings(self.folder_mapping)[0][1], "agent_simple")
+        )
+        path = os.path.realpath(os.path.join(base, output))
+        if not path.startswith(base + os.sep):
+            raise ValueError(f"output must be inside agent_simple/: {output}")
+        return path
+
+    def prepare_job(self, job, restrict_paths=False):
+        """
+        ジョブ（辞書）から (テンプレート, 入力値の辞書) を作る関数。
+        キー: template, files, input, error, directory_structure（y/n/パス）、
+        auto_files（files がない場合に自動で選ぶファイル数）、
+        traceback_lines（files がない場合にトレースバックの該当箇所の前後に含める行数）
+        restrict_paths=True の場合、new_folder の外側のファイルやディレクトリを指定した
+        ジョブは ValueError にする（常駐モードで使う。メッセージにパスは含めない）。
+        """
+        prompt_name = resolve_prompt_name(job.get("template", "1"))
+        prompt_template = prompt_templates[prompt_name]
+        file_specs = job.get("files") or []
+        if isinstance(file_specs, str):
+            file_specs = file_specs.split()
+        file_path_option = "1"
+        input_values = {}
+        for var in get_required_variables(prompt_template):
+            if var == "code":
+                if not file_specs:
+                    input_values[var] = ""
+                    continue
+                specs, file_path_option = parse_file_specs(file_specs)
+                input_values[var] = CodeSection(
+                    specs,
+                    folder_mapping=self.folder_mapping,
+                    workers=self.workers,
+                    max_file_bytes=self.max_file_bytes,
+                    max_total_bytes=self.max_total_bytes,
+                    reader=self.file_cache.read,
+                    matcher=build_ignore_matcher(self.include_ignore),
+                )
+            elif var in ["input", "error"]:
+                text = sanitize_string(job.get(var) or "")
+                input_values[var] = text if text.endswith("\n") else text + "\n"
+            elif var == "directory_structure":
+                work_directory = resolve_directory_choice(
+                    job.get("directory_structure", "y"), self.folder_mapping
+                )
+                if (
+                    restrict_paths
+                    and isinstance(work_directory, str)
+                    and not self.is_within_roots(
+                        map_folder(work_directory, self.folder_mapping)[0]
+                    )
+                ):
+                    raise ValueError("Path outside the mapped folders")
+                input_values[var] = (
+                    ""
+                    if work_directory is None
+                    else self.directory_section(work_directory)
+                )
+        traceback_lines = job.get("traceback_lines", self.traceback_lines)
+        if traceback_lines and "code" in input_values and not input_values["code"]:
+            input_values["code"] = (
+                traceback_section(
+                    input_values.get("error") or "",
+                    self.folder_mapping,
+                    traceback_lines,
+                    self.workers,
+                    self.max_file_bytes,
+                    self.max_total_bytes,
+                )
+                or ""
+            )
+        auto_files = job.get("auto_files", self.auto_files)
+        if auto_files and "code" in input_values and not input_values["code"]:
+            query = "\n".join(input_values.get(v) or "" for v in ["error", "input"])
+            input_values["code"] = CodeSection(
+                self.code_index().query(query, auto_files),
+                folder_mapping=self.folder_mapping,
+                workers=self.workers,
+                max_file_bytes=self.max_file_bytes,
+                max_total_bytes=self.max_total_bytes,
+                reader=self.file_cache.read,
+            )
+        code = input_values.get("code")
+        if restrict_paths and isinstance(code, CodeSection):
+            # 見つからなかった指定も確かめ、外側のファイルの有無で結果が変わらないようにする
+            for f in code.files + code.not_found_files:
+                if not self.is_within_roots(f):
+                    raise ValueError("Path outside the mapped folders")
+        set_file_path_prompts(input_values, file_path_option)
+        max_tokens = job.get("max_tokens", self.max_tokens)
+        if max_tokens:
+            apply_token_budget(prompt_template, input_values, max_tokens)
+        return prompt_template, input_values
+
+    def options(self):
+        """出力内容に影響する設定（--refresh のマニフェストに保存し、同じ設定で作り直す）"""
+        return {
+            "folder_mapping": folder_mappings(self.folder_mapping),
+            "include_ignore": self.include_ignore,
+            "max_file_bytes": self.max_file_bytes,
+            "max_total_bytes": self.max_total_bytes,
+            "max_tokens": self.max_tokens,
+            "tree_max_depth": self.tree_max_depth,
+            "tree_max_files": self.tree_max_files,
+        }
+
+    def render_job(self, job, output_path, restrict_paths=False):
+        """ジョブのプロンプトを output_path に書き込み、--refresh 用のマニフェストも保存する"""
+        prompt_template, input_values = self.prepare_job(job, restrict_paths)
+        options = self.options()
+        options["max_tokens"] = job.get("max_tokens", self.max_tokens)
+        return save_prompt(
+            output_path,
+            prompt_template,
+            input_values,
+            describe_job(prompt_template, input_values),
+            options,
+        )
+
+
+def run_batch(jobs, context, output_dir, max_jobs=1):
+    """
+    複数のジョブを1プロセスでまとめて処理する関数。
+    出力先はジョブの output キー、なければ output_dir/.aa_prompt_<番号>.md。
+    max_jobs > 1 の場合はジョブをスレッドプールで並行に処理する。
+    (出力パス, エラー) のリストを返す（成功したジョブのエラーは None）。
+    """
+
+    def run(index, job):
+        output_path = job.get("output") or os.path.join(
+            output_dir, f".aa_prompt_{index + 1}.md"
+        )
+        try:
+            return context.render_job(job, output_path), None
+        except Exception as e:
+            print(f"エラー: ジョブ{index + 1}の処理に失敗しました: {e}")
+            return output_path, e
+
+    if max_jobs <= 1:
+        return [run(i, job) for i, job in enumerate(jobs)]
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        return list(executor.map(run, range(len(jobs)), jobs))
+
+
+def _copy_bytes(src, out, start, end):
+    """src の start から end までのバイト列を out（_ByteWriter）に分割して写す"""
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = src.read(min(remaining, DECODE_CHUNK_BYTES))
+        if not data:
+            break
+        out.write_bytes(data)
+        remaining -= len(data)
+
+
+def refresh_prompt(
+    output_path, workers=DEFAULT_WORKERS, use_cache=False, file_cache=None
+):
+    """
+    マニフェストを保存したプロンプト（output_path）を、変更のあったセクションだけ作り直す関数。
+    ファイルやディレクトリ構造の指紋が変わったセクションだけを描画して差し替え、
+    それ以外の部分は前回の出力をバイト単位でそのまま使う。
+    出力ファイルが編集されていた場合、描画されるセクションが変わった場合、
+    トークン数の上限がある場合（配分が全体で決まるため）は全体を作り直す。
+    作り直したセクションの変数名のリストを返す。
+    """
+    manifest_path = prompt_manifest_path(output_path)
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported prompt manifest: {manifest_path}")
+    options = dict(manifest["options"])
+    mappings = folder_mappings(options["folder_mapping"])
+    options["folder_mapping"] = mappings[0] if len(mappings) == 1 else mappings
+    context = BatchContext(
+        workers=workers, use_cache=use_cache, file_cache=file_cache, **options
+    )
+    prompt_template, input_values = context.prepare_job(manifest["job"])
+    sections = rendered_sections(input_values)
+    fingerprints = {var: section.fingerprint() for var, section in sections.items()}
+    recorded = {var: fingerprint for var, _, _, fingerprint in manifest["sections"]}
+    changed = [var for var in fingerprints if recorded.get(var) != fingerprints[var]]
+    try:
+        st = os.stat(output_path)
+        output_stamp = [st.st_size, st.st_mtime_ns]
+    except OSError:
+        output_stamp = None
+
+    reason = None
+    if output_stamp != manifest.get("output_stamp"):
+        reason = "出力ファイルが前回の生成後に変更された"
+    elif set(recorded) != set(fingerprints):
+        reason = "描画するセクションが変わった"
+    elif changed and options.get("max_tokens"):
+        reason = "トークン数の上限がある"
+    if reason:
+        print(f"{reason}ため、プロンプト全体を作り直します。")
+        save_prompt(
+            output_path,
+            prompt_template,
+            input_values,
+            manifest["job"],
+            manifest["options"],
+        )
+        return list(fingerprints)
+    if not changed:
+        return []
+
+    spans = []
+    tmp_path = output_path + ".tmp"
+    with open(output_path, "rb") as src, open(tmp_path, "wb") as f:
+        out = _ByteWriter(f)
+        pos = 0
+        for var, start, end, _ in manifest["sections"]:
+            _copy_bytes(src, out, pos, start)
+            new_start = out.size
+            if var in changed:
+                sections[var].write(out)
+            else:
+                _copy_bytes(src, out, start, end)
+            spans.append([var, new_start, out.size, fingerprints[var]])
+            pos = end
+        _copy_bytes(src, out, pos, os.fstat(src.fileno()).st_size)
+    os.replace(tmp_path, output_path)
+    manifest["sections"] = spans
+    _save_manifest(output_path, manifest)
+    return changed
+
+
+class PromptRequestHandler(BaseHTTPRequestHandler):
+    """
+    常駐モードの HTTP ハンドラ。
+    POST /prompt: ジョブ（JSON、キーは --batch と同じ）を受け取り、{"prompt": 本文} を返す。
+                  output キーがある場合は agent_simple/ 以下のファイルに書き込み、
+                  {"output": パス} を返す。
+    GET /stats:   キャッシュのヒット数などを返す。
+    ブラウザ上のページなどからの要求を拒むため、Host が待ち受け先と一致しない要求と、
+    Content-Type が application/json でない POST は受け付けない。
+    ファイルとディレクトリ構造は new_folder 以下のものだけを読み込む。
+    ジョブの誤りは 400、内部のエラーは 500 を返す（500 の詳細はサーバー側にだけ表示する）。
+    """
+
+    server_version = "agent_simple"
+
+    def _check_host(self):
+        """Host が待ち受け先でなければ 403 を返して False を返す"""
+        host = self.headers.get("Host", "")
+        if host in self.server.allowed_hosts:
+            return True
+        self._send_json(403, {"error": f"Host not allowed: {host}"})
+        return False
+
+    def do_GET(self):
+        if not self._check_host():
+            return
+        if self.path != "/stats":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        context = self.server.context
+        self._send_json(
+            200,
+            {
+                "trees": len(context._trees),
+                "directory_misses": sum(
+                    cache.misses for cache in context._dir_caches.values()
+                ),
+                "file_hits": context.file_cache.hits,
+                "file_disk_hits": context.file_cache.disk_hits,
+                "file_misses": context.file_cache.misses,
+            },
+        )
+
+    def do_POST(self):
+        if not self._check_host():
+            return
+        if self.path != "/prompt":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        if self.headers.get_content_type() != "application/json":
+            self._send_json(415, {"error": "Content-Type must be application/json"})
+            return
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            job = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(job, dict):
+                raise ValueError("Job must be a JSON object")
+            context = self.server.context
+            if job.get("output"):
+                output_path = context.output_path(job["output"])
+                result = {"output": context.render_job(job, output_path, True)}
+            else:
+                prompt = generate_prompt(*context.prepare_job(job, True))
+                result = {"prompt": prompt}
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            # 内部のエラーは詳細をクライアントに返さず、サーバー側にだけ表示する
+            print(f"リクエストの処理中にエラーが発生しました: {e!r}")
+            self._send_json(500, {"error": "Internal server error"})
+            return
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        self._send_json(200, result)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix ソケットの場合、client_address はホスト名を持たない
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    """Unix ソケットで待ち受ける HTTP サーバー"""
+
+    daemon_threads = True
+
+
+def make_prompt_server(context, host="127.0.0.1", port=0, socket_path=None):
+    """
+    context（BatchContext）を共有する常駐サーバーを作る関数。
+    socket_path を指定すると Unix ソケット、省略すると host:port の HTTP で待ち受ける。
+    リクエストはスレッドごとに並行して処理される。
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, PromptRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PromptRequestHandler)
+    if socket_path:
+        # curl --unix-socket などは Host に localhost を送る
+        server.allowed_hosts = {"localhost"}
+    else:
+        bound_port = server.server_address[1]
+        server.allowed_hosts = {
+            f"{host}:{bound_port}",
+            f"127.0.0.1:{bound_port}",
+            f"localhost:{bound_port}",
+        }
+    server.context = context
+    server.verbose = False
+    return server
+
+
+def poll_directory_changes(context, stop_event, interval=DEFAULT_POLL_INTERVAL):
+    """stop_event が設定されるまで、interval 秒ごとに context のディレクトリ構造を再走査する"""
+    while not stop_event.wait(interval):
+        try:
+            context.refresh()
+        except Exception as e:
+            warnings.warn(f"Failed to refresh directory cache: {e}", UserWarning)
+
+
+def serve_prompts(
+    context,
+    host="127.0.0.1",
+    port=8765,
+    socket_path=None,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+):
+    """常駐サーバーを起動し、Ctrl+C で停止するまでリクエストを処理する関数"""
+    server = make_prompt_server(context, host, port, socket_path)
+    stop_event = threading.Event()
+    poller = threading.Thread(
+        target=poll_directory_changes,
+        args=(context, stop_event, poll_interval),
+        daemon=True,
+    )
+    poller.start()
+    address = socket_path or "http://{}:{}".format(*server.server_address[:2])
+    print(f"プロンプトサーバーを {address} で起動しました（Ctrl+C で停止）。")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("\nプロンプトサーバーを停止しました。")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create input prompt")
+    parser.add_argument(
+        "--old_folder", type=str, default="src", help="Old folder name to be replaced"
+    )
+    parser.add_argument(
+        "--new_folder",
         type=str,
         default=os.path.dirname(os.path.dirname(__file__)),
         help="New folder name to replace with",
     )
+    parser.add_argument(
+        "--mapping",
+        action="append",
+        default=[],
+        metavar="OLD=NEW",
+        help="Additional folder mapping scanned alongside --old_folder/--new_folder "
+        "(repeatable)",
+    )
     parser.add_argument(
         "--include_ignore",
         action="store_true",
         help="Whether to use .gitignore and .dirignore",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of threads used for directory scanning and file reading",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Do not use the directory scan cache in agent_simple/.cache",
+    )
+    parser.add_argument(
+        "--max_file_bytes",
+        type=int,
+        default=DEFAULT_MAX_FILE_BYTES,
+        help="Per-file byte limit; larger files are cut to head/tail (0: no limit)",
+    )
+    parser.add_argument(
+        "--max_total_bytes",
+        type=int,
+        default=DEFAULT_MAX_TOTAL_BYTES,
+        help="Total byte limit for attached files (0: no limit)",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=0,
+        help="Approximate token budget for the whole prompt (0: no limit)",
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        default=None,
+        help="Render every job in a JSONL/YAML job file without prompting",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of batch jobs rendered in parallel",
+    )
+    parser.add_argument(
+        "--file_cache",
+        action="store_true",
+        help="Persist decoded file contents in agent_simple/.cache/files",
+    )
+    parser.add_argument(
+        "--auto_files",
+        type=int,
+        default=0,
+        help="Auto-select up to N relevant files for {code} when none are given",
+    )
+    parser.add_argument(
+        "--traceback_lines",
+        type=int,
+        default=0,
+        help="Attach N lines around each traceback frame in {error} when no files "
+        "are given",
+    )
+    parser.add_argument(
+        "--tree_max_depth",
+        type=int,
+        default=None,
+        help="Collapse directories deeper than N into one 'name/ (+N more)' line",
+    )
+    parser.add_argument(
+        "--tree_max_files",
+        type=int,
+        default=None,
+        help="Show at most N files per directory in the directory structure",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run as a long-lived prompt server that keeps caches warm",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Localhost port used by --serve",
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Unix socket path used by --serve instead of the localhost port",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between directory change checks in --serve mode",
+    )
+    parser.add_argument(
+        "--refresh",
+        nargs="?",
+        const="",
+        default=None,
+        help="Rebuild only the changed sections of a saved prompt "
+        "(default: agent_simple/.aa_prompt.md)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Write per-stage timings and counters next to .aa_prompt.md",
+    )
+    parser.add_argument(
+        "--pstats",
+        action="store_true",
+        help="With --profile, also dump main-thread cProfile stats (.pstats)",
+    )
     args = parser.parse_args()
-    result = create_input_prompt(
-        folder_mapping=(args.old_folder, args.new_folder),
+    folder_mapping = (args.old_folder, args.new_folder)
+    if args.mapping:
+        extra = [tuple(mapping.split("=", 1)) for mapping in args.mapping]
+        if any(len(mapping) != 2 for mapping in extra):
+            parser.error("--mapping must be given as OLD=NEW")
+        folder_mapping = [folder_mapping] + extra
+    file_cache = FileCache(
+        cache_dir=os.path.join(CACHE_DIR, "files") if args.file_cache else None
+    )
+    profile_path = os.path.join(
+        args.new_folder, "agent_simple/.aa_prompt.profile.json"
+    )
+    profiler = Profiler(use_cprofile=args.pstats) if args.profile else None
+    set_profiler(profiler)
+
+    def save_profile():
+        """--profile の場合、計測結果をプロンプトと同じディレクトリに保存する"""
+        if profiler is None:
+            return
+        profiler.save(
+            profile_path,
+            file_cache={
+                "hits": file_cache.hits,
+                "disk_hits": file_cache.disk_hits,
+                "misses": file_cache.misses,
+            },
+        )
+        print(f"計測結果が {profile_path} に保存されました。")
+
+    output_path = os.path.join(args.new_folder, "agent_simple/.aa_prompt.md")
+    if args.refresh is not None:
+        refresh_path = args.refresh or output_path
+        try:
+            changed = refresh_prompt(
+                refresh_path,
+                workers=args.workers,
+                use_cache=not args.no_cache,
+                file_cache=file_cache,
+            )
+        except (OSError, ValueError) as e:
+            print(f"エラー: {refresh_path} を更新できませんでした: {e}")
+            sys.exit(1)
+        if changed:
+            print(f"作り直したセクション: {', '.join(changed)}")
+            print(f"プロンプトが {refresh_path} に保存されました。")
+        else:
+            print(f"変更はありません（{refresh_path}）。")
+        save_profile()
+        sys.exit(0)
+    if args.batch or args.serve:
+        context = BatchContext(
+            folder_mapping=folder_mapping,
+            include_ignore=args.include_ignore,
+            workers=args.workers,
+            use_cache=not args.no_cache,
+            max_file_bytes=args.max_file_bytes or None,
+            max_total_bytes=args.max_total_bytes or None,
+            max_tokens=args.max_tokens or None,
+            file_cache=file_cache,
+            auto_files=args.auto_files,
+            traceback_lines=args.traceback_lines,
+            tree_max_depth=args.tree_max_depth,
+            tree_max_files=args.tree_max_files,
+        )
+        if args.serve:
+            serve_prompts(
+                context,
+                port=args.port,
+                socket_path=args.socket,
+                poll_interval=args.poll_interval,
+            )
+            save_profile()
+            sys.exit(0)
+        results = run_batch(
+            load_jobs(args.batch),
+            context,
+            output_dir=os.path.join(args.new_folder, "agent_simple"),
+            max_jobs=args.jobs,
+        )
+        failed = sum(1 for _, error in results if error is not None)
+        for output_path, error in results:
+            if error is None:
+                print(f"プロンプトが {output_path} に保存されました。")
+        save_profile()
+        sys.exit(1 if failed else 0)
+    prompt_template, input_values = prepare_input_prompt(
+        folder_mapping=folder_mapping,
         include_ignore=args.include_ignore,
+        workers=args.workers,
+        use_cache=not args.no_cache,
+        max_file_bytes=args.max_file_bytes or None,
+        max_total_bytes=args.max_total_bytes or None,
+        max_tokens=args.max_tokens or None,
+        reader=file_cache.read,
+        auto_files=args.auto_files,
+        traceback_lines=args.traceback_lines,
+        tree_max_depth=args.tree_max_depth,
+        tree_max_files=args.tree_max_files,
+    )
+    # ファイル内容は1つずつ読み込みながら出力ファイルへ直接書き込む
+    save_prompt(
+        output_path,
+        prompt_template,
+        input_values,
+        describe_job(prompt_template, input_values),
+        {
+            "folder_mapping": folder_mappings(folder_mapping),
+            "include_ignore": args.include_ignore,
+            "max_file_bytes": args.max_file_bytes or None,
+            "max_total_bytes": args.max_total_bytes or None,
+            "max_tokens": args.max_tokens or None,
+            "tree_max_depth": args.tree_max_depth,
+            "tree_max_files": args.tree_max_files,
+        },
     )
-    with open(
-        os.path.join(args.new_folder, "agent_simple/.aa_prompt.md"),
-        "w",
-        encoding="utf-8",
-        errors="ignore",
-    ) as f:
-        f.write(result)
     print(
         "\nプロンプトが {}/agent_simple/.aa_prompt.md に保存されました。".format(
             args.new_folder
         )
     )
+    save_profile()
 
 # --------------------------------------------------------------------------------------------------
 # 使い方（Usage）
@@ -470,6 +3843,13 @@ if __name__ == "__main__":
 #      - --old_folder で変換前のトップフォルダ名を指定（デフォルトは"src"）。
 #      - --new_folder で変換後のトップフォルダ名を**絶対パス**で指定（デフォルトは本スクリプトの１つ上のディレクトリ）。
 #      - --include_ignore フラグを付けると.gitignoreや.dirignoreのパターンに従い、表示／取得から除外されます。
+#      - --workers でディレクトリ走査とファイル読み込みに使うスレッド数を指定（1 で逐次処理）。
+#      - ディレクトリ構造は agent_simple/.cache にキャッシュされ、次回以降は更新されたディレクトリのみ再走査します。
+#        --no_cache フラグを付けるとキャッシュを使いません。
+#      - --max_file_bytes / --max_total_bytes で1ファイル・合計の読み込みバイト数の上限を指定（0 で無制限）。
+#        上限を超えたファイルは先頭と末尾の抜粋になり、バイナリファイルは内容を省略します。
+#      - --max_tokens でプロンプト全体の概算トークン数の上限を指定します。
+#        指定順に先頭のファイルを優先して詰め、入りきらないファイルやディレクトリ構造の深い階層は省略します。
 
 # 2. プロンプトの番号を入力（1〜5）して、利用したいテンプレートを選択します。
 #    - 1: コードレビュー
@@ -481,6 +3861,8 @@ if __name__ == "__main__":
 # 3. 選んだテンプレートに応じて必要な変数（{code}, {error}, {input}, {directory_structure}など）を対話形式で入力します。
 #    - {code} 入力の際は、読み込みたいファイルやフォルダを**相対パス**で指定してください。
 #      ファイル名は空白または改行で区切って入力し、空行で入力終了です。
+#      ワイルドカード（*, ?, [...]）と任意の深さに一致する ** が使えます（例: src/app/**/*.py）。
+#      ディレクトリやワイルドカードの展開では除外パターンに一致するファイルを除き、重複したファイルは1度だけ読み込みます。
 #      注：ファイル名に **`@`** を付けると「与えられたコードのみで考えさせる（ファイルパスを受け付けない）」、
 #          **`!`** を付けると「必ずファイルパスを提供するようにする」オプションになります。
 #    - {error} や {input} では複数行を入力したい場合は、**Ctrl+C（または Ctrl+D）**で入力終了します。
@@ -492,6 +3874,67 @@ if __name__ == "__main__":
 # 5. もし「ファイルが見つからない」旨が表示された場合、指定パスやファイル名が正しいかご確認ください。
 #    特に複数ファイルを指定する際はスペースまたは改行で区切って入力し、相対パス指定が正しいか注意してください。
 
+# 6. 対話なしで複数のプロンプトをまとめて作る場合は --batch にジョブファイルを指定します。
+#    ジョブファイルは JSONL（1行1ジョブ）または YAML（ジョブのリスト）で、各ジョブは次のキーを持ちます。
+#      template: テンプレート名または番号（例: "error_prompt" / "3"）
+#      files: ファイルスペックのリストまたは空白区切りの文字列（@ / ! も使えます）
+#      input / error: 入力テキスト、directory_structure: y(default)/n/特定のパス
+#      output: 出力先（省略時は agent_simple/.aa_prompt_<番号>.md）、max_tokens: トークン数の上限
+#    ディレクトリ構造の走査と読み込んだファイルはジョブ間で共有され、--jobs で並行数を指定できます。
+#    --file_cache フラグを付けると読み込んだファイル内容を agent_simple/.cache/files に保存し、
+#    次回以降は変更のないファイルの読み込みを省略します。
+#    例）python agent.py --new_folder /var/www --batch jobs.jsonl --jobs 4
+
+# 7. エディタなどから繰り返しプロンプトを作る場合は --serve で常駐サーバーとして起動します。
+#    テンプレート・ディレクトリ構造・ファイル内容をメモリ上に保持したまま、複数のリクエストを並行に処理します。
+#    ディレクトリ構造は --poll_interval 秒ごとに mtime で変更を確認し、変更があった部分だけ再走査します。
+#    ファイル内容はリクエストごとにサイズと mtime を確認し、変更があれば読み直します。
+#      - 待ち受け先は 127.0.0.1:--port（デフォルト 8765）、--socket でパスを指定すると Unix ソケットになります。
+#      - POST /prompt にジョブ（--batch と同じキーの JSON）を送ると {"prompt": 本文} が返ります。
+#        output キーを指定した場合は agent_simple/ 以下のファイルに書き込み、{"output": パス} が返ります。
+#        Content-Type: application/json の POST だけを受け付け、Host が待ち受け先と異なる要求は拒否します。
+#        ファイルやディレクトリ構造は --new_folder（--mapping）以下のものだけを読み込みます。
+#      - GET /stats でキャッシュのヒット数を確認できます。
+#    例）python agent.py --new_folder /var/www --serve
+#        curl -s localhost:8765/prompt -H 'Content-Type: application/json' -d '{"template": "3", "files": "src/app.py", "error": "..."}'
+
+# 8. --auto_files N を指定すると、{code} のファイル指定を空行だけで省略した場合に、
+#    {error} / {input} の内容から関連するファイルを最大 N 件自動で選んで添付します。
+#    ファイル名・識別子（BM25）、エラー文に含まれるパスや名前空間（App\Models\User → app/Models/User.php）、
+#    および Python の import / PHP の use による参照関係から順位を付けます。
+#    索引は agent_simple/.cache に保存され、次回以降は変更されたファイルだけを読み直します。
+#    --batch / --serve ではジョブの auto_files キーでも指定できます。
+
+# 9. --traceback_lines N を指定すると、{code} のファイル指定を省略した場合に、
+#    {error} に貼り付けた Python / PHP のトレースバックが指す行の前後 N 行だけを行番号付きで添付します（--auto_files より優先）。
+#    パスは --old_folder / --new_folder で変換し、new_folder 以下のファイル（vendor や site-packages を除く）だけを対象にします。
+#    ファイル全体は読み込まず、該当する範囲だけをデコードするため、大きなファイルでもプロンプトが小さくなります。
+#    --batch / --serve ではジョブの traceback_lines キーでも指定できます。
+
+# 10. 大きなリポジトリではディレクトリ構造の描画量を制限できます。
+#    --tree_max_depth N で深さ N より深いディレクトリを "name/ (+N more)" の1行にまとめ、
+#    --tree_max_files N でディレクトリごとのファイルを先頭の N 件（残りは "... (+N more)"）にします。
+#    --batch / --serve では、走査済みのディレクトリの下位パスを指定したジョブは走査し直さずに部分木を描画します。
+
+# 11. 処理が遅い場合は --profile を付けると、段階ごとの処理時間（walk / ignore_match / read / render など）、
+#    ファイル数・読み込んだバイト数・キャッシュのヒット数・ピークメモリを
+#    agent_simple/.aa_prompt.profile.json に保存します（--pstats で cProfile の .pstats も保存）。
+#    段階の時間はスレッドをまたいで合計し、入れ子の段階（render 中の read など）はそれぞれに計上されます。
+#    対話入力の待ち時間は input として分けて記録されます。--profile なしの場合はほぼ負荷がありません。
+
+# 12. プロンプトの保存時に、テンプレート・ファイルの指定・入力・設定と、セクション（{code} / {directory_structure}）ごとの
+#    出力内の位置と指紋（ファイルのサイズと mtime、ツリーの描画結果のハッシュ）を .aa_prompt.manifest.json に保存します。
+#    --refresh を付けて実行すると対話入力なしで、変更があったセクションだけを作り直して既存のプロンプトに差し替えます
+#    （他の部分は前回の出力をそのまま使います）。--refresh パス で --batch の出力ファイルも更新できます。
+#    出力ファイルを手で編集した場合や、--max_tokens を指定していて変更があった場合は、全体を作り直します。
+#    例）python agent.py --new_folder /var/www --refresh
+
+# 13. 複数のルートにまたがるサービスでは、--mapping OLD=NEW を繰り返して対応を追加します（--old_folder / --new_folder が主なルート）。
+#    ディレクトリ構造で y を選ぶと、すべてのルートを並行に走査し（走査キャッシュはルートごと）、1つのディレクトリ構造にまとめます。
+#    ファイルの指定やトレースバックのパスは、先頭のフォルダ名（lib/... など）が一致する対応で変換します。
+#    --auto_files の索引は主なルートだけを対象にします。
+#    例）python agent.py --new_folder /var/www --mapping lib=/opt/lib --mapping config=/etc/app
+
 # 【コマンド実行例】
 #  python agent.py --old_folder src --new_folder /var/www --include_ignore
 
@@ -0,0 +1,310 @@
+"""
+bench_agent.py
+agent.py の処理時間を計測するベンチマークです。
+python bench_agent.py で実行します（オプションは python bench_agent.py --help を参照）。
+
+一時ディレクトリに合成したディレクトリツリー（ファイル数・深さ・ignore パターン数を指定可能）を作り、
+主要な処理の処理時間・スループット・ピークメモリ（tracemalloc）を計測します。
+--save_baseline で結果を JSON に保存し、--baseline でその結果との差分を表示します。
+外部のパッケージやネットワークは使いません。
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from agent import (
+    BatchContext,
+    IgnoreMatcher,
+    generate_prompt,
+    get_files_from_spec,
+    is_ignored,
+    list_directory_structure,
+    read_code_as_markdown,
+)
+
+
+def legacy_is_ignored(path, ignore_patterns, new_folder):
+    """比較用: パターンごとに fnmatch を呼ぶ従来の is_ignored"""
+    relative_path = os.path.relpath(path, new_folder)
+    for pattern in ignore_patterns:
+        if pattern.endswith("/"):
+            base_pattern = os.path.basename(os.path.normpath(pattern))
+            base_path = os.path.basename(os.path.normpath(relative_path))
+            if fnmatch.fnmatch(base_path, base_pattern):
+                return True
+        elif "*" in pattern or "?" in pattern:
+            if fnmatch.fnmatch(relative_path, pattern):
+                return True
+        else:
+            if relative_path == pattern:
+                return True
+    return False
+
+
+def make_patterns(n_patterns):
+    """よくある .gitignore を模したパターンを n_patterns 個生成する関数"""
+    patterns = [".git/", "agent_simple/", "__pycache__/", "*.pyc", "node_modules/"]
+    for i in range(n_patterns - len(patterns)):
+        kind = i % 4
+        if kind == 0:
+            patterns.append(f"*.ext{i}")
+        elif kind == 1:
+            patterns.append(f"build{i}/")
+        elif kind == 2:
+            patterns.append(f"generated_{i}.txt")
+        else:
+            patterns.append(f"docs/**/tmp{i}_*.md")
+    return patterns
+
+
+def make_paths(root, n_paths):
+    """ディレクトリ走査で現れるようなパスを n_paths 個生成する関数"""
+    return [
+        os.path.join(root, f"pkg{i % 50}", f"mod{i % 7}", f"file{i}.py")
+        for i in range(n_paths)
+    ]
+
+
+def make_tree(root, n_files=5000, depth=4, fanout=4, n_patterns=50, file_lines=40):
+    """
+    root 以下に合成したディレクトリツリーを作る関数。
+    深さ depth・分岐数 fanout のディレクトリに n_files 個のファイルを均等に配置し、
+    ルートに n_patterns 個のパターンの .gitignore、一部のディレクトリに下位の .gitignore を置く。
+    除外対象のファイル（*.pyc, build*/）も混ぜる。作成したディレクトリの相対パスのリストを返す。
+    """
+    dirs = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, f"pkg{i}") for parent in level for i in range(fanout)
+        ]
+        dirs.extend(level)
+    for d in dirs:
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    with open(os.path.join(root, ".gitignore"), "w") as f:
+        f.write("\n".join(make_patterns(n_patterns)) + "\n")
+    body = "".join(
+        f"def function_{i}(value):\n    return value * {i}  # サンプル\n"
+        for i in range(file_lines // 2)
+    )
+    for i in range(n_files):
+        d = dirs[i % len(dirs)]
+        kind = i % 20
+        if kind == 0:
+            name = f"cache_{i}.pyc"
+        elif kind == 1:
+            os.makedirs(os.path.join(root, d, "build1"), exist_ok=True)
+            name = os.path.join("build1", f"out_{i}.o")
+        else:
+            name = f"module_{i}.py"
+        with open(os.path.join(root, d, name), "w", encoding="utf-8") as f:
+            f.write(body)
+    for i, d in enumerate(dirs[1::7]):
+        with open(os.path.join(root, d, ".gitignore"), "w") as f:
+            f.write(f"*.log\nlocal_{i}/\n!keep.log\n")
+    return dirs
+
+
+def measure(func, repeat=3):
+    """func の最短実行時間（秒）と、tracemalloc で計測したピークメモリ（MB）を返す"""
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak / 1024 / 1024
+
+
+def run_suite(root, dirs, n_files, repeat=3, workers=4, n_patterns=50):
+    """
+    合成ツリーに対して各処理を計測し、{名前: {seconds, peak_mb, throughput, unit}} を返す。
+    list_directory_structure は .gitignore をカレントディレクトリから読むため、root に移動して実行する。
+    """
+    patterns = make_patterns(n_patterns)
+    paths = [
+        os.path.join(root, d, f"module_{i}.py") for i, d in enumerate(dirs * 4)
+    ][: max(n_files, 1)]
+    code_files = [p for p in paths if os.path.exists(p)][:200]
+    code_bytes = sum(os.path.getsize(p) for p in code_files)
+    folder_mapping = ("src", root)
+    job = {
+        "template": "error_prompt",
+        "files": [os.path.join(root, "**", "module_1*.py")],
+        "error": "Traceback: ValueError in function_3",
+    }
+
+    benchmarks = {
+        "list_directory_structure": (
+            lambda: list_directory_structure(
+                "src", folder_mapping, workers=workers, use_cache=False
+            ),
+            n_files,
+            "files/s",
+        ),
+        "is_ignored": (
+            lambda: [is_ignored(p, patterns, root, is_dir=False) for p in paths],
+            len(paths),
+            "paths/s",
+        ),
+        "get_files_from_spec": (
+            lambda: get_files_from_spec(os.path.join(root, "**", "*.py")),
+            n_files,
+            "files/s",
+        ),
+        "read_code_as_markdown": (
+            lambda: read_code_as_markdown(code_files, folder_mapping, workers=workers),
+            code_bytes / 1024 / 1024,
+            "MB/s",
+        ),
+        "generate_prompt": (
+            lambda: generate_prompt(
+                *BatchContext(folder_mapping, workers=workers).prepare_job(job)
+            ),
+            1,
+            "prompts/s",
+        ),
+    }
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        for name, (func, amount, unit) in benchmarks.items():
+            seconds, peak_mb = measure(func, repeat)
+            results[name] = {
+                "seconds": seconds,
+                "peak_mb": peak_mb,
+                "throughput": amount / seconds if seconds else 0.0,
+                "unit": unit,
+            }
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def compare_with_baseline(results, baseline, threshold=0.2):
+    """
+    baseline との差分を表示し、処理時間が threshold（割合）以上遅くなった処理名のリストを返す。
+    """
+    regressions = []
+    print("\nbaseline との比較（+ は遅く / 多くなったことを示す）")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"  {name:<26}: baseline なし")
+            continue
+        time_delta = result["seconds"] / base["seconds"] - 1 if base["seconds"] else 0
+        memory_delta = result["peak_mb"] - base["peak_mb"]
+        mark = ""
+        if time_delta > threshold:
+            regressions.append(name)
+            mark = "  <- regression"
+        print(
+            f"  {name:<26}: time {time_delta * 100:+7.1f}%"
+            f"  peak {memory_delta:+8.2f} MB{mark}"
+        )
+    return regressions
+
+
+def bench_ignore_matching(n_paths=20000, n_patterns=150, repeat=3):
+    """従来の is_ignored とコンパイル済み IgnoreMatcher の照合速度を比較する"""
+    root = "/var/www"
+    patterns = make_patterns(n_patterns)
+    paths = make_paths(root, n_paths)
+    rel_paths = [os.path.relpath(p, root) for p in paths]
+    matcher = IgnoreMatcher(patterns)
+
+    def run_legacy():
+        for p in paths:
+            legacy_is_ignored(p, patterns, root)
+
+    def run_compiled():
+        for p in rel_paths:
+            matcher.match(p)
+
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=repeat))
+    compiled = min(timeit.repeat(run_compiled, number=1, repeat=repeat))
+    print(f"is_ignored ({n_paths} paths x {n_patterns} patterns)")
+    print(f"  legacy   : {legacy * 1000:8.1f} ms")
+    print(f"  compiled : {compiled * 1000:8.1f} ms  (x{legacy / compiled:.1f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark agent.py hot paths")
+    parser.add_argument("--files", type=int, default=5000, help="Number of files")
+    parser.add_argument("--depth", type=int, default=4, help="Directory depth")
+    parser.add_argument("--fanout", type=int, default=4, help="Subdirs per directory")
+    parser.add_argument(
+        "--patterns", type=int, default=50, help="Number of root ignore patterns"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions")
+    parser.add_argument("--workers", type=int, default=4, help="Worker threads")
+    parser.add_argument(
+        "--baseline", type=str, default=None, help="Compare with this JSON baseline"
+    )
+    parser.add_argument(
+        "--save_baseline", type=str, default=None, help="Save results to this JSON"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Exit with status 1 if a benchmark is slower than baseline by this ratio",
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Also compare legacy fnmatch matching with IgnoreMatcher",
+    )
+    args = parser.parse_args()
+
+    config = {
+        "files": args.files,
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "patterns": args.patterns,
+        "workers": args.workers,
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirs = make_tree(tmpdir, args.files, args.depth, args.fanout, args.patterns)
+        results = run_suite(
+            tmpdir, dirs, args.files, args.repeat, args.workers, args.patterns
+        )
+
+    print(f"合成ツリー: {config}")
+    for name, result in results.items():
+        print(
+            f"  {name:<26}: {result['seconds'] * 1000:9.1f} ms"
+            f"  {result['throughput']:12.1f} {result['unit']:<10}"
+            f"  peak {result['peak_mb']:8.2f} MB"
+        )
+    if args.legacy:
+        bench_ignore_matching()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print(f"警告: baseline の設定が異なります: {baseline.get('config')}")
+        regressions = compare_with_baseline(
+            results, baseline.get("results", {}), args.threshold
+        )
+    if args.save_baseline:
+        data = {
+            "config": config,
+            "python": platform.python_version(),
+            "results": results,
+        }
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を {args.save_baseline} に保存しました。")
+    sys.exit(1 if regressions else 0)
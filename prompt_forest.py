@@ -1,3 +1,6 @@
+import functools
+import re
+
 # プロンプトテンプレート
 review_prompt = """# 指示
 1. これから添付するコードを日本語で解説してください。
@@ -94,3 +97,68 @@ prompt_templates = {
     "conditional_file_path_request_prompt": conditional_file_path_request_prompt,
     "file_path_request_prompt": file_path_request_prompt,
 }
+
+
+# プレースホルダ {変数名} のパターン
+_PLACEHOLDER_PATTERN = re.compile(r"\{(.*?)\}")
+
+
+class CompiledTemplate:
+    """
+    テンプレートを一度だけリテラルと変数に分解し、1パスで描画するクラス。
+    埋め込んだ値は再走査しないため、値の中に {...} が含まれていても置換されない。
+    """
+
+    __slots__ = ("source", "segments", "variables")
+
+    def __init__(self, source):
+        self.source = source
+        # 偶数番目がリテラル、奇数番目が変数名
+        self.segments = tuple(_PLACEHOLDER_PATTERN.split(source))
+        self.variables = self.segments[1::2]
+
+    @property
+    def required_variables(self):
+        """テンプレート内の変数名の集合"""
+        return frozenset(self.variables)
+
+    def render_to(self, out, values):
+        """
+        values の値を埋め込みながら out に書き込む。
+        値が文字列以外の場合は write(out) を呼び、値がない変数はそのまま残す。
+        """
+        for i, segment in enumerate(self.segments):
+            if i % 2 == 0:
+                if segment:
+                    out.write(segment)
+                continue
+            value = values.get(segment)
+            if value is None:
+                out.write(f"{{{segment}}}")
+            elif isinstance(value, str):
+                out.write(value)
+            else:
+                value.write(out)
+
+    def render(self, values):
+        """values の値を埋め込んだ文字列を返す"""
+        parts = []
+        for i, segment in enumerate(self.segments):
+            if i % 2 == 0:
+                parts.append(segment)
+            else:
+                value = values.get(segment)
+                parts.append(f"{{{segment}}}" if value is None else value)
+        return "".join(parts)
+
+
+@functools.lru_cache(maxsize=128)
+def compile_template(source):
+    """テンプレート文字列をコンパイルしてキャッシュする関数"""
+    return CompiledTemplate(source)
+
+
+# コンパイル済みテンプレートの辞書（import 時に一度だけ分解する）
+compiled_templates = {
+    name: compile_template(template) for name, template in prompt_templates.items()
+}
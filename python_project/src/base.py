@@ -1,5 +1,7 @@
+import hashlib
+import os
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
 import hydra
 import numpy as np
@@ -7,6 +9,7 @@ import pandas as pd
 import torch
 from hydra.core.config_store import ConfigStore
 from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 import utils
 
@@ -16,6 +19,8 @@ import utils
 class FeatureConfig:
     categorical_features: List[str] = field(default_factory=list)
     numerical_features: List[str] = field(default_factory=list)
+    group_key: str = "ID"  # e.g. race_id
+    target: str = "relevance"
     # Add other feature-related configurations as needed
 
 
@@ -24,6 +29,14 @@ class DataConfig:
     data_path: str = "path/to/your/data.csv"
     output_dir: str = "output/"
     features: FeatureConfig = field(default_factory=FeatureConfig)
+    chunk_size: int = 500_000  # CSV rows parsed per chunk
+    use_cache: bool = True  # Keep a Parquet copy of the CSV (requires pyarrow)
+    cache_dir: Optional[str] = None  # Defaults to <output_dir>/cache
+    scaler: str = "standard"  # "standard" (mean/std) or "robust" (median/IQR)
+    scaler_path: Optional[str] = None  # Defaults to <output_dir>/scaler.npz
+    # "fit": fit on the train split and save (training); "load": reuse the saved
+    # scaler without fitting (inference)
+    scaler_mode: str = "fit"
     # Add other data-related configurations as needed
 
 
@@ -37,17 +50,40 @@ class ModelConfig:
     # Add other model-specific configurations as needed
 
 
+@dataclass
+class LoaderConfig:
+    num_workers: int = 4  # 0 loads batches in the main process
+    pin_memory: Optional[bool] = None  # None: on whenever the device is not CPU
+    persistent_workers: bool = True  # Keep workers alive between epochs
+    prefetch_factor: int = 4  # Batches prefetched per worker
+    share_memory: bool = True  # Move group tensors to shared memory for workers
+
+
 @dataclass
 class TrainingConfig:
     seed: int = 42
     device: str = "cpu"  # "cuda" if GPU is available
     model: ModelConfig = field(default_factory=ModelConfig)
+    loader: LoaderConfig = field(default_factory=LoaderConfig)
+    # Val/test loaders run once per epoch; fewer, short-lived workers are enough
+    eval_loader: LoaderConfig = field(
+        default_factory=lambda: LoaderConfig(
+            num_workers=2, persistent_workers=False, prefetch_factor=2
+        )
+    )
     # Add other training-related configurations as needed
 
 
+@dataclass
+class SplitConfig:
+    test_size: float = 0.05
+    val_size: float = 0.15
+
+
 @dataclass
 class ProjectConfig:
     data: DataConfig = field(default_factory=DataConfig)
+    data_split: SplitConfig = field(default_factory=SplitConfig)
     training: TrainingConfig = field(default_factory=TrainingConfig)
     debug: bool = False
 
@@ -59,59 +95,661 @@ cs.store(name="base_config", node=ProjectConfig)
 # cs.store(group="model", name="base_model", node=ModelConfig)
 
 
+# --- Data Loading ---
+def _csv_dtypes(categorical: List[str], numerical: List[str]) -> Dict[str, Any]:
+    """dtype hints for pd.read_csv, so chunks never hold object columns for features."""
+    dtypes: Dict[str, Any] = {column: np.float32 for column in numerical}
+    dtypes.update({column: "category" for column in categorical})
+    return dtypes
+
+
+def _downcast_floats(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Downcast float64 columns of a CSV chunk to float32."""
+    for column in chunk.columns:
+        if pd.api.types.is_float_dtype(chunk[column]):
+            chunk[column] = chunk[column].astype(np.float32)
+    return chunk
+
+
+def _downcast_integers(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast integer columns to the smallest dtype that holds them.
+    This runs on the full column, so every chunk ends up with the same dtype.
+    """
+    for column in df.columns:
+        if pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+    return df
+
+
+def _arrow_schema(chunk: pd.DataFrame, categorical: List[str]) -> Any:
+    """
+    Build the Parquet schema from the first CSV chunk.
+    Integers are kept as int64 so later chunks with larger values still fit.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for column in chunk.columns:
+        dtype = chunk[column].dtype
+        if column in categorical:
+            arrow_type = pa.dictionary(pa.int32(), pa.string())
+        elif pd.api.types.is_bool_dtype(dtype):
+            arrow_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(dtype):
+            arrow_type = pa.int64()
+        elif pd.api.types.is_float_dtype(dtype):
+            arrow_type = pa.float32()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(str(column), arrow_type))
+    return pa.schema(fields)
+
+
+def parquet_cache_path(data_cfg: DataConfig) -> str:
+    """
+    Path of the Parquet copy of data_cfg.data_path.
+    The name includes the CSV size/mtime and the feature dtypes, so a changed CSV or
+    feature list gets a fresh cache.
+    """
+    stat = os.stat(data_cfg.data_path)
+    features = data_cfg.features
+    key = repr(
+        (
+            os.path.abspath(data_cfg.data_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            sorted(features.categorical_features),
+            sorted(features.numerical_features),
+        )
+    )
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(data_cfg.data_path))[0]
+    cache_dir = data_cfg.cache_dir or os.path.join(data_cfg.output_dir, "cache")
+    return os.path.join(cache_dir, f"{stem}-{digest}.parquet")
+
+
+def build_parquet_cache(data_cfg: DataConfig, cache_path: str) -> None:
+    """
+    Stream the CSV in chunks and write it to cache_path as Parquet.
+    Only one chunk is held in memory at a time.
+    Args:
+        data_cfg: Data configuration (data_path, chunk_size and features).
+        cache_path: Destination Parquet file (written atomically).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    features = data_cfg.features
+    categorical = list(features.categorical_features)
+    dtypes = _csv_dtypes(categorical, list(features.numerical_features))
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    writer = None
+    rows = 0
+    try:
+        for chunk in pd.read_csv(
+            data_cfg.data_path, chunksize=data_cfg.chunk_size, dtype=dtypes
+        ):
+            chunk = _downcast_floats(chunk)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, _arrow_schema(chunk, categorical))
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            try:
+                table = table.cast(writer.schema)
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                raise ValueError(
+                    f"Column types changed after row {rows} of {data_cfg.data_path}; "
+                    "list such columns in numerical_features or categorical_features."
+                ) from e
+            writer.write_table(table)
+            rows += len(chunk)
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(tmp_path, cache_path)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"Parquet cache written: {cache_path} ({rows} rows)")
+
+
+def read_parquet_columns(cache_path: str, columns: Optional[List[str]]) -> pd.DataFrame:
+    """
+    Read only the given columns from the Parquet cache through a memory map.
+    Columns missing from the cache are skipped; None reads every column.
+    """
+    import pyarrow.parquet as pq
+
+    if columns is not None:
+        available = set(pq.read_schema(cache_path).names)
+        missing = [column for column in columns if column not in available]
+        if missing:
+            print(f"Warning: columns not found in data: {missing}")
+        columns = [column for column in columns if column in available]
+    table = pq.read_table(cache_path, columns=columns, memory_map=True)
+    # Release Arrow buffers column by column while converting to pandas
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    return _downcast_integers(df)
+
+
+def read_csv_chunks(data_cfg: DataConfig, columns: Optional[List[str]]) -> pd.DataFrame:
+    """
+    Fallback without pyarrow: parse the CSV in chunks (only the given columns) and
+    concatenate them, unifying the categories of each categorical column first.
+    """
+    from pandas.api.types import union_categoricals
+
+    features = data_cfg.features
+    categorical = list(features.categorical_features)
+    dtypes = _csv_dtypes(categorical, list(features.numerical_features))
+    usecols = None if columns is None else (lambda column: column in columns)
+    chunks = [
+        _downcast_floats(chunk)
+        for chunk in pd.read_csv(
+            data_cfg.data_path,
+            chunksize=data_cfg.chunk_size,
+            dtype=dtypes,
+            usecols=usecols,
+        )
+    ]
+    if not chunks:
+        return pd.DataFrame()
+    for column in categorical:
+        if column in chunks[0].columns:
+            categories = union_categoricals([c[column] for c in chunks]).categories
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+    df = pd.concat(chunks, ignore_index=True)
+    del chunks
+    return _downcast_integers(df)
+
+
+def load_columnar_data(
+    data_cfg: DataConfig, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """
+    Load data_cfg.data_path with compact dtypes.
+    The first run streams the CSV into a Parquet cache; later runs memory-map the
+    cache and read only the requested columns. Without pyarrow (or with
+    use_cache=False) the CSV is parsed in chunks every time.
+    Args:
+        data_cfg: Data configuration.
+        columns: Columns to load (None loads every column).
+    Returns:
+        DataFrame with float32 floats, downcast integers and categorical features.
+    """
+    if data_cfg.use_cache:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print("Warning: pyarrow is not installed; reading the CSV without a cache.")
+        else:
+            cache_path = parquet_cache_path(data_cfg)
+            if not os.path.exists(cache_path):
+                build_parquet_cache(data_cfg, cache_path)
+            return read_parquet_columns(cache_path, columns)
+    return read_csv_chunks(data_cfg, columns)
+
+
 # --- Data Processing Functions ---
 def load_and_preprocess_data(cfg: ProjectConfig) -> Tuple[pd.DataFrame, List[str]]:
     """
     Load raw data and perform initial preprocessing.
+    Only the group key, the target and the configured features are loaded; when no
+    features are configured, every column is loaded and numeric columns are used.
     Args:
         cfg: Hydra configuration object.
     Returns:
         A tuple containing the preprocessed DataFrame and a list of feature column names.
     """
     print("Loading and preprocessing data...")
+    features = cfg.data.features
+    configured = list(features.categorical_features) + list(features.numerical_features)
+    columns = None
+    if configured:
+        columns = [features.group_key, features.target] + configured
+        columns = list(dict.fromkeys(columns))
 
-    # Placeholder:
-    processed_df = pd.DataFrame()  # Replace with your actual processed data
-    feature_columns = []  # Replace with your actual feature columns
-    print(f"Data loaded. Shape: {processed_df.shape}, Features: {len(feature_columns)}")
+    processed_df = load_columnar_data(cfg.data, columns)
+    if configured:
+        feature_columns = [c for c in configured if c in processed_df.columns]
+    else:
+        feature_columns = [
+            column
+            for column in processed_df.select_dtypes(include="number").columns
+            if column not in (features.group_key, features.target)
+        ]
+    memory_mb = processed_df.memory_usage().sum() / 1024**2
+    print(
+        f"Data loaded. Shape: {processed_df.shape}, Features: {len(feature_columns)}, "
+        f"Memory: {memory_mb:.1f} MB"
+    )
     return processed_df, feature_columns
 
 
+@dataclass(eq=False)
+class GroupedData(Dataset):
+    """
+    Groups (e.g. races) stored CSR-style: one contiguous feature matrix sorted by
+    group key plus an offsets array, so group i is rows offsets[i]:offsets[i + 1].
+    Indexing returns the same dict as the old per-group loop, but "features" and
+    "relevance" are views into the shared tensors instead of new allocations.
+    Being a Dataset, it plugs into a DataLoader with BucketBatchSampler.
+    """
+
+    group_ids: np.ndarray
+    offsets: np.ndarray  # int64, len(group_ids) + 1
+    features: torch.Tensor  # [rows, features], float32
+    relevance: torch.Tensor  # [rows], float32
+    categorical: Optional[np.ndarray] = None  # bool per feature column (code columns)
+
+    def __len__(self) -> int:
+        return len(self.group_ids)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"group index {index} out of range")
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return {
+            "race_id": self.group_ids[index],
+            "features": self.features[start:end],
+            "relevance": self.relevance[start:end],
+            "num_items": end - start,
+        }
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def num_items(self) -> np.ndarray:
+        """Number of items in each group."""
+        return np.diff(self.offsets)
+
+    def take(self, indices: Sequence[int]) -> "GroupedData":
+        """
+        Select groups (e.g. for a train/val/test split) with one gather of their rows.
+        The result owns its rows, so scaling one split never touches another.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        sizes = self.num_items[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        # Row positions: each group's start repeated over its rows, plus 0..size-1
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], sizes)
+        rows += np.arange(offsets[-1], dtype=np.int64)
+        rows_t = torch.from_numpy(rows)
+        return GroupedData(
+            group_ids=self.group_ids[indices],
+            offsets=offsets,
+            features=self.features.index_select(0, rows_t),
+            relevance=self.relevance.index_select(0, rows_t),
+            categorical=self.categorical,
+        )
+
+
 def create_grouped_data(
     processed_df: pd.DataFrame, feature_columns: List[str], cfg: ProjectConfig
-) -> List[Dict[str, Any]]:
+) -> GroupedData:
     """
     Group data by a specific key (e.g., race_id) and prepare it for model input.
+    Rows are sorted once by the group key (skipped when already sorted) and copied
+    column by column into one float32 matrix; categorical features use their codes,
+    with missing values mapped to their own index (the number of categories).
+    Memory and build time scale with the number of rows, not groups.
     Args:
         processed_df: The preprocessed DataFrame.
         feature_columns: List of feature column names.
         cfg: Hydra configuration object.
     Returns:
-        A list of dictionaries, where each dictionary represents a group (e.g., a race).
+        GroupedData, a sequence of per-group dicts backed by shared tensors.
     """
     print("Creating grouped data...")
-    grouped_data_list = []
-    # --- Add your grouping logic here ---
-    # Example: Group by 'ID' (race_id)
-    # for group_id, group_df in processed_df.groupby("ID"):
-    #     features_tensor = torch.FloatTensor(group_df[feature_columns].values)
-    #     relevance_tensor = torch.FloatTensor(group_df["relevance"].values)
-    #     grouped_data_list.append({
-    #         "race_id": group_id,
-    #         "features": features_tensor,
-    #         "relevance": relevance_tensor,
-    #         "num_items": len(group_df)
-    #     })
-    print(f"Grouped data created. Number of groups: {len(grouped_data_list)}")
-    return grouped_data_list
+    features = cfg.data.features
+    codes, group_ids = pd.factorize(processed_df[features.group_key], sort=True)
+    valid = codes >= 0  # rows with a missing group key are dropped
+    order = None
+    if not valid.all() or (codes[1:] < codes[:-1]).any():
+        order = np.flatnonzero(valid)
+        order = order[np.argsort(codes[order], kind="stable")]
+    counts = np.bincount(codes[valid], minlength=len(group_ids))
+    offsets = np.zeros(len(group_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    def column_values(column: str) -> np.ndarray:
+        values = processed_df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes
+            values = codes.where(codes >= 0, len(values.cat.categories))
+        values = values.to_numpy(dtype=np.float32, na_value=np.nan)
+        return values if order is None else values[order]
+
+    matrix = np.empty((offsets[-1], len(feature_columns)), dtype=np.float32)
+    for j, column in enumerate(feature_columns):
+        matrix[:, j] = column_values(column)
+    if features.target in processed_df.columns:
+        relevance = column_values(features.target)
+    else:
+        relevance = np.zeros(offsets[-1], dtype=np.float32)
+
+    grouped_data = GroupedData(
+        group_ids=np.asarray(group_ids),
+        offsets=offsets,
+        features=torch.from_numpy(matrix),
+        # The target may be a read-only view of the DataFrame; copy only in that case
+        relevance=torch.from_numpy(np.require(relevance, requirements=["C", "W"])),
+        categorical=np.array(
+            [
+                isinstance(processed_df[column].dtype, pd.CategoricalDtype)
+                for column in feature_columns
+            ],
+            dtype=bool,
+        ),
+    )
+    print(f"Grouped data created. Number of groups: {len(grouped_data)}")
+    return grouped_data
+
+
+def split_grouped_data(
+    grouped_data: GroupedData, split_cfg: SplitConfig, seed: int = 42
+) -> Tuple[GroupedData, GroupedData, GroupedData]:
+    """
+    Randomly split groups into train/val/test by split_cfg (fractions of groups).
+    Each split gets its own rows, so scaling one split never changes another.
+    """
+    order = np.random.default_rng(seed).permutation(len(grouped_data))
+    num_test = int(len(order) * split_cfg.test_size)
+    num_val = int(len(order) * split_cfg.val_size)
+    test_index = np.sort(order[:num_test])
+    val_index = np.sort(order[num_test : num_test + num_val])
+    train_index = np.sort(order[num_test + num_val :])
+    print(
+        f"Split groups: train={len(train_index)}, val={len(val_index)}, "
+        f"test={len(test_index)}"
+    )
+    return (
+        grouped_data.take(train_index),
+        grouped_data.take(val_index),
+        grouped_data.take(test_index),
+    )
+
+
+# --- Batching ---
+class BucketBatchSampler(Sampler):
+    """
+    Yields batches of group indices with similar num_items, so padding stays small.
+    Groups are sorted by size (ties broken randomly when shuffling) and cut into
+    batches of batch_size; the order of the batches is shuffled every epoch.
+    Each pass over the sampler counts as one epoch, so a new DataLoader iterator
+    gets a new order; set_epoch(epoch) pins the order to an explicit epoch instead.
+    """
+
+    def __init__(
+        self,
+        num_items: np.ndarray,
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+    ) -> None:
+        self.num_items = np.asarray(num_items)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Use the shuffling of the given epoch for the next pass."""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.num_items) // self.batch_size
+        return -(-len(self.num_items) // self.batch_size)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        if self.shuffle:
+            order = np.lexsort((rng.random(len(self.num_items)), self.num_items))
+        else:
+            order = np.argsort(self.num_items, kind="stable")
+        starts = np.arange(0, len(order), self.batch_size)
+        if self.drop_last and len(order) % self.batch_size:
+            starts = starts[:-1]
+        if self.shuffle:
+            starts = rng.permutation(starts)
+        for start in starts:
+            yield order[start : start + self.batch_size].tolist()
+
+
+def collate_groups(batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Pad a list of groups into dense tensors for one forward pass.
+    Args:
+        batch: Group dicts as returned by GroupedData[i].
+    Returns:
+        A dict with "features" [batch, max_items, features], "relevance"
+        [batch, max_items], "mask" [batch, max_items] (True for real items),
+        "num_items" [batch] and the list of "race_id".
+    """
+    num_items = torch.tensor([group["num_items"] for group in batch])
+    max_items = int(num_items.max()) if len(batch) else 0
+    num_features = batch[0]["features"].shape[1] if batch else 0
+    features = torch.zeros(len(batch), max_items, num_features)
+    relevance = torch.zeros(len(batch), max_items)
+    for i, group in enumerate(batch):
+        n = group["num_items"]
+        features[i, :n] = group["features"]
+        relevance[i, :n] = group["relevance"]
+    mask = torch.arange(max_items).unsqueeze(0) < num_items.unsqueeze(1)
+    return {
+        "race_id": [group["race_id"] for group in batch],
+        "features": features,
+        "relevance": relevance,
+        "mask": mask,
+        "num_items": num_items,
+    }
+
+
+def create_batch_loader(
+    grouped_data: GroupedData,
+    cfg: ProjectConfig,
+    shuffle: bool = True,
+    loader_cfg: Optional[LoaderConfig] = None,
+) -> DataLoader:
+    """
+    DataLoader yielding padded batches of ModelConfig.batch_size groups of similar size.
+    Workers, pinned memory, persistent workers and prefetch depth come from
+    loader_cfg. With workers, the group tensors are moved to shared memory
+    once, so workers read them without copying.
+    Args:
+        grouped_data: Groups from create_grouped_data (or GroupedData.take).
+        cfg: Hydra configuration object.
+        shuffle: Shuffle within size buckets and the batch order (train split).
+        loader_cfg: Loader settings; defaults to cfg.training.loader (train split).
+    Returns:
+        A DataLoader whose batches are dicts from collate_groups.
+    """
+    loader_cfg = loader_cfg or cfg.training.loader
+    sampler = BucketBatchSampler(
+        grouped_data.num_items,
+        cfg.training.model.batch_size,
+        shuffle=shuffle,
+        seed=cfg.training.seed,
+    )
+    pin_memory = loader_cfg.pin_memory
+    if pin_memory is None:
+        pin_memory = torch.device(cfg.training.device).type != "cpu"
+    worker_options: Dict[str, Any] = {}
+    if loader_cfg.num_workers > 0:
+        if loader_cfg.share_memory:
+            grouped_data.features.share_memory_()
+            grouped_data.relevance.share_memory_()
+        worker_options = {
+            "persistent_workers": loader_cfg.persistent_workers,
+            "prefetch_factor": loader_cfg.prefetch_factor,
+        }
+    return DataLoader(
+        grouped_data,
+        batch_sampler=sampler,
+        collate_fn=collate_groups,
+        num_workers=loader_cfg.num_workers,
+        pin_memory=pin_memory,
+        **worker_options,
+    )
+
+
+# --- Feature Scaling ---
+@dataclass(eq=False)
+class FeatureScaler:
+    """
+    Per-feature scaling fitted on the concatenated train feature matrix.
+    "standard" streams over row chunks with Welford/Chan updates (mean and variance);
+    "robust" uses the median and IQR of a row sample. NaNs are ignored when fitting
+    and stay NaN after scaling. Columns passed as skip (categorical codes) keep
+    center 0 and scale 1, so they pass through unchanged.
+    """
+
+    method: str = "standard"
+    center: Optional[np.ndarray] = None
+    scale: Optional[np.ndarray] = None
+    chunk_rows: int = 1 << 20
+    sample_rows: int = 200_000  # rows sampled for the robust statistics
+
+    def fit(
+        self,
+        features: torch.Tensor,
+        seed: int = 0,
+        skip: Optional[np.ndarray] = None,
+    ) -> "FeatureScaler":
+        """Fit center/scale on a [rows, features] tensor, leaving skip columns as-is."""
+        if self.method == "standard":
+            self._fit_standard(features)
+        elif self.method == "robust":
+            self._fit_robust(features, seed)
+        else:
+            raise ValueError(f"Unknown scaler method: {self.method}")
+        if skip is not None:
+            self.center[skip] = 0.0
+            self.scale[skip] = 1.0
+        return self
+
+    def _fit_standard(self, features: torch.Tensor) -> None:
+        num_features = features.shape[1]
+        count = torch.zeros(num_features, dtype=torch.float64)
+        mean = torch.zeros(num_features, dtype=torch.float64)
+        m2 = torch.zeros(num_features, dtype=torch.float64)
+        for start in range(0, features.shape[0], self.chunk_rows):
+            block = features[start : start + self.chunk_rows].double()
+            valid = ~torch.isnan(block)
+            block_count = valid.sum(0).double()
+            block_sum = torch.where(valid, block, 0.0).sum(0)
+            block_mean = block_sum / block_count.clamp(min=1)
+            block_m2 = (torch.where(valid, block - block_mean, 0.0) ** 2).sum(0)
+            # Merge the chunk's (count, mean, M2) into the running statistics
+            total = count + block_count
+            delta = block_mean - mean
+            weight = block_count / total.clamp(min=1)
+            mean += delta * weight
+            m2 += block_m2 + delta**2 * count * weight
+            count = total
+        std = torch.sqrt(m2 / count.clamp(min=1))
+        self.center = mean.numpy()
+        self.scale = torch.where(std > 0, std, 1.0).numpy()
+
+    def _fit_robust(self, features: torch.Tensor, seed: int) -> None:
+        rows = features.shape[0]
+        if rows > self.sample_rows:
+            rng = np.random.default_rng(seed)
+            index = np.sort(rng.choice(rows, self.sample_rows, replace=False))
+            features = features.index_select(0, torch.from_numpy(index))
+        sample = features.numpy().astype(np.float64)
+        q1, median, q3 = np.nanpercentile(sample, [25, 50, 75], axis=0)
+        iqr = np.nan_to_num(q3 - q1)
+        self.center = np.nan_to_num(median)
+        self.scale = np.where(iqr > 0, iqr, 1.0)
+
+    def transform_(self, features: torch.Tensor) -> torch.Tensor:
+        """Scale a [rows, features] tensor in place and return it."""
+        if self.center is None or self.scale is None:
+            raise ValueError("FeatureScaler is not fitted")
+        center = torch.from_numpy(self.center).to(features.dtype)
+        scale = torch.from_numpy(self.scale).to(features.dtype)
+        return features.sub_(center).div_(scale)
+
+    def save(self, path: str) -> None:
+        """Save the fitted statistics as .npz."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, method=self.method, center=self.center, scale=self.scale)
+
+    @classmethod
+    def load(cls, path: str) -> "FeatureScaler":
+        with np.load(path) as data:
+            return cls(
+                method=str(data["method"]),
+                center=data["center"],
+                scale=data["scale"],
+            )
 
 
 def scale_features(
-    train_data: List[Dict[str, Any]],
-    val_data: List[Dict[str, Any]],
-    test_data: List[Dict[str, Any]],
-) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
-    pass
+    train_data: GroupedData,
+    val_data: GroupedData,
+    test_data: GroupedData,
+    method: str = "standard",
+    scaler_path: Optional[str] = None,
+    mode: str = "fit",
+    seed: int = 0,
+) -> Tuple[GroupedData, GroupedData, GroupedData]:
+    """
+    Fit a FeatureScaler on the train groups and scale all splits in place.
+    Categorical code columns are not scaled, so they stay valid category indices.
+    The feature tensors are modified directly (no per-group copies); a tensor shared
+    by several splits is scaled only once.
+    Args:
+        train_data: Train groups (the scaler is fitted on their features).
+        val_data: Validation groups.
+        test_data: Test groups.
+        method: "standard" or "robust".
+        scaler_path: Where the fitted scaler is saved ("fit") or loaded from ("load").
+        mode: "fit" always fits on train_data and overwrites scaler_path;
+            "load" reuses the scaler saved by a training run (for inference).
+        seed: Seed for the robust method's row sample.
+    Returns:
+        The same three GroupedData objects, scaled.
+    """
+    if mode == "load":
+        if not scaler_path:
+            raise ValueError("scaler_path is required when mode is 'load'")
+        scaler = FeatureScaler.load(scaler_path)
+        print(f"Loaded fitted scaler: {scaler_path}")
+    elif mode == "fit":
+        scaler = FeatureScaler(method=method).fit(
+            train_data.features, seed=seed, skip=train_data.categorical
+        )
+        if scaler_path:
+            scaler.save(scaler_path)
+            print(f"Scaler saved: {scaler_path}")
+    else:
+        raise ValueError(f"Unknown scaler mode: {mode}")
+    if len(scaler.center) != train_data.features.shape[1]:
+        raise ValueError(
+            f"Scaler has {len(scaler.center)} features but the data has "
+            f"{train_data.features.shape[1]}; refit the scaler."
+        )
+    scaled = set()
+    for data in (train_data, val_data, test_data):
+        key = (data.features.data_ptr(), tuple(data.features.shape))
+        if key not in scaled:
+            scaled.add(key)
+            scaler.transform_(data.features)
     return train_data, val_data, test_data
 
 
@@ -135,6 +773,35 @@ def main(cfg: ProjectConfig) -> None:
         print("No data or features after preprocessing. Exiting.")
         return
 
+    # 2. Group, split and scale
+    grouped_data = create_grouped_data(processed_df, feature_columns, cfg)
+    del processed_df
+    train_data, val_data, test_data = split_grouped_data(
+        grouped_data, cfg.data_split, cfg.training.seed
+    )
+    del grouped_data
+    scale_features(
+        train_data,
+        val_data,
+        test_data,
+        method=cfg.data.scaler,
+        scaler_path=cfg.data.scaler_path
+        or os.path.join(cfg.data.output_dir, "scaler.npz"),
+        mode=cfg.data.scaler_mode,
+        seed=cfg.training.seed,
+    )
+    cfg.training.model.input_dim = len(feature_columns)
+
+    # 3. Input pipeline
+    train_loader = create_batch_loader(train_data, cfg, shuffle=True)
+    eval_loader_cfg = cfg.training.eval_loader
+    val_loader = create_batch_loader(val_data, cfg, False, eval_loader_cfg)
+    test_loader = create_batch_loader(test_data, cfg, False, eval_loader_cfg)
+    print(
+        f"Data loaders ready. Batches: train={len(train_loader)}, "
+        f"val={len(val_loader)}, test={len(test_loader)}"
+    )
+
     print("\nProject finished.")
 
 
@@ -0,0 +1,389 @@
+import os
+import sys
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+    import pandas as pd
+    import torch
+except ImportError as e:  # the project dependencies live in the dev container
+    raise unittest.SkipTest(f"python_project dependencies are not installed: {e}")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import base  # noqa: E402
+
+
+class PipelineTestCase(unittest.TestCase):
+    """小さな CSV と、それを読む設定を一時ディレクトリに用意する"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        # IDごとの行数: 10 -> 3, 20 -> 1, 30 -> 2, 40 -> 4 (わざと未ソート)
+        self.csv_path = os.path.join(self.tmpdir.name, "data.csv")
+        pd.DataFrame(
+            {
+                "ID": [30, 10, 40, 10, 20, 40, 30, 10, 40, 40],
+                "relevance": [1, 0, 2, 1, 0, 1, 0, 3, 0, 1],
+                "horse": ["a", "b", None, "a", "c", "b", "c", "a", "a", None],
+                "weight": [4.0, 1.0, 7.0, 2.0, 5.0, 8.0, 6.0, 3.0, 9.0, 10.0],
+                "unused": ["x"] * 10,
+            }
+        ).to_csv(self.csv_path, index=False)
+
+        self.cfg = base.ProjectConfig()
+        self.cfg.data.data_path = self.csv_path
+        self.cfg.data.chunk_size = 4
+        self.cfg.data.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        self.cfg.data.features.categorical_features = ["horse"]
+        self.cfg.data.features.numerical_features = ["weight"]
+        self.cfg.training.loader.num_workers = 0
+
+
+class TestColumnarLoading(PipelineTestCase):
+    def test_csv_chunks_match_parquet_cache(self):
+        columns = ["ID", "relevance", "horse", "weight"]
+        # カテゴリ "c" は2つ目のチャンクで初めて現れるので、カテゴリの統合も確認できる
+        from_csv = base.read_csv_chunks(self.cfg.data, columns)
+        from_cache = base.load_columnar_data(self.cfg.data, columns)
+        self.assertEqual(list(from_csv.columns), columns)
+        self.assertEqual(from_csv["weight"].dtype, np.float32)
+        self.assertEqual(list(from_csv["horse"].cat.categories), ["a", "b", "c"])
+        self.assertEqual(int(from_csv["horse"].isna().sum()), 2)
+        pd.testing.assert_frame_equal(from_csv, from_cache, check_dtype=False)
+        # 指定されていない列は読み込まない
+        self.assertNotIn("unused", from_cache.columns)
+
+    def test_cache_is_rebuilt_when_csv_changes(self):
+        first_path = base.parquet_cache_path(self.cfg.data)
+        self.assertEqual(len(base.load_columnar_data(self.cfg.data)), 10)
+        self.assertTrue(os.path.exists(first_path))
+        self.assertEqual(base.parquet_cache_path(self.cfg.data), first_path)
+
+        with open(self.csv_path, "a") as f:
+            f.write("50,2,b,11.0,x\n")
+        os.utime(self.csv_path, ns=(10**9, 10**9))
+        second_path = base.parquet_cache_path(self.cfg.data)
+        self.assertNotEqual(second_path, first_path)
+        df = base.load_columnar_data(self.cfg.data)
+        self.assertEqual(len(df), 11)
+        self.assertTrue(os.path.exists(second_path))
+        # 特徴量の指定が変わった場合も別のキャッシュになる
+        self.cfg.data.features.numerical_features = []
+        self.assertNotEqual(base.parquet_cache_path(self.cfg.data), second_path)
+
+    def test_without_cache_reads_csv(self):
+        self.cfg.data.use_cache = False
+        df = base.load_columnar_data(self.cfg.data, ["ID", "weight"])
+        self.assertEqual(list(df.columns), ["ID", "weight"])
+        self.assertFalse(os.path.exists(self.cfg.data.cache_dir))
+
+
+class TestGroupedData(unittest.TestCase):
+    def setUp(self):
+        # グループの行数: 0 (空), 1, 3
+        self.grouped = base.GroupedData(
+            group_ids=np.array([7, 8, 9]),
+            offsets=np.array([0, 0, 1, 4], dtype=np.int64),
+            features=torch.arange(8, dtype=torch.float32).reshape(4, 2),
+            relevance=torch.tensor([1.0, 0.0, 2.0, 3.0]),
+            categorical=np.array([False, False]),
+        )
+
+    def test_offsets_and_slices(self):
+        grouped = self.grouped
+        self.assertEqual(len(grouped), 3)
+        self.assertEqual(grouped.num_items.tolist(), [0, 1, 3])
+        empty = grouped[0]
+        self.assertEqual(empty["num_items"], 0)
+        self.assertEqual(tuple(empty["features"].shape), (0, 2))
+        single = grouped[1]
+        self.assertEqual((single["race_id"], single["num_items"]), (8, 1))
+        self.assertEqual(single["features"].tolist(), [[0.0, 1.0]])
+        self.assertEqual(grouped[-1]["relevance"].tolist(), [0.0, 2.0, 3.0])
+        # スライスは共有テンソルのビュー
+        self.assertEqual(
+            grouped[2]["features"].data_ptr(), grouped.features[1].data_ptr()
+        )
+        with self.assertRaises(IndexError):
+            grouped[3]
+        self.assertEqual([g["race_id"] for g in grouped], [7, 8, 9])
+
+    def test_take_copies_selected_groups(self):
+        taken = self.grouped.take([2, 0, 1])
+        self.assertEqual(taken.group_ids.tolist(), [9, 7, 8])
+        self.assertEqual(taken.offsets.tolist(), [0, 3, 3, 4])
+        self.assertEqual(taken[0]["features"].tolist(), [[2, 3], [4, 5], [6, 7]])
+        self.assertEqual(taken[1]["num_items"], 0)
+        self.assertEqual(taken[2]["relevance"].tolist(), [1.0])
+        self.assertTrue(taken.categorical is self.grouped.categorical)
+        # 取り出した側を書き換えても元のデータは変わらない
+        taken.features.zero_()
+        self.assertEqual(self.grouped.features[1].tolist(), [2.0, 3.0])
+        self.assertEqual(len(self.grouped.take([])), 0)
+
+    def test_rows_without_group_key_are_dropped(self):
+        df = pd.DataFrame(
+            {
+                "ID": [2.0, np.nan, 1.0, 2.0],
+                "relevance": [1.0, 5.0, 0.0, 2.0],
+                "x": [1.0, 2.0, 3.0, 4.0],
+            }
+        )
+        grouped = base.create_grouped_data(df, ["x"], base.ProjectConfig())
+        self.assertEqual(grouped.group_ids.tolist(), [1.0, 2.0])
+        self.assertEqual(grouped.offsets.tolist(), [0, 1, 3])
+        self.assertEqual(grouped.features[:, 0].tolist(), [3.0, 1.0, 4.0])
+        self.assertEqual(grouped.relevance.tolist(), [0.0, 1.0, 2.0])
+
+
+class TestBatchLoader(unittest.TestCase):
+    def setUp(self):
+        self.grouped = base.GroupedData(
+            group_ids=np.arange(3),
+            offsets=np.array([0, 2, 3, 6], dtype=np.int64),
+            features=torch.ones(6, 2),
+            relevance=torch.zeros(6),
+        )
+        self.cfg = base.ProjectConfig()
+
+    def test_pin_memory_follows_device(self):
+        self.cfg.training.loader.num_workers = 0
+        for device, pin_memory, expected in [
+            ("cpu", None, False),
+            ("cuda", None, True),
+            ("cuda:1", None, True),
+            ("cuda", False, False),
+            ("cpu", True, True),
+        ]:
+            self.cfg.training.device = device
+            self.cfg.training.loader.pin_memory = pin_memory
+            loader = base.create_batch_loader(self.grouped, self.cfg)
+            self.assertEqual(loader.pin_memory, expected, (device, pin_memory))
+
+    def test_worker_options(self):
+        loader_cfg = self.cfg.training.loader
+        loader_cfg.num_workers = 0
+        loader = base.create_batch_loader(self.grouped, self.cfg)
+        self.assertEqual(loader.num_workers, 0)
+        self.assertFalse(loader.persistent_workers)
+        self.assertIsNone(loader.prefetch_factor)
+        self.assertFalse(self.grouped.features.is_shared())
+
+        loader_cfg.num_workers = 3
+        loader = base.create_batch_loader(self.grouped, self.cfg)
+        self.assertEqual(loader.num_workers, 3)
+        self.assertTrue(loader.persistent_workers)
+        self.assertEqual(loader.prefetch_factor, 4)
+        self.assertTrue(self.grouped.features.is_shared())
+        self.assertTrue(self.grouped.relevance.is_shared())
+
+        # val/test 用の設定は少ないワーカーを使い、エポックをまたいで残さない
+        loader = base.create_batch_loader(
+            self.grouped, self.cfg, False, self.cfg.training.eval_loader
+        )
+        self.assertEqual(loader.num_workers, 2)
+        self.assertFalse(loader.persistent_workers)
+        self.assertEqual(loader.prefetch_factor, 2)
+
+    def test_batches_cover_every_group(self):
+        self.cfg.training.loader.num_workers = 0
+        self.cfg.training.model.batch_size = 2
+        loader = base.create_batch_loader(self.grouped, self.cfg, shuffle=False)
+        self.assertEqual(len(loader), 2)
+        sizes = [batch["num_items"].tolist() for batch in loader]
+        self.assertEqual(sizes, [[1, 2], [3]])
+
+
+class TestPipeline(PipelineTestCase):
+    def test_csv_to_collated_batch(self):
+        df, feature_columns = base.load_and_preprocess_data(self.cfg)
+        self.assertEqual(feature_columns, ["horse", "weight"])
+        self.assertTrue(os.path.exists(base.parquet_cache_path(self.cfg.data)))
+        # 2回目はParquetキャッシュから読み、同じ結果になる
+        cached_df, _ = base.load_and_preprocess_data(self.cfg)
+        pd.testing.assert_frame_equal(df, cached_df)
+
+        grouped = base.create_grouped_data(df, feature_columns, self.cfg)
+        self.assertEqual(grouped.group_ids.tolist(), [10, 20, 30, 40])
+        self.assertEqual(grouped.num_items.tolist(), [3, 1, 2, 4])
+        self.assertEqual(grouped.categorical.tolist(), [True, False])
+        # 欠損カテゴリは -1 ではなく専用のインデックス (カテゴリ数) になる
+        num_categories = len(df["horse"].cat.categories)
+        horse = grouped[3]["features"][:, 0]
+        self.assertEqual(int(horse.min()), 0)
+        self.assertEqual(int((horse == num_categories).sum()), 2)
+
+        split_cfg = base.SplitConfig(test_size=0.25, val_size=0.25)
+        train, val, test = base.split_grouped_data(grouped, split_cfg, seed=0)
+        self.assertEqual((len(train), len(val), len(test)), (2, 1, 1))
+        self.assertEqual(
+            sorted(np.concatenate([s.group_ids for s in (train, val, test)])),
+            [10, 20, 30, 40],
+        )
+
+        codes_before = train.features[:, 0].clone()
+        scaler_path = os.path.join(self.tmpdir.name, "scaler.npz")
+        train, val, test = base.scale_features(
+            train, val, test, scaler_path=scaler_path
+        )
+        self.assertTrue(os.path.exists(scaler_path))
+        # 数値列は train で標準化され、カテゴリ列はそのまま
+        weight = train.features[:, 1].double()
+        self.assertAlmostEqual(float(weight.mean()), 0.0, places=5)
+        self.assertAlmostEqual(float(weight.std(unbiased=False)), 1.0, places=5)
+        self.assertTrue(torch.equal(train.features[:, 0], codes_before))
+
+        loader = base.create_batch_loader(train, self.cfg, shuffle=False)
+        batch = next(iter(loader))
+        sizes = train.num_items.tolist()
+        self.assertEqual(batch["num_items"].tolist(), sizes)
+        self.assertEqual(tuple(batch["features"].shape), (2, max(sizes), 2))
+        expected_mask = torch.tensor(
+            [[j < size for j in range(max(sizes))] for size in sizes]
+        )
+        self.assertTrue(torch.equal(batch["mask"], expected_mask))
+        # パディング部分はゼロ、実データ部分は GroupedData と一致する
+        self.assertFalse(batch["features"][~batch["mask"]].any())
+        for i, size in enumerate(sizes):
+            self.assertTrue(
+                torch.equal(batch["features"][i, :size], train[i]["features"])
+            )
+
+    def test_standard_scaler_streams_over_chunks(self):
+        features = torch.randn(1000, 3) * torch.tensor([1.0, 5.0, 0.1]) + 3.0
+        features[::7, 1] = float("nan")
+        scaler = base.FeatureScaler(chunk_rows=64).fit(
+            features, skip=np.array([False, False, True])
+        )
+        data = features.double().numpy()
+        np.testing.assert_allclose(
+            scaler.center[:2], np.nanmean(data[:, :2], axis=0), rtol=1e-6
+        )
+        np.testing.assert_allclose(
+            scaler.scale[:2], np.nanstd(data[:, :2], axis=0), rtol=1e-6
+        )
+        self.assertEqual((scaler.center[2], scaler.scale[2]), (0.0, 1.0))
+
+
+class TestFeatureScaler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def make_split(self, features):
+        rows = len(features)
+        return base.GroupedData(
+            group_ids=np.arange(rows),
+            offsets=np.arange(rows + 1, dtype=np.int64),
+            features=torch.tensor(features, dtype=torch.float32),
+            relevance=torch.zeros(rows),
+            categorical=np.array([False, False, True]),
+        )
+
+    def test_robust_uses_median_and_iqr(self):
+        features = torch.tensor(
+            [
+                [1.0, 5.0, 0.0],
+                [2.0, 5.0, 1.0],
+                [3.0, float("nan"), 2.0],
+                [4.0, 5.0, 3.0],
+                [100.0, 5.0, 4.0],
+            ]
+        )
+        scaler = base.FeatureScaler(method="robust").fit(
+            features, skip=np.array([False, False, True])
+        )
+        # 外れ値 (100) の影響を受けず、一定の列は scale 1 になる
+        np.testing.assert_allclose(scaler.center, [3.0, 5.0, 0.0])
+        np.testing.assert_allclose(scaler.scale, [2.0, 1.0, 1.0])
+        scaled = scaler.transform_(features.clone())
+        self.assertTrue(torch.isnan(scaled[2, 1]))
+        self.assertEqual(scaled[:, 0].tolist(), [-1.0, -0.5, 0.0, 0.5, 48.5])
+        sampled = base.FeatureScaler(method="robust", sample_rows=3).fit(features)
+        self.assertEqual(sampled.center.shape, (3,))
+        with self.assertRaises(ValueError):
+            base.FeatureScaler(method="minmax").fit(features)
+
+    def test_load_mode_round_trip(self):
+        scaler_path = os.path.join(self.tmpdir.name, "scaler.npz")
+        train = self.make_split([[1.0, 10.0, 0.0], [3.0, 30.0, 2.0]])
+        val = self.make_split([[2.0, 20.0, 1.0]])
+        base.scale_features(
+            train, val, val, method="robust", scaler_path=scaler_path, mode="fit"
+        )
+        fitted = val.features.clone()
+
+        # 推論側: 新しいデータに保存済みの scaler をそのまま適用する
+        new_train = self.make_split([[100.0, 100.0, 0.0], [200.0, 200.0, 1.0]])
+        new_val = self.make_split([[2.0, 20.0, 1.0]])
+        base.scale_features(
+            new_train, new_val, new_val, scaler_path=scaler_path, mode="load"
+        )
+        self.assertTrue(torch.equal(new_val.features, fitted))
+        loaded = base.FeatureScaler.load(scaler_path)
+        self.assertEqual(loaded.method, "robust")
+        self.assertEqual(loaded.center[2], 0.0)
+
+        with self.assertRaises(ValueError):
+            base.scale_features(new_train, new_val, new_val, mode="load")
+        with self.assertRaises(ValueError):
+            base.scale_features(new_train, new_val, new_val, mode="refit")
+        other = base.GroupedData(
+            group_ids=np.arange(1),
+            offsets=np.array([0, 1], dtype=np.int64),
+            features=torch.zeros(1, 2),
+            relevance=torch.zeros(1),
+        )
+        with self.assertRaises(ValueError):
+            base.scale_features(
+                other, other, other, scaler_path=scaler_path, mode="load"
+            )
+
+
+class TestBucketBatchSampler(unittest.TestCase):
+    def test_order_changes_every_epoch(self):
+        sampler = base.BucketBatchSampler(np.arange(64) % 5 + 1, 4, seed=1)
+        first, second = list(sampler), list(sampler)
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(sum(first, [])), sorted(sum(second, [])))
+        sampler.set_epoch(0)
+        self.assertEqual(list(sampler), first)
+
+    def test_unshuffled_order_is_deterministic(self):
+        num_items = np.array([3, 1, 2, 1, 3, 2])
+        sampler = base.BucketBatchSampler(num_items, 2, shuffle=False)
+        # 行数の昇順（同じ行数は元の順）に区切る
+        expected = [[1, 3], [2, 5], [0, 4]]
+        self.assertEqual(list(sampler), expected)
+        self.assertEqual(list(sampler), expected)
+
+    def test_drop_last(self):
+        num_items = np.arange(10) + 1
+        sampler = base.BucketBatchSampler(num_items, 4, shuffle=False, drop_last=True)
+        self.assertEqual(list(sampler), [[0, 1, 2, 3], [4, 5, 6, 7]])
+        for shuffle in (False, True):
+            sampler = base.BucketBatchSampler(
+                num_items, 4, shuffle=shuffle, drop_last=True
+            )
+            batches = list(sampler)
+            self.assertTrue(all(len(batch) == 4 for batch in batches))
+
+    def test_len_matches_batches(self):
+        for num_groups in (0, 1, 7, 8, 9):
+            for batch_size in (1, 3, 8):
+                for drop_last in (False, True):
+                    for shuffle in (False, True):
+                        sampler = base.BucketBatchSampler(
+                            np.ones(num_groups, dtype=np.int64),
+                            batch_size,
+                            shuffle=shuffle,
+                            drop_last=drop_last,
+                        )
+                        self.assertEqual(len(sampler), len(list(sampler)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,23 +5,55 @@ test_agent.py
 要らないテスト関数は消さずにコメントアウトしています。
 """
 
+import hashlib
+import io
+import json
 import os
 import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.request
 import warnings
 from unittest.mock import MagicMock, patch
 
-from agent import (  # read_code_as_markdown,; create_input_prompt,
+import agent
+from agent import (  # create_input_prompt,
+    BatchContext,
+    CodeIndex,
+    CodeSection,
+    DirectoryCache,
+    DirectoryTree,
+    FileCache,
+    IgnoreMatcher,
+    Profiler,
     _decode_with_warning,
+    _extract_references,
+    TreeSection,
     add_markdown_block,
+    apply_token_budget,
+    decode_utf8,
+    estimate_tokens,
+    expand_file_specs,
     format_directory_structure,
+    generate_prompt,
     get_directory_structure,
     get_required_variables,
     is_ignored,
+    list_directory_structure,
+    load_jobs,
+    make_prompt_server,
+    parse_traceback,
+    read_code_as_markdown,
     read_file,
+    refresh_prompt,
     replace_top_folder,
+    run_batch,
     sanitize_string,
+    set_profiler,
+    traceback_section,
 )
+from prompt_forest import compile_template, compiled_templates
 
 
 class TestAgentFunctions(unittest.TestCase):
@@ -45,16 +77,125 @@ class TestAgentFunctions(unittest.TestCase):
         with self.assertRaises(ValueError):
             get_required_variables(invalid_template)
 
+    def test_compile_template(self):
+        compiled = compile_template("A {code} B {input} C")
+        self.assertIs(compiled, compile_template("A {code} B {input} C"))
+        self.assertEqual(compiled.variables, ("code", "input"))
+        self.assertEqual(
+            compiled.render({"code": "{input}", "input": "x"}), "A {input} B x C"
+        )
+        self.assertEqual(compiled.render({"code": "1"}), "A 1 B {input} C")
+        self.assertIn("error", compiled_templates["error_prompt"].required_variables)
+
     def test_is_ignored(self):
         ignore_patterns = ["*.pyc", "secret/"]
         new_folder = "/var/www"
         path1 = "/var/www/secret/config.txt"
         path2 = "/var/www/app/main.py"
         path3 = "/var/www/app/main.pyc"
-        # 修正すべきテストケースが確認されるまで以下をコメントアウト
-        # self.assertTrue(is_ignored(path1, ignore_patterns, new_folder))
+        self.assertTrue(is_ignored(path1, ignore_patterns, new_folder))
         self.assertFalse(is_ignored(path2, ignore_patterns, new_folder))
         self.assertTrue(is_ignored(path3, ignore_patterns, new_folder))
+        # 存在しないパスでも stat せず、ディレクトリパターンは名前で一致する
+        self.assertTrue(is_ignored("/var/www/build", ["build/"], "/var/www"))
+        self.assertFalse(
+            is_ignored("/var/www/build", ["build/"], "/var/www", is_dir=False)
+        )
+        self.assertTrue(
+            is_ignored("/var/www/build", ["build/"], "/var/www", is_dir=True)
+        )
+
+    def test_ignore_matcher_gitignore_semantics(self):
+        matcher = IgnoreMatcher(
+            ["*.log", "!keep.log", "/build", "docs/**/tmp", "cache/", "a/**/b.txt"]
+        )
+        self.assertTrue(matcher.match("logs/app.log"))
+        self.assertFalse(matcher.match("logs/keep.log"))
+        self.assertTrue(matcher.match("build", is_dir=True))
+        self.assertFalse(matcher.match("src/build", is_dir=True))
+        self.assertTrue(matcher.match("docs/tmp", is_dir=True))
+        self.assertTrue(matcher.match("docs/x/y/tmp"))
+        self.assertTrue(matcher.match("src/cache", is_dir=True))
+        self.assertFalse(matcher.match("src/cache"))
+        self.assertTrue(matcher.match("a/b.txt"))
+        self.assertTrue(matcher.match("a/x/y/b.txt"))
+        self.assertTrue(matcher.is_ignored("build/out/main.o"))
+
+        # 下位の .gitignore が上位の定義より優先される
+        matcher.add_patterns("pkg", ["!*.log", "*.tmp"])
+        self.assertFalse(matcher.match("pkg/debug.log"))
+        self.assertTrue(matcher.match("pkg/sub/x.tmp"))
+        self.assertFalse(matcher.match("other/x.tmp"))
+
+    def test_get_directory_structure_nested_gitignore(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "pkg", "build"))
+            for name in ["pkg/.gitignore", "pkg/a.py", "pkg/a.tmp", "b.tmp"]:
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write("*.tmp\nbuild/\n" if name.endswith(".gitignore") else "")
+
+            matcher = IgnoreMatcher([], load_nested=True)
+            formatted = format_directory_structure(
+                get_directory_structure(tmpdir, matcher), tmpdir
+            )
+            self.assertIn("a.py", formatted)
+            self.assertIn("b.tmp", formatted)
+            self.assertNotIn("a.tmp", formatted)
+            self.assertNotIn("build/", formatted)
+
+    def test_get_directory_structure_parallel_is_deterministic(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for d in ["b/y", "b/x", "a", "c/z/w"]:
+                os.makedirs(os.path.join(tmpdir, d))
+            for name in ["b/y/2.txt", "b/y/1.txt", "a/f.py", "c/z/w/g.py", "root.txt"]:
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write("")
+
+            sequential = get_directory_structure(tmpdir, [], max_workers=1)
+            parallel = get_directory_structure(tmpdir, [], max_workers=4)
+            self.assertEqual(sequential, parallel)
+            self.assertEqual(
+                [(d["depth"], d["dirname"]) for d in parallel[1:]],
+                [(1, "a"), (1, "b"), (2, "x"), (2, "y"), (1, "c"), (2, "z"), (3, "w")],
+            )
+            self.assertEqual(parallel[4]["files"], ["1.txt", "2.txt"])
+
+    def test_directory_cache_reuses_unchanged_directories(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            cache_dir = os.path.join(tmpdir, "cache")
+            os.makedirs(os.path.join(root, "pkg"))
+            for name in ["pkg/a.py", "pkg/a.tmp", "pkg/.gitignore"]:
+                with open(os.path.join(root, name), "w") as f:
+                    f.write("*.tmp\n" if name.endswith(".gitignore") else "")
+            for d in [root, os.path.join(root, "pkg")]:
+                os.utime(d, ns=(10**9, 10**9))
+
+            def scan():
+                cache = DirectoryCache.load(root, cache_dir=cache_dir)
+                matcher = IgnoreMatcher([], load_nested=True)
+                structure = get_directory_structure(root, matcher, 2, cache)
+                cache.save()
+                return cache, structure[1]["files"]
+
+            scan()
+            cache, files = scan()
+            self.assertEqual((cache.hits, cache.misses), (2, 0))
+            self.assertEqual(files, [".gitignore", "a.py"])
+
+            # ignore ファイルの変更は、ディレクトリの mtime が同じでも反映される
+            with open(os.path.join(root, "pkg", ".gitignore"), "w") as f:
+                f.write("*.py\n")
+            os.utime(os.path.join(root, "pkg"), ns=(10**9, 10**9))
+            cache, files = scan()
+            self.assertEqual(cache.hits, 2)
+            self.assertEqual(files, [".gitignore", "a.tmp"])
+
+            with open(os.path.join(root, "pkg", "b.txt"), "w") as f:
+                f.write("")
+            cache, files = scan()
+            self.assertEqual(cache.misses, 1)
+            self.assertIn("b.txt", files)
 
     def test_get_directory_structure_and_format(self):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -71,6 +212,315 @@ class TestAgentFunctions(unittest.TestCase):
             self.assertIn("subdir/", formatted)
             self.assertIn("test.txt", formatted)
 
+    def test_format_directory_structure_max_depth(self):
+        structure = [
+            {"depth": 0, "dirname": "root", "files": ["a.py"]},
+            {"depth": 1, "dirname": "pkg", "files": ["b.py"]},
+            {"depth": 2, "dirname": "sub", "files": ["c.py", "d.py"]},
+            {"depth": 1, "dirname": "docs", "files": []},
+        ]
+        formatted = format_directory_structure(structure, "/var/www", max_depth=0)
+        self.assertEqual(
+            formatted,
+            "# ディレクトリ構造\n/var/www/\n    a.py\n"
+            "    pkg/ (+4 more)\n    docs/ (+0 more)\n",
+        )
+
+    def test_directory_tree_depth_file_cap_and_subtree(self):
+        structure = [
+            {"depth": 0, "dirname": "root", "files": ["a.py"]},
+            {"depth": 1, "dirname": "pkg", "files": ["b.py", "c.py", "d.py"]},
+            {"depth": 2, "dirname": "sub", "files": ["e.py"]},
+            {"depth": 1, "dirname": "docs", "files": []},
+        ]
+        tree = DirectoryTree.from_structure(structure)
+        self.assertEqual(tree.to_structure(), structure)
+        self.assertEqual(
+            format_directory_structure(tree, "/var/www", max_depth=1, max_files=2),
+            "# ディレクトリ構造\n/var/www/\n    a.py\n    pkg/\n        b.py\n"
+            "        c.py\n        ... (+1 more)\n        sub/ (+1 more)\n    docs/\n",
+        )
+        self.assertIsNone(tree.find("pkg/missing"))
+        buffer = io.StringIO()
+        tree.write(buffer, "/var/www/pkg", start=tree.find("pkg"), max_depth=0)
+        self.assertEqual(
+            buffer.getvalue(),
+            "# ディレクトリ構造\n/var/www/pkg/\n    b.py\n    c.py\n    d.py\n"
+            "    sub/ (+1 more)\n",
+        )
+        capped = TreeSection(tree, "/var/www", max_files=1)
+        full = TreeSection(tree, "/var/www")
+        self.assertLess(capped.estimate_tokens(), full.estimate_tokens())
+        # 指紋は描画結果の SHA-1 と一致し、表示内容が変われば変わる
+        buffer = io.StringIO()
+        full.write(buffer)
+        self.assertEqual(
+            full.fingerprint(),
+            hashlib.sha1(buffer.getvalue().encode("utf-8")).hexdigest(),
+        )
+        self.assertNotEqual(capped.fingerprint(), full.fingerprint())
+
+    def test_apply_token_budget(self):
+        self.assertEqual(estimate_tokens("abcdefgh"), 2)
+        self.assertEqual(estimate_tokens("あいう"), 3)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            specs = []
+            for i in range(3):
+                with open(os.path.join(tmpdir, f"f{i}.py"), "w") as f:
+                    f.write("x = 1\n" * 400)
+                specs.append(f"src/f{i}.py")
+            structure = [{"depth": 0, "dirname": "root", "files": ["f.py"] * 500}]
+            values = {
+                "input": "Q",
+                "directory_structure": TreeSection(structure, tmpdir),
+                "code": CodeSection(specs, ("src", tmpdir)),
+            }
+            template = "{input}\n{directory_structure}\n{code}"
+            budget = apply_token_budget(template, values, 1000)
+            result = generate_prompt(template, values)
+
+            self.assertLessEqual(budget.used, 1000)
+            self.assertIn("File f0.py", result)
+            self.assertIn("中略", result)
+            self.assertNotIn("File f2.py", result)
+            self.assertIn("トークン数の上限のため省略", result)
+
+    def test_run_batch_shares_tree_and_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "a.py"), "w") as f:
+                f.write("print('a')")
+            os.utime(os.path.join(tmpdir, "a.py"), ns=(10**9, 10**9))
+            jobs_path = os.path.join(tmpdir, "jobs.jsonl")
+            with open(jobs_path, "w") as f:
+                f.write('{"template": "3", "files": "src/a.py", "error": "E1"}\n')
+                f.write('{"template": "ask_prompt", "files": ["@", "src/a.py"],')
+                f.write(' "input": "Q2", "output": "%s/out/q.md"}\n' % tmpdir)
+
+            context = BatchContext(folder_mapping=("src", tmpdir), workers=1)
+            results = run_batch(load_jobs(jobs_path), context, tmpdir, max_jobs=2)
+            self.assertEqual(
+                [path for path, _ in results],
+                [os.path.join(tmpdir, ".aa_prompt_1.md"), f"{tmpdir}/out/q.md"],
+            )
+            self.assertTrue(all(error is None for _, error in results))
+            with open(results[0][0], encoding="utf-8") as f:
+                first = f.read()
+            with open(results[1][0], encoding="utf-8") as f:
+                second = f.read()
+            self.assertIn("E1", first)
+            self.assertIn("print('a')", first)
+            self.assertIn("# ディレクトリ構造", first)
+            self.assertIn("Q2", second)
+            self.assertNotIn("フルパス", second)
+            self.assertEqual(len(context._trees), 1)
+            self.assertEqual(context.file_cache.misses, 1)
+
+    def test_multiple_folder_mappings(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            web = os.path.join(tmpdir, "www")
+            lib = os.path.join(tmpdir, "lib")
+            os.makedirs(os.path.join(web, "app"))
+            os.makedirs(lib)
+            with open(os.path.join(web, "app", "main.py"), "w") as f:
+                f.write("import util")
+            with open(os.path.join(lib, "util.py"), "w") as f:
+                f.write("VALUE = 1")
+            mapping = [("src", web), ("lib", lib)]
+
+            tree = list_directory_structure(("src", "lib"), mapping, workers=2)
+            self.assertEqual(tree.count("# ディレクトリ構造"), 1)
+            self.assertIn(f"{web}/\n    app/\n        main.py\n", tree)
+            self.assertIn(f"{lib}/\n    util.py\n", tree)
+            markdown = read_code_as_markdown(["src/app/*.py", "lib/util.py"], mapping)
+            self.assertIn("import util", markdown)
+            self.assertIn("VALUE = 1", markdown)
+
+            context = BatchContext(folder_mapping=mapping, workers=1)
+            job = {"template": "3", "files": "lib/util.py", "error": "E1"}
+            prompt = generate_prompt(*context.prepare_job(job))
+            self.assertIn(f"{web}/", prompt)
+            self.assertIn(f"{lib}/", prompt)
+            self.assertEqual(sorted(context._trees), ["lib", "src"])
+
+    def test_multiple_folder_mappings_keep_ignore_rules_per_root(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = os.path.join(tmpdir, "r1")
+            second = os.path.join(tmpdir, "r2")
+            os.makedirs(first)
+            os.makedirs(os.path.join(second, "pkg"))
+            with open(os.path.join(first, ".gitignore"), "w") as f:
+                f.write("*.py\n")
+            for path in ["r1/a.txt", "r1/x.py", "r2/pkg/b.py"]:
+                with open(os.path.join(tmpdir, path), "w") as f:
+                    f.write("")
+            section = CodeSection(
+                ["src/*", "lib/pkg/*.py"],
+                folder_mapping=[("src", first), ("lib", second)],
+                matcher=IgnoreMatcher([], load_nested=True),
+            )
+            # r1 の .gitignore は r1 の中だけに適用される
+            self.assertEqual(
+                section.files,
+                [os.path.join(first, "a.txt"), os.path.join(second, "pkg", "b.py")],
+            )
+
+    def test_refresh_prompt_rebuilds_only_changed_sections(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "root")
+            os.makedirs(root)
+            a_path = os.path.join(root, "a.py")
+            with open(a_path, "w") as f:
+                f.write("print('a')")
+            os.utime(a_path, ns=(10**9, 10**9))
+            output_path = os.path.join(tmpdir, "out", ".aa_prompt.md")
+            context = BatchContext(folder_mapping=("src", root), workers=1)
+            job = {"template": "3", "files": ["src/a.py"], "error": "E1"}
+            context.render_job(job, output_path)
+            with open(output_path, "rb") as f:
+                first = f.read()
+            self.assertEqual(refresh_prompt(output_path, workers=1), [])
+
+            with open(a_path, "w") as f:
+                f.write("print('changed')")
+            os.utime(a_path, ns=(2 * 10**9, 2 * 10**9))
+            self.assertEqual(refresh_prompt(output_path, workers=1), ["code"])
+            with open(output_path, "rb") as f:
+                second = f.read()
+            self.assertEqual(second, first.replace(b"'a'", b"'changed'"))
+
+            with open(os.path.join(root, "b.py"), "w") as f:
+                f.write("")
+            changed = refresh_prompt(output_path, workers=1)
+            self.assertEqual(changed, ["directory_structure"])
+            with open(output_path, encoding="utf-8") as f:
+                self.assertIn("b.py", f.read())
+
+    def test_refresh_does_not_block_scanned_trees(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "a.py"), "w") as f:
+                f.write("def main(): pass\n")
+            context = BatchContext(folder_mapping=("src", tmpdir), workers=1)
+            self.assertIsInstance(context.directory_section("src"), TreeSection)
+            index = context.code_index()
+            started, release = threading.Event(), threading.Event()
+            scan = agent.list_directory_section
+
+            def slow_scan(*args, **kwargs):
+                started.set()
+                release.wait(10)
+                return scan(*args, **kwargs)
+
+            with patch("agent.list_directory_section", slow_scan):
+                refresher = threading.Thread(target=context.refresh)
+                refresher.start()
+                try:
+                    self.assertTrue(started.wait(10))
+                    # 再走査の途中でも、走査済みのツリーと索引はすぐに使える
+                    results = []
+                    reader = threading.Thread(
+                        target=lambda: results.extend(
+                            [context.directory_section("src"), context.code_index()]
+                        )
+                    )
+                    reader.start()
+                    reader.join(5)
+                    self.assertFalse(reader.is_alive())
+                    self.assertIsInstance(results[0], TreeSection)
+                    self.assertIs(results[1], index)
+                finally:
+                    release.set()
+                    refresher.join(10)
+            self.assertFalse(refresher.is_alive())
+
+    def test_prompt_server_keeps_caches_warm(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "a.py"), "w") as f:
+                f.write("print('a')")
+            os.utime(os.path.join(tmpdir, "a.py"), ns=(10**9, 10**9))
+            context = BatchContext(folder_mapping=("src", tmpdir), workers=1)
+            server = make_prompt_server(context, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = "http://127.0.0.1:%d/prompt" % server.server_address[1]
+            job = json.dumps({"template": "3", "files": "src/a.py", "error": "E1"})
+
+            def post(data=job, headers=None):
+                headers = headers or {"Content-Type": "application/json"}
+                request = urllib.request.Request(url, data.encode("utf-8"), headers)
+                try:
+                    with urllib.request.urlopen(request) as res:
+                        return res.status, json.loads(res.read())
+                except urllib.error.HTTPError as e:
+                    return e.code, json.loads(e.read())
+
+            try:
+                status, result = post()
+                self.assertEqual(status, 200)
+                self.assertIn("print('a')", result["prompt"])
+                with open(os.path.join(tmpdir, "b.py"), "w") as f:
+                    f.write("")
+                context.refresh()
+                second = post()[1]["prompt"]
+                # ブラウザなどからの要求と、ルートの外側のパスは拒否する
+                self.assertEqual(post(headers={"Content-Type": "text/plain"})[0], 415)
+                foreign = {"Content-Type": "application/json", "Host": "evil.example"}
+                self.assertEqual(post(headers=foreign)[0], 403)
+                # 外側のファイルは有無にかかわらず同じ応答で、パスは返さない
+                for outside_file in [__file__, "/nonexistent/agent_simple.py"]:
+                    outside_file = os.path.abspath(outside_file)
+                    outside = json.dumps({"template": "3", "files": outside_file})
+                    self.assertEqual(
+                        post(outside),
+                        (400, {"error": "Path outside the mapped folders"}),
+                    )
+                escape = json.dumps({"template": "3", "output": "../../x.md"})
+                status, result = post(escape)
+                self.assertEqual(status, 400)
+                self.assertNotIn(os.path.realpath(tmpdir), result["error"])
+                # 内部のエラーは 500 で、詳細はクライアントに返さない
+                with patch("agent.generate_prompt", side_effect=OSError("/secret")):
+                    with patch("builtins.print"):
+                        self.assertEqual(
+                            post(), (500, {"error": "Internal server error"})
+                        )
+                inside = json.dumps({"template": "3", "error": "E", "output": "p.md"})
+                status, result = post(inside)
+                self.assertEqual(status, 200)
+                self.assertEqual(
+                    result["output"],
+                    os.path.join(os.path.realpath(tmpdir), "agent_simple", "p.md"),
+                )
+            finally:
+                server.shutdown()
+                server.server_close()
+            self.assertIn("b.py", second)
+            self.assertEqual(context.file_cache.misses, 1)
+            self.assertEqual(context.file_cache.hits, 1)
+
+    def test_profiler_records_stages_and_counters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "a.py"), "w") as f:
+                f.write("print('a')")
+            profiler = Profiler()
+            previous = set_profiler(profiler)
+            try:
+                get_directory_structure(tmpdir, [])
+                read_file(os.path.join(tmpdir, "a.py"))
+            finally:
+                set_profiler(previous)
+            # 計測を止めた後の処理は記録されない
+            read_file(os.path.join(tmpdir, "a.py"))
+            report_path = os.path.join(tmpdir, "out", "profile.json")
+            profiler.save(report_path, file_cache={"hits": 0})
+            with open(report_path, encoding="utf-8") as f:
+                report = json.load(f)
+        self.assertEqual(report["stages"]["walk"]["calls"], 1)
+        self.assertEqual(report["stages"]["read"]["calls"], 1)
+        self.assertEqual(report["counters"]["files_read"], 1)
+        self.assertEqual(report["counters"]["bytes_read"], len("print('a')"))
+        self.assertEqual(report["counters"]["files_listed"], 1)
+        self.assertEqual(report["file_cache"], {"hits": 0})
+
     def test_sanitize_string(self):
         normal_str = "hello world"
         self.assertEqual(sanitize_string(normal_str), normal_str)
@@ -98,6 +548,286 @@ class TestAgentFunctions(unittest.TestCase):
                 any("Some characters were removed" in str(warn.message) for warn in w)
             )
 
+    def test_decode_utf8_chunks(self):
+        data = "あいう\n".encode("utf-8") * 3 + b"\xff\xfe" + "えお".encode("utf-8")
+        # 小さいチャンクで文字の途中を区切っても、結果は一括デコードと同じになる
+        for chunk_size in (1, 4, 5, 7, len(data)):
+            text, dropped = decode_utf8(data, chunk_size=chunk_size)
+            self.assertEqual(text, "あいう\n" * 3 + "えお")
+            self.assertEqual(dropped, [(30, 32)])
+
+    def test_expand_file_specs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for path in ["a.py", "pkg/b.py", "pkg/sub/c.py", "pkg/gen/d.py", ".h.py"]:
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, path)), exist_ok=True)
+                with open(os.path.join(tmpdir, path), "w") as f:
+                    f.write("")
+            with open(os.path.join(tmpdir, "pkg", ".gitignore"), "w") as f:
+                f.write("gen/\n")
+            specs = [
+                os.path.join(tmpdir, "pkg/b.py"),
+                os.path.join(tmpdir, "**/*.py"),
+                os.path.join(tmpdir, "pkg/gen/d.py"),
+                os.path.join(tmpdir, "*.md"),
+            ]
+            matcher = IgnoreMatcher([".git/"], load_nested=True)
+            result = expand_file_specs(specs, root=tmpdir, matcher=matcher)
+            join = lambda *paths: [os.path.join(tmpdir, p) for p in paths]
+            # 重複は先のスペックに残り、無視されたディレクトリは明示した場合のみ含まれる
+            self.assertEqual(result[0], join("pkg/b.py"))
+            self.assertEqual(result[1], join("a.py", "pkg/sub/c.py"))
+            self.assertEqual(result[2], join("pkg/gen/d.py"))
+            self.assertIsNone(result[3])
+            # 起点が除外されたディレクトリのワイルドカードも ** と同じ結果になる
+            for spec in ["pkg/gen/*.py", "pkg/gen/**"]:
+                result = expand_file_specs(
+                    [os.path.join(tmpdir, spec)],
+                    root=tmpdir,
+                    matcher=IgnoreMatcher([".git/"], load_nested=True),
+                )
+                self.assertEqual(result, [None])
+            unfiltered = expand_file_specs([os.path.join(tmpdir, "pkg/**")])[0]
+            self.assertEqual(
+                unfiltered, join("pkg/b.py", "pkg/gen/d.py", "pkg/sub/c.py")
+            )
+
+    def test_code_index_ranks_relevant_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sources = {
+                "app/Models/User.php": "<?php\nnamespace App\\Models;\nclass User {}\n",
+                "app/Http/Controllers/UserController.php": (
+                    "<?php\nuse App\\Models\\User;\n"
+                    "class UserController { function show() {} }\n"
+                ),
+                "lib/parser.py": "from .tokens import tokenize\ndef parse_expr(): ...",
+                "lib/tokens.py": "def tokenize(text): pass\n",
+                "lib/other.py": "def unrelated(): pass\n",
+            }
+            for path, text in sources.items():
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, path)), exist_ok=True)
+                with open(os.path.join(tmpdir, path), "w") as f:
+                    f.write(text)
+                os.utime(os.path.join(tmpdir, path), ns=(10**9, 10**9))
+            index = CodeIndex(tmpdir)
+            self.assertEqual(index.update(IgnoreMatcher([".git/"])), 5)
+            join = lambda *paths: [os.path.join(tmpdir, p) for p in paths]
+
+            # エラー文のパスに一致するファイルと、その import 先が上位になる
+            error = 'File "/var/www/lib/parser.py", line 2, in parse_expr'
+            self.assertEqual(
+                index.query(error, 2), join("lib/parser.py", "lib/tokens.py")
+            )
+            # 名前空間は Laravel の配置に従って解決される
+            self.assertEqual(
+                index.query('Class "App\\Models\\User" not found', 1),
+                join("app/Models/User.php"),
+            )
+            self.assertEqual(
+                index.query("UserController show failed", 1),
+                join("app/Http/Controllers/UserController.php"),
+            )
+
+            # 変更・削除されたファイルだけが索引に反映される
+            os.remove(os.path.join(tmpdir, "lib/other.py"))
+            with open(os.path.join(tmpdir, "lib/tokens.py"), "w") as f:
+                f.write("def lexer(text): pass\n")
+            os.utime(os.path.join(tmpdir, "lib/tokens.py"), ns=(2 * 10**9, 2 * 10**9))
+            self.assertEqual(index.update(IgnoreMatcher([".git/"])), 1)
+            self.assertEqual(len(index.files), 4)
+            self.assertEqual(index.query("lexer", 1), join("lib/tokens.py"))
+
+    def test_extract_references_keeps_dotted_names(self):
+        # 先頭の ./ と ../ だけを取り除き、ドットで始まる名前は残す
+        text = (
+            "<?php\nrequire_once './.config/db.php';\n"
+            "include '../lib/util.php';\nrequire '.env.php';\n"
+        )
+        self.assertEqual(
+            _extract_references(text, "public/index.php"),
+            [".config/db.php", "lib/util.php", ".env.php"],
+        )
+
+    def test_traceback_section_excerpts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "app"))
+            with open(os.path.join(tmpdir, "app", "main.py"), "w") as f:
+                f.write("".join(f"line{i}\n" for i in range(1, 5001)))
+            error = (
+                "Traceback (most recent call last):\n"
+                '  File "/usr/lib/python3/json/decoder.py", line 3, in decode\n'
+                '  File "/var/www/app/main.py", line 2, in <module>\n'
+                '  File "src/app/main.py", line 4000, in run\n'
+                "PHP Fatal error: Oops in /var/www/app/Foo.php:12\n"
+                "#0 /var/www/vendor/x/Bar.php(3): call()\n"
+            )
+            self.assertEqual(
+                parse_traceback(error),
+                [
+                    ("/usr/lib/python3/json/decoder.py", 3),
+                    ("/var/www/app/main.py", 2),
+                    ("src/app/main.py", 4000),
+                    ("/var/www/app/Foo.php", 12),
+                    ("/var/www/vendor/x/Bar.php", 3),
+                ],
+            )
+            # 改行を数えるチャンクを小さくして、チャンクをまたぐ行の位置を確認する
+            with patch("agent.LINE_SCAN_CHUNK", 64):
+                section = traceback_section(error, ("src", tmpdir), context_lines=1)
+                buffer = io.StringIO()
+                section.write(buffer)
+            main_path = os.path.join(tmpdir, "app", "main.py")
+            self.assertEqual(section.files, [main_path])
+            text = buffer.getvalue()
+            self.assertIn(">    2 | line2\n", text)
+            self.assertIn("     3 | line3\n...\n", text)
+            self.assertIn("  3999 | line3999\n> 4000 | line4000\n", text)
+            self.assertNotIn("line5", text)
+            self.assertLess(section.estimate_tokens(), 200)
+
+            # ファイルの末尾より後ろの行は、空のコードブロックではなく注記になる
+            with open(os.path.join(tmpdir, "app", "short.py"), "w") as f:
+                f.write("a = 1\n")
+            open(os.path.join(tmpdir, "app", "empty.py"), "w").close()
+            error = (
+                '  File "/var/www/app/short.py", line 50, in run\n'
+                '  File "/var/www/app/empty.py", line 1, in <module>\n'
+            )
+            section = traceback_section(error, ("src", tmpdir), context_lines=1)
+            buffer = io.StringIO()
+            section.write(buffer)
+            text = buffer.getvalue()
+            self.assertIn("（50 行目はファイルの範囲外です）", text)
+            self.assertIn("（1 行目はファイルの範囲外です）", text)
+            self.assertNotIn("```\n\n```", text)
+
+    def test_traceback_section_skips_library_frames(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "pkg"))
+            for name in ("app.py", os.path.join("pkg", "views.py")):
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write("".join(f"line{i}\n" for i in range(1, 2001)))
+            # 同名のファイルがプロジェクトにあっても、ライブラリのフレームは添付しない
+            site = "/usr/local/lib/python3.11/site-packages/flask/app.py"
+            error = f'  File "{site}", line 1498, in __call__\n'
+            self.assertIsNone(traceback_section(error, ("src", tmpdir)))
+            # ファイル名だけの一致は使わず、親ディレクトリも一致する場合だけ対応づける
+            error = (
+                '  File "/opt/other/app.py", line 3, in run\n'
+                '  File "/srv/deploy/pkg/views.py", line 7, in show\n'
+            )
+            section = traceback_section(error, ("src", tmpdir))
+            self.assertEqual(section.files, [os.path.join(tmpdir, "pkg", "views.py")])
+            # ルート内のシンボリックリンクが外側を指す場合も対応づけない
+            with tempfile.TemporaryDirectory() as outside:
+                with open(os.path.join(outside, "secret.py"), "w") as f:
+                    f.write("token = 1\n")
+                os.symlink(
+                    os.path.join(outside, "secret.py"),
+                    os.path.join(tmpdir, "pkg", "link.py"),
+                )
+                error = '  File "/var/www/pkg/link.py", line 1, in <module>\n'
+                self.assertIsNone(traceback_section(error, ("src", tmpdir)))
+
+    def test_read_file_binary_and_size_limit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            binary_path = os.path.join(tmpdir, "image.png")
+            with open(binary_path, "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\n" + b"\x00" * 100)
+            self.assertIn("バイナリファイル", read_file(binary_path))
+
+            text_path = os.path.join(tmpdir, "big.txt")
+            lines = [f"line {i}" for i in range(1000)]
+            with open(text_path, "w") as f:
+                f.write("\n".join(lines))
+            excerpt = read_file(text_path, max_bytes=200)
+            self.assertTrue(excerpt.startswith("line 0\n"))
+            self.assertTrue(excerpt.endswith("line 999"))
+            self.assertIn("中略", excerpt)
+            self.assertLess(len(excerpt), 300)
+
+            empty_path = os.path.join(tmpdir, "empty.txt")
+            open(empty_path, "w").close()
+            self.assertEqual(read_file(empty_path), "")
+
+            # mmap できない場合も、抜粋の末尾はファイルの本当の末尾になる
+            big_path = os.path.join(tmpdir, "bigger.txt")
+            with open(big_path, "w") as f:
+                f.write("\n".join(f"行 {i}" for i in range(20000)))
+
+            class UnmappableFile(agent.mmap.mmap):
+                def __new__(cls, *args, **kwargs):
+                    raise OSError("mmap is not supported")
+
+            for path in (text_path, big_path):
+                mapped, full = read_file(path, max_bytes=300), read_file(path)
+                with patch.object(agent.mmap, "mmap", UnmappableFile):
+                    self.assertEqual(read_file(path, max_bytes=300), mapped)
+                    self.assertEqual(read_file(path), full)
+            self.assertTrue(mapped.endswith("行 19999"))
+
+    def test_code_section_total_limit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            specs = []
+            for i in range(5):
+                with open(os.path.join(tmpdir, f"f{i}.py"), "w") as f:
+                    f.write("x" * 100)
+                specs.append(f"src/f{i}.py")
+
+            section = CodeSection(specs, ("src", tmpdir), max_total_bytes=250)
+            buffer = io.StringIO()
+            section.write(buffer)
+            self.assertIn("File f2.py", buffer.getvalue())
+            self.assertNotIn("File f3.py", buffer.getvalue())
+            self.assertEqual(
+                section.omitted_files,
+                [os.path.join(tmpdir, "f3.py"), os.path.join(tmpdir, "f4.py")],
+            )
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i in range(3):
+                path = os.path.join(tmpdir, f"f{i}.py")
+                with open(path, "w") as f:
+                    f.write(f"value = {i}\n" * 10)
+                os.utime(path, ns=(10**9, 10**9))
+                paths.append(path)
+            cache_dir = os.path.join(tmpdir, "cache")
+
+            cache = FileCache(cache_dir=cache_dir)
+            self.assertEqual(cache.read(paths[0]), "value = 0\n" * 10)
+            self.assertEqual(cache.read(paths[0]), "value = 0\n" * 10)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # 別インスタンスではディスクから読み込む
+            other = FileCache(cache_dir=cache_dir)
+            self.assertEqual(other.read(paths[0]), "value = 0\n" * 10)
+            self.assertEqual((other.disk_hits, other.misses), (1, 0))
+
+            # 改行コード（CRLF / CR）はディスクのキャッシュを経ても変わらない
+            crlf_path = os.path.join(tmpdir, "crlf.py")
+            with open(crlf_path, "wb") as f:
+                f.write(b"a = 1\r\nb = 2\rc = 3\n")
+            os.utime(crlf_path, ns=(10**9, 10**9))
+            self.assertEqual(cache.read(crlf_path), read_file(crlf_path))
+            reloaded = FileCache(cache_dir=cache_dir)
+            self.assertEqual(reloaded.read(crlf_path), "a = 1\r\nb = 2\rc = 3\n")
+            self.assertEqual(reloaded.disk_hits, 1)
+
+            # ファイルが変わると読み直す
+            with open(paths[0], "w") as f:
+                f.write("changed")
+            os.utime(paths[0], ns=(2 * 10**9, 2 * 10**9))
+            self.assertEqual(other.read(paths[0]), "changed")
+            self.assertEqual(other.misses, 1)
+
+            # 合計サイズを超えると古いものから破棄する
+            small = FileCache(max_bytes=300)
+            for path in paths:
+                small.read(path)
+            self.assertEqual(len(small._entries), 2)
+            self.assertIsNone(small.read(os.path.join(tmpdir, "missing.py")))
+
     def test_read_file_and_add_markdown_block(self):
         with tempfile.NamedTemporaryFile("w", delete=False) as tmp_file:
             tmp_file_name = tmp_file.name
@@ -113,8 +843,61 @@ class TestAgentFunctions(unittest.TestCase):
         finally:
             os.remove(tmp_file_name)
 
-    # def test_read_code_as_markdown(self):
-    #     pass
+    def test_read_code_as_markdown(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ["a.py", "b.py"]:
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write(f"print('{name}')")
+
+            result = read_code_as_markdown(
+                ["src/b.py", "src/a.py", "src/missing.py"], ("src", tmpdir)
+            )
+            self.assertEqual(
+                result,
+                "\n## File b.py\n```\nprint('b.py')\n```"
+                "\n## File a.py\n```\nprint('a.py')\n```",
+            )
+            self.assertEqual(read_code_as_markdown([], ("src", tmpdir)), "")
+
+    def test_code_section_concurrent_read_keeps_order(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            specs = []
+            for i in range(20):
+                with open(os.path.join(tmpdir, f"f{i}.py"), "w") as f:
+                    f.write(str(i))
+                specs.append(f"src/f{i}.py")
+            specs.insert(5, "src/missing.py")
+
+            sequential = CodeSection(specs, ("src", tmpdir), workers=1)
+            parallel = CodeSection(specs, ("src", tmpdir), workers=4)
+            outputs = []
+            for section in (sequential, parallel):
+                buffer = io.StringIO()
+                section.write(buffer)
+                outputs.append(buffer.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertLess(outputs[1].index("f3.py"), outputs[1].index("f12.py"))
+            self.assertEqual(
+                parallel.not_found_files, [os.path.join(tmpdir, "missing.py")]
+            )
+
+    def test_generate_prompt_writes_sections(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "a.py"), "w") as f:
+                f.write("x = '{input}'")
+            template = "# 指示\n{input}\n# 該当コード\n{code}\n"
+
+            section = CodeSection(["src/a.py"], ("src", tmpdir))
+            result = generate_prompt(template, {"input": "Q", "code": section})
+            # 埋め込んだコード中の {input} は置換されない
+            self.assertEqual(
+                result,
+                "# 指示\nQ\n# 該当コード\n\n## File a.py\n```\nx = '{input}'\n```\n",
+            )
+
+            empty = CodeSection([], ("src", tmpdir))
+            result = generate_prompt(template, {"input": "Q", "code": empty})
+            self.assertEqual(result, "# 指示\nQ\n")
 
     # def test_create_input_prompt(self):
     #     pass